@@ -1,15 +1,12 @@
 import argparse
 import logging
-import glob
 import os
 
 from pathlib import Path
-import pandas as pd
 
-import src.core as core
-import src.parsing as parsing
-import src.formatting as formatting
-import src.copositivity as copositivity
+# heavy dependencies (pandas, numpy, openpyxl) are only imported once the arguments are parsed and checked,
+# see cli_aura_data_processor()
+import src.options as options
 
 
 ########################
@@ -46,6 +43,117 @@ def parse_args():
                             metavar='OUTPUT_FOLDER',
                             help='Path to output folder')
 
+    main_group.add_argument('-m', '--output-mode',
+                            choices=['formulas', 'values'],
+                            default='formulas',
+                            metavar='OUTPUT_MODE',
+                            help="Write the analysis as spreadsheet 'formulas' or as computed 'values' "
+                                 "(default: formulas)")
+
+    main_group.add_argument('-l', '--layout',
+                            choices=options.LAYOUTS,
+                            default='sheets',
+                            metavar='LAYOUT',
+                            help="'sheets': one sheet per sample, or 'long': one data sheet and one analysis sheet "
+                                 "of computed values for all samples, for very large experiments (default: sheets)")
+
+    main_group.add_argument('-f', '--format',
+                            choices=['xlsx', *options.EXPORT_FORMATS],
+                            nargs='+',
+                            default=['xlsx'],
+                            metavar='FORMAT',
+                            help="Output files: 'xlsx' workbook and/or the merged data and analysis tables as "
+                                 "'parquet', 'arrow' (IPC) or 'csv' files (default: xlsx)")
+
+    main_group.add_argument('-t', '--threshold',
+                            type=float,
+                            default=None,
+                            metavar='THRESHOLD',
+                            help='Minimum value for a cell to be positive (default: 1 for Count, >0 for Area). '
+                                 'Requires --output-mode values or --layout long')
+
+    main_group.add_argument('-b', '--bin-edges',
+                            type=float,
+                            nargs=3,
+                            default=None,
+                            metavar='EDGE',
+                            help='Lower edges of the 3 upper H-score bins (default: 4 10 16). '
+                                 'Requires --output-mode values or --layout long, and --analysis Count')
+
+    main_group.add_argument('-s', '--sweep',
+                            type=float,
+                            nargs='+',
+                            default=None,
+                            metavar='THRESHOLD',
+                            help='Also write a .csv table of %% positive cells, H-score and %% co-positive cells '
+                                 'at each of the given positivity thresholds')
+
+    main_group.add_argument('-w', '--writer',
+                            choices=options.XLSX_BACKENDS,
+                            default='openpyxl',
+                            metavar='BACKEND',
+                            help="Library writing the .xlsx file: 'openpyxl', which keeps every sample and the "
+                                 "whole workbook in memory until it is saved, or 'xlsxwriter', which processes one "
+                                 "sample at a time and streams its sheet to disk, memory being bounded by the largest "
+                                 "sample (default: openpyxl)")
+
+    main_group.add_argument('-j', '--jobs',
+                            type=int,
+                            default=1,
+                            metavar='N',
+                            help='Number of threads reading the input files of the next samples, each process '
+                                 'reads its own files with --processes (default: 1)')
+
+    main_group.add_argument('-p', '--processes',
+                            type=int,
+                            default=1,
+                            metavar='N',
+                            help='Number of processes building the sample sheets, written with the xlsxwriter '
+                                 'backend (default: 1)')
+
+    main_group.add_argument('--append',
+                            action='store_true',
+                            help='Add the new or changed samples to the workbook of a previous --append run, the '
+                                 'other sheets are kept as is (samples are listed in <name>_manifest.json). The '
+                                 'workbook is always written with the xlsxwriter writer, --writer is ignored')
+
+    main_group.add_argument('--watch',
+                            action='store_true',
+                            help='Watch the input folder while the AURA macro writes it: each sample is appended to '
+                                 'the workbook (see --append) as soon as the files of all its channels are written')
+
+    main_group.add_argument('--debounce',
+                            type=float,
+                            default=options.WATCH_DEBOUNCE,
+                            metavar='SECONDS',
+                            help='With --watch, files are read once unchanged for this long, so that files being '
+                                 f'written are not read (default: {options.WATCH_DEBOUNCE})')
+
+    main_group.add_argument('--idle-timeout',
+                            type=float,
+                            default=None,
+                            metavar='MINUTES',
+                            help='With --watch, stop once no file changed for this long, samples still missing '
+                                 'channels are then processed as they are (default: watch until interrupted)')
+
+    main_group.add_argument('--cache',
+                            default=None,
+                            metavar='DIR',
+                            help='Directory caching the parsed input files: on reruns, only new or changed files '
+                                 'are parsed (default: no cache)')
+
+    main_group.add_argument('--cache-size',
+                            type=int,
+                            default=options.DEFAULT_CACHE_SIZE,
+                            metavar='MB',
+                            help='Maximum size of the cache directory, least recently used files are removed '
+                                 f'beyond it (default: {options.DEFAULT_CACHE_SIZE})')
+
+    main_group.add_argument('--checkpoint',
+                            action='store_true',
+                            help='Save the .xlsx file after every processing stage (debugging, keeps the whole '
+                                 'workbook in memory: openpyxl writer only)')
+
     main_group.add_argument('-v', '--verbose',
                             action='count',
                             default=1,
@@ -53,24 +161,50 @@ def parse_args():
 
     args = parser.parse_args()
 
-    return args
-
-
-def cli_filename_handler(input_folder):
-    """
-    Input: path to folder containing .csv files and .txt files
-    Output:  dictionnary {filename : filedata}
-    """
-
-    input_folder = Path(input_folder)
-    input_csv_files = [f for f in glob.glob("*.csv", root_dir=f'{input_folder}{os.sep}')]
-    files_dict = {file: pd.read_csv(os.path.join(input_folder, file)) for file in input_csv_files}
-
-    settings_file = os.path.join(input_folder, 'Analysis_Settings.txt')
-    with open(settings_file) as file:
-        channels = core.get_channels_from_settings_file(file)
+    # thresholds are baked into the template formulas, custom values can only be written as computed values
+    # the long layout and the exported tables analysis are always written as values
+    values = args.output_mode == 'values' or args.layout == 'long' or 'xlsx' not in args.format
+    if (args.threshold is not None or args.bin_edges is not None) and not values:
+        parser.error('--threshold and --bin-edges require --output-mode values or --layout long')
+
+    # intermediate files are saved from the in-memory openpyxl workbook, which the streamed writers never build
+    if args.checkpoint and (args.processes > 1 or args.writer == 'xlsxwriter'):
+        parser.error('--checkpoint can not be used with --processes or --writer xlsxwriter')
+
+    if args.layout == 'long' and (args.processes > 1 or args.checkpoint):
+        parser.error('--processes and --checkpoint can only be used with --layout sheets')
+
+    if (args.append or args.watch) and (args.layout != 'sheets' or args.checkpoint or args.format != ['xlsx'] or
+                                        args.sweep):
+        parser.error('--append and --watch only write the .xlsx workbook with --layout sheets: they can not be used '
+                     'with --checkpoint, --format or --sweep')
+
+    if args.debounce < 0 or (args.idle_timeout is not None and args.idle_timeout <= 0):
+        parser.error('--debounce must be positive and --idle-timeout greater than 0')
+
+    if args.cache_size <= 0:
+        parser.error('--cache-size must be greater than 0')
+
+    try:
+        options.validate_formats([fmt for fmt in args.format if fmt != 'xlsx'])
+    except ImportError as error:
+        parser.error(str(error))
+
+    try:
+        options.validate_thresholds(args.analysis, args.threshold, args.bin_edges)
+        for threshold in args.sweep or []:
+            options.validate_positivity_threshold(threshold)
+    except ValueError as error:
+        parser.error(str(error))
+
+    # input files are read once every dependency is imported: check the folder first
+    if not os.path.isdir(args.input):
+        parser.error(f'input folder not found: {args.input}')
+    # watched folders may be empty until the macro starts writing them
+    if not args.watch and not os.path.isfile(os.path.join(args.input, 'Analysis_Settings.txt')):
+        parser.error(f'Analysis_Settings.txt not found in input folder: {args.input}')
 
-    return files_dict, channels
+    return args
 
 
 ########################
@@ -78,49 +212,86 @@ def cli_filename_handler(input_folder):
 ########################
 
 
-def cli_aura_data_processor(experiment_name, input_folder, output_folder, analysis_column):
+def cli_aura_data_processor(experiment_name, input_folder, output_folder, analysis_column, checkpoint=False, jobs=1,
+                            output_mode='formulas', positivity_threshold=None, bin_edges=None,
+                            sweep_thresholds=None, backend='openpyxl', processes=1, layout='sheets',
+                            formats=('xlsx',), cache_dir=None, cache_size=options.DEFAULT_CACHE_SIZE, append=False):
     # logging.info(f'input folder: {input_folder}')
+    import pandas as pd
+
+    import src.aura as aura
+    import src.analysis as analysis
+    import src.sweep as sweep
+    import src.export as export
+    import src.csv_cache as csv_cache
 
     logging.warning('##### PROCESS STARTED')
-    files_dict, channels = cli_filename_handler(input_folder)
-    files_attributes = core.build_files_attributes_dict(files_dict, channels_list=channels)
-
-    # Create output file
-    writer, filename = core.create_xlsx_file(experiment_name, output_folder=output_folder)
-
-    logging.warning('##### MERGING CHANNEL DATA')
-    sheets, data, file_channels, skipped = core.merge_image_channels(files_attributes=files_attributes, channels_dict=channels,
-                                                            writer=writer, file_name=filename)
-
-    logging.warning('##### DETERMINING TEMPLATES TO USE')
-    # Determine if we add co-positivity_analysis
-    n_channels = max([len(i) for i in file_channels.values()])
-    add_copositivity = True if 1 < n_channels < 6 else False
-    logging.warning(f'##### FOUND {n_channels} CHANNELS TO USE')
-
-    # get templates
-    summary_template, sheet_template = core.get_templates(n_channels=n_channels, analysis_type=analysis_column.lower())
-
-    logging.warning('##### PARSING')
-    analysis_end = parsing.main_parsing(writer=writer, filename=filename, sheets=sheets, file_channels=file_channels,
-                                        add_copositivity=add_copositivity, progress_bar=False,
-                                        sheet_template=sheet_template, summary_template=summary_template,
-                                        analysis_type=analysis_column)
-
-    ### COPOSITIVITE
-    if add_copositivity:
-        logging.warning('##### COMPUTING CO-POSITIVITY')
-        copositivity.parse_copositivity_template(writer=writer, filename=filename, sheets=sheets,
-                                                 file_channels=file_channels, analysis_end=analysis_end,
-                                                 progress_bar=True, template_file=sheet_template,
-                                                 analysis_type=analysis_column)
-
-        copositivity.parse_copositivity_summary(writer=writer, filename=filename, summary_template=summary_template,
-                                                n_channels=n_channels, file_channels=file_channels)
-
-    logging.warning('##### FORMATTING')
-    formatting.format_file(writer=writer, filename=filename, sheets=sheets, n_channels=len(channels),
-                           progress_bar=False)
+    cache = csv_cache.CsvCache(cache_dir, max_size=cache_size * 2**20) if cache_dir else None
+    experiment = aura.load_experiment(input_folder, jobs=jobs, cache=cache)
+
+    if 'xlsx' in formats:
+        filename = os.path.join(output_folder, f'{experiment_name}.xlsx')
+        samples = aura.iter_workbook(experiment, filename, analysis_type=analysis_column, output_mode=output_mode,
+                                     positivity_threshold=positivity_threshold, bin_edges=bin_edges,
+                                     layout=layout, backend=backend, processes=processes, checkpoint=checkpoint,
+                                     append=append)
+    else:
+        logging.warning('##### MERGING CHANNEL DATA')
+        samples = aura.iter_data(experiment, analysis_type=analysis_column)
+
+    # samples are processed one at a time: only the exported tables need the data of every sample at once
+    export_formats = [fmt for fmt in formats if fmt != 'xlsx']
+    data = {}
+    sweeps = []
+    for sample, df in samples:
+        if export_formats:
+            data[sample] = df
+
+        # samples are independent: the sweep of the experiment is the sweep of each sample, in order
+        if sweep_thresholds:
+            sweeps.append(sweep.compute_threshold_sweep({sample: df}, analysis_type=analysis_column,
+                                                        thresholds=sweep_thresholds, bin_edges=bin_edges))
+
+    if export_formats:
+        logging.warning('##### EXPORTING TABLES')
+        analysis_results = analysis.compute_analysis(data, analysis_type=analysis_column,
+                                                     positivity_threshold=positivity_threshold, bin_edges=bin_edges)
+        export.export_results(output_folder, experiment_name, data=data, analysis=analysis_results,
+                              formats=export_formats)
+
+    if sweep_thresholds:
+        logging.warning('##### COMPUTING THRESHOLD SWEEP')
+        threshold_sweep = pd.concat(sweeps, ignore_index=True)
+        threshold_sweep.to_csv(os.path.join(output_folder, f'{experiment_name}_threshold_sweep.csv'), index=False)
+
+    logging.warning('##### PROCESS COMPLETED')
+
+    return
+
+
+def cli_aura_folder_watcher(experiment_name, input_folder, output_folder, analysis_column, jobs=1,
+                            output_mode='formulas', positivity_threshold=None, bin_edges=None, processes=1,
+                            cache_dir=None, cache_size=options.DEFAULT_CACHE_SIZE, debounce=options.WATCH_DEBOUNCE,
+                            idle_timeout=None):
+    import src.aura as aura
+    import src.watch as watch
+    import src.csv_cache as csv_cache
+
+    logging.warning(f'##### WATCHING {input_folder}')
+    cache = csv_cache.CsvCache(cache_dir, max_size=cache_size * 2**20) if cache_dir else None
+    filename = os.path.join(output_folder, f'{experiment_name}.xlsx')
+    ready_files = watch.iter_ready_files(input_folder, debounce=debounce,
+                                         idle_timeout=None if idle_timeout is None else idle_timeout * 60)
+
+    # each batch of ready samples is appended to the workbook written so far
+    try:
+        for files_dict, channels in ready_files:
+            experiment = aura.build_experiment(files_dict, channels, jobs=jobs, cache=cache)
+            aura.write_workbook(experiment, filename, analysis_type=analysis_column, output_mode=output_mode,
+                                positivity_threshold=positivity_threshold, bin_edges=bin_edges, processes=processes,
+                                append=True)
+    except KeyboardInterrupt:
+        logging.warning('##### WATCH INTERRUPTED')
 
     logging.warning('##### PROCESS COMPLETED')
 
@@ -135,6 +306,22 @@ def wrapper_cli_aura_data_processor():
     analysis_type = args.analysis    # analysis type
     input_folder = args.input        # Folder containing input files
     output_folder = args.output      # Folder to store output files
+    checkpoint = args.checkpoint     # Save intermediate files
+    jobs = args.jobs                 # Threads used to read input files
+    output_mode = args.output_mode   # Analysis written as formulas or values
+    threshold = args.threshold       # Positivity threshold
+    bin_edges = args.bin_edges       # H-score bins edges
+    sweep_thresholds = args.sweep    # Positivity thresholds of the sensitivity analysis
+    backend = args.writer            # Library writing the .xlsx file
+    processes = args.processes       # Processes building the sample sheets
+    layout = args.layout             # One sheet per sample or long tables
+    formats = args.format            # Output files formats
+    cache_dir = args.cache           # Directory of the parsed input files cache
+    cache_size = args.cache_size     # Maximum size of the cache, in MB
+    append = args.append             # Only add new or changed samples to the previous workbook
+    watch = args.watch               # Process samples while the input folder is written
+    debounce = args.debounce         # Seconds without change before a watched file is read
+    idle_timeout = args.idle_timeout  # Minutes without change before watching stops
 
     # set verbosity & logging settings
     args.verbose = 40 - (10 * args.verbose) if args.verbose > 0 else 0
@@ -143,11 +330,23 @@ def wrapper_cli_aura_data_processor():
     # create the output folder if not found
     output_folder_path = Path(output_folder)
     if not output_folder_path.exists():
-        core.create_directory(output_folder_path)
+        os.makedirs(output_folder_path, exist_ok=True)
+
+    if watch:
+        cli_aura_folder_watcher(experiment_name=experiment_name, input_folder=input_folder,
+                                output_folder=output_folder, analysis_column=analysis_type, jobs=jobs,
+                                output_mode=output_mode, positivity_threshold=threshold, bin_edges=bin_edges,
+                                processes=processes, cache_dir=cache_dir, cache_size=cache_size, debounce=debounce,
+                                idle_timeout=idle_timeout)
+        return
 
     # main function processing files
     cli_aura_data_processor(experiment_name=experiment_name, input_folder=input_folder,
-                            output_folder=output_folder, analysis_column=analysis_type)
+                            output_folder=output_folder, analysis_column=analysis_type, checkpoint=checkpoint,
+                            jobs=jobs, output_mode=output_mode, positivity_threshold=threshold, bin_edges=bin_edges,
+                            sweep_thresholds=sweep_thresholds, backend=backend, processes=processes,
+                            layout=layout, formats=formats, cache_dir=cache_dir, cache_size=cache_size,
+                            append=append)
 
     return
 
@@ -1,5 +1,10 @@
 import streamlit as st
 import src.processing as processing
+import src.export as export
+
+
+# Names of the export formats shown in the app
+EXPORT_LABELS = {'parquet': 'Parquet', 'arrow': 'Arrow IPC', 'csv': 'CSV'}
 
 
 ##############################
@@ -81,6 +86,16 @@ def get_analysis_column():
         return None
 
 
+def get_export_formats():
+
+    # Parquet and Arrow are only offered when pyarrow is installed
+    formats = st.multiselect("**Also export :blue[tables] as:**", export.get_available_formats(),
+                             format_func=lambda fmt: EXPORT_LABELS[fmt],
+                             help='Merged data and analysis tables, downloaded in a .zip folder with the .xlsx file')
+
+    return formats
+
+
 def get_uploaded_files(input_format):
     """ Configure file_uploader based on user-defined input format """
 
@@ -117,6 +132,9 @@ def aura_data_processor():
     # Analysis column
     analysis_col = get_analysis_column()
 
+    # Exported tables
+    export_formats = get_export_formats()
+
     # Retrieve user input configuration
     input_format = get_input_configuration()
 
@@ -133,7 +151,8 @@ def aura_data_processor():
 
         if process:
             st.subheader('Progress', anchor=False)
-            processing.process_aura_files(experiment_name, input_format, uploaded_files, analysis_col)
+            processing.process_aura_files(experiment_name, input_format, uploaded_files, analysis_col,
+                                          export_formats=export_formats)
 
     return
 
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+# thresholds settings are defined with the options, which the CLI validates without importing numpy
+from src.options import (POSITIVE, DEFAULT_POSITIVITY_THRESHOLDS, DEFAULT_BIN_EDGES,  # noqa: F401
+                         validate_positivity_threshold, validate_thresholds)
+
+
+def get_bin_edges(analysis_type, positivity_threshold=None, bin_edges=None) -> tuple:
+    """ Edges used to bin cells: positivity threshold, followed by the H-score bin edges for the Count analysis """
+
+    threshold = DEFAULT_POSITIVITY_THRESHOLDS[analysis_type] if positivity_threshold is None else positivity_threshold
+
+    if analysis_type == 'Count':
+        return (threshold,) + tuple(DEFAULT_BIN_EDGES if bin_edges is None else bin_edges)
+    return (threshold,)
+
+
+def format_edge(value) -> str:
+    return f'{value:g}'
+
+
+def get_bin_labels(edges, analysis_type='Count') -> list[str]:
+    """
+    Labels of the bins delimited by the edges, e.g. (1, 4, 10, 16) -> 0 | 1-3 | 4-9 | 10-15 | >15
+    Dots are counted, so integer edges are labelled by the last count of the bin. Areas are continuous: (3,) -> <3 | >=3
+    """
+
+    integers = analysis_type == 'Count' and all(float(edge).is_integer() for edge in edges)
+
+    if edges[0] == POSITIVE or (edges[0] == 1 and integers):
+        labels = ['0']
+    else:
+        labels = [f'<{format_edge(edges[0])}']
+
+    for low, high in zip(edges[:-1], edges[1:]):
+        labels.append(f'{format_edge(low)}-{format_edge(high - 1)}' if integers else
+                      f'{format_edge(low)}-<{format_edge(high)}')
+
+    if edges[-1] == POSITIVE:
+        labels.append('>0')
+    elif integers:
+        labels.append(f'>{format_edge(edges[-1] - 1)}')
+    else:
+        labels.append(f'>={format_edge(edges[-1])}')
+
+    return labels
+
+
+########################
+#   SEGMENTED ARRAYS   #
+########################
+
+
+def concatenate_channels(data) -> tuple[np.ndarray, np.ndarray, list[tuple[str, str]]]:
+    """
+    Input: {sample : dataframe} dictionary as returned by core.merge_image_channels (one column per channel)
+    Output: every channel of every sample concatenated in a single array, the segments offsets and their keys
+    """
+
+    keys = [(sample, channel) for sample, df in data.items() for channel in df.columns]
+    columns = [data[sample][channel].to_numpy(dtype=np.float64) for sample, channel in keys]
+
+    values = np.concatenate(columns) if columns else np.empty(0)
+    offsets = np.cumsum([0] + [len(column) for column in columns])
+
+    return values, offsets, keys
+
+
+def count_bins(values, offsets, edges) -> np.ndarray:
+    """ Returns a (segments x bins) array with the number of cells of each segment falling in each bin
+        Bins are [-inf, edges[0]), [edges[0], edges[1]), ..., [edges[-1], +inf) """
+
+    n_segments = len(offsets) - 1
+    n_bins = len(edges) + 1
+
+    # empty cells (NaN) go to an extra bin, dropped afterwards
+    bins = np.digitize(values, edges)
+    bins[np.isnan(values)] = n_bins
+
+    segment_index = np.repeat(np.arange(n_segments), np.diff(offsets))
+    counts = np.bincount(segment_index * (n_bins + 1) + bins, minlength=n_segments * (n_bins + 1))
+
+    return counts.reshape(n_segments, n_bins + 1)[:, :n_bins]
+
+
+def sum_positive(values, offsets, threshold) -> np.ndarray:
+    """ Returns the sum of the values >= threshold of each segment """
+
+    n_segments = len(offsets) - 1
+    segment_index = np.repeat(np.arange(n_segments), np.diff(offsets))
+
+    with np.errstate(invalid='ignore'):
+        weights = np.where(values >= threshold, values, 0)
+
+    return np.bincount(segment_index, weights=weights, minlength=n_segments)
+
+
+#######################
+#       ANALYSIS      #
+#######################
+
+
+def divide(numerator, denominator):
+    """ Element-wise division returning NaN instead of dividing by 0 (#DIV/0! in the spreadsheet) """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def compute_count_analysis(values, offsets, edges):
+    counts = count_bins(values, offsets, edges)
+    total = counts.sum(axis=1)
+
+    analysis = pd.DataFrame(counts, columns=get_bin_labels(edges, 'Count'))
+    analysis['Total'] = total
+    analysis['% Positive Cells'] = divide(counts[:, 1:].sum(axis=1), total) * 100
+    analysis['H-Score'] = divide(counts @ np.arange(counts.shape[1]), total) * 100
+    analysis['Avg Dots/Cell'] = divide(sum_positive(values, offsets, POSITIVE), total)
+    return analysis
+
+
+def compute_area_analysis(values, offsets, edges):
+    counts = count_bins(values, offsets, edges)
+    total = counts.sum(axis=1)
+
+    analysis = pd.DataFrame(counts, columns=get_bin_labels(edges, 'Area'))
+    analysis['Total'] = total
+    analysis['% Positive Cells'] = divide(counts[:, 1], total) * 100
+    analysis['Total Area'] = sum_positive(values, offsets, edges[0])
+    analysis['Avg Area/Cell'] = divide(analysis['Total Area'].to_numpy(), total)
+    return analysis
+
+
+def compute_analysis(data, analysis_type, positivity_threshold=None, bin_edges=None) -> pd.DataFrame:
+    """
+    Computes the statistics of the sheets analysis part (cells per bin, % positive cells, H-score, ...)
+    for every sample and channel in a single vectorized pass.
+
+    Output: one row per sample x channel, in the same order as the channels of each sample sheet.
+    Bins columns are named after the bins labels.
+    """
+
+    validate_thresholds(analysis_type, positivity_threshold, bin_edges)
+    edges = get_bin_edges(analysis_type, positivity_threshold, bin_edges)
+    values, offsets, keys = concatenate_channels(data)
+
+    if analysis_type == 'Count':
+        analysis = compute_count_analysis(values, offsets, edges)
+    else:
+        analysis = compute_area_analysis(values, offsets, edges)
+
+    analysis.insert(0, 'Sample', [sample for sample, _ in keys])
+    analysis.insert(1, 'Channel', [channel for _, channel in keys])
+
+    return analysis
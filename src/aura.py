@@ -0,0 +1,346 @@
+import os
+import glob
+import logging
+from functools import partial
+from pathlib import Path
+from typing import IO, Iterator
+from zipfile import ZipFile
+
+import pandas as pd
+
+import src.core as core
+import src.analysis as analysis
+import src.parsing as parsing
+import src.formatting as formatting
+import src.copositivity as copositivity
+import src.parallel as parallel
+import src.incremental as incremental
+import src.compact as compact
+import src.options as options
+import src.csv_cache as csv_cache
+
+
+#######################
+#        INPUT        #
+#######################
+
+
+class Experiment:
+    """
+    AURA tables of an experiment grouped by sample, and the channels of its Analysis_Settings.txt file.
+    Tables of a folder are only indexed (file paths), they are read one sample at a time while processing.
+    """
+
+    __slots__ = ('files_attributes', 'channels', 'jobs')
+
+    def __init__(self, files_attributes, channels, jobs=1):
+        self.files_attributes = files_attributes    # {sample : {channel : filedata or file path}}
+        self.channels = channels                    # {stain name : 'Channel n (Cn)'}
+        self.jobs = jobs                            # threads reading the files of the next samples
+
+    @property
+    def samples(self) -> list[str]:
+        return list(self.files_attributes)
+
+
+def is_settings_file(name) -> bool:
+    return name.startswith('Analysis_Settings') and name.endswith('.txt')
+
+
+def index_folder(input_folder) -> tuple[dict[str, str], dict[str, str]]:
+    """
+    Input: path to folder containing .csv files and the Analysis_Settings.txt file
+    Output: {filename : file path} dictionary, files are read later, and the settings channels
+    """
+
+    input_folder = Path(input_folder)
+    input_csv_files = sorted(glob.glob("*.csv", root_dir=f'{input_folder}{os.sep}'))
+    files_dict = {file: os.path.join(input_folder, file) for file in input_csv_files}
+
+    settings_file = os.path.join(input_folder, 'Analysis_Settings.txt')
+    with open(settings_file) as file:
+        channels = core.get_channels_from_settings_file(file)
+
+    return files_dict, channels
+
+
+def index_zip(input_file: [str | IO[bytes]]) -> tuple[dict[str, core.ZipMember], dict[str, str]]:
+    """
+    Input: path or bytes-like .zip file containing .csv files and the Analysis_Settings.txt file
+    Output: {member path : archive member} dictionary, sorted by file name, and the settings channels. Members are
+    listed from the central directory of the archive, only the settings file is decompressed: .csv files are read
+    later.
+    Raises a ValueError if the archive has no settings file.
+    """
+
+    is_path = isinstance(input_file, (str, os.PathLike))
+    zip_file = core.open_zip_file(os.fspath(input_file)) if is_path else ZipFile(input_file)
+
+    members = []
+    for file in zip_file.namelist():
+        if file.startswith('.') or file.startswith('_') or file.endswith('/'):
+            continue
+        members.append((file, Path(file).name))
+
+    # channels are known before any .csv file is listed, files of unknown channels are never decompressed
+    settings_files = [file for file, name in members if is_settings_file(name)]
+    if not settings_files:
+        raise ValueError('No Analysis_Settings.txt file found in the .zip file')
+    with zip_file.open(settings_files[-1]) as settings_file:
+        channels = core.get_channels_from_settings_file(settings_file)
+
+    # archives opened from a path are reopened by each process reading its members
+    # members are keyed by their path: files with the same name in several folders are reported as duplicates
+    archive = os.fspath(input_file) if is_path else zip_file
+    files_dict = {file: core.ZipMember(archive, file)
+                  for file, name in sorted(members, key=lambda member: (member[1], member[0])) if name.endswith('.csv')}
+
+    return files_dict, channels
+
+
+def read_files(input_files) -> tuple[dict[str, pd.DataFrame], dict[str, str]]:
+    """
+    Input: named file objects (.csv files and the Analysis_Settings.txt file), e.g. uploaded files
+    Output: {filename : filedata} dictionary, with every analysed column of the files, and the settings channels
+    """
+
+    files_dict = {}
+    channels = []
+
+    for file in input_files:
+
+        if file.name.endswith('.csv'):
+            files_dict[file.name] = core.read_aura_csv(file)
+
+        if is_settings_file(file.name):
+            channels = core.get_channels_from_settings_file(file)
+
+    return files_dict, channels
+
+
+def load_experiment(source, jobs=1, cache=None, on_error=None, progress=None) -> Experiment:
+    """
+    Loads the AURA tables of an experiment from a folder, a .zip file (path or file object) or a list of named
+    file objects. Tables of a folder or a .zip file are read while processing, jobs threads reading the next
+    samples ahead. With a cache (see csv_cache.CsvCache), only the tables not parsed yet are parsed.
+    Unknown and duplicated channels are reported to on_error(message), or logged.
+    Raises a ValueError if no .csv file of the settings channels is found.
+    """
+
+    if isinstance(source, (list, tuple)):
+        files_dict, channels = read_files(source)
+    elif isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+        files_dict, channels = index_folder(source)
+    else:
+        files_dict, channels = index_zip(source)
+
+    return build_experiment(files_dict, channels, jobs=jobs, cache=cache, on_error=on_error, progress=progress)
+
+
+def build_experiment(files_dict, channels, jobs=1, cache=None, on_error=None, progress=None) -> Experiment:
+    """
+    Experiment of the {filename : filedata or file} dictionary and the settings channels (see load_experiment).
+    Raises a ValueError if no .csv file of the settings channels is found.
+    """
+
+    if not files_dict:
+        raise ValueError('No .csv file found in the input files')
+
+    if cache is not None:
+        files_dict = {name: csv_cache.CachedFile(file, cache) if not isinstance(file, pd.DataFrame) else file
+                      for name, file in files_dict.items()}
+
+    files_attributes = core.build_files_attributes_dict(files_dict, channels_list=channels, on_error=on_error,
+                                                        progress=progress)
+    if not files_attributes:
+        raise ValueError('No .csv file matches the channels of the settings file')
+
+    return Experiment(files_attributes, channels, jobs=jobs)
+
+
+#######################
+#       ANALYSIS      #
+#######################
+
+
+def iter_samples(experiment, analysis_type=None) -> Iterator[tuple[str, dict[str, pd.DataFrame]]]:
+    """
+    Yields the {channel : filedata} tables of each sample, in the samples order, with the column of the analysis_type
+    analysis (see core.read_sample_files).
+    The next experiment.jobs samples are read in background threads while the current one is processed.
+    """
+
+    yield from core.iter_sample_files(experiment.files_attributes, jobs=experiment.jobs, column_name=analysis_type)
+
+
+def iter_data(experiment, analysis_type) -> Iterator[tuple[str, pd.DataFrame]]:
+    """ Yields the merged data of each sample: the analysed column of every channel, one row per cell """
+    for sample, channels_per_image in iter_samples(experiment, analysis_type=analysis_type):
+        yield sample, core.merge_sample_channels(channels_per_image, channels_dict=experiment.channels,
+                                                 column_name=analysis_type)
+
+
+def merge(experiment, analysis_type) -> dict[str, pd.DataFrame]:
+    """ {sample : dataframe} of the analysed column of every channel, one row per cell """
+    return dict(iter_data(experiment, analysis_type))
+
+
+def analyze(experiment, analysis_type, positivity_threshold=None, bin_edges=None) -> pd.DataFrame:
+    """ Analysis of every sample x channel (see analysis.compute_analysis) """
+    return analysis.compute_analysis(merge(experiment, analysis_type), analysis_type=analysis_type,
+                                     positivity_threshold=positivity_threshold, bin_edges=bin_edges)
+
+
+#######################
+#       WORKBOOK      #
+#######################
+
+
+def write_sheets(experiment, filename, analysis_type, output_mode='formulas', positivity_threshold=None,
+                 bin_edges=None, checkpoint=False, progress=None) -> tuple[dict, list]:
+    """ Runs every processing stage on an openpyxl workbook with one sheet per sample, kept in memory until saved """
+
+    channels = experiment.channels
+    writer = core.open_xlsx_writer(filename)
+
+    logging.warning('##### MERGING CHANNEL DATA')
+    sheets, data, file_channels, skipped = core.merge_image_channels(files_attributes=experiment.files_attributes,
+                                                                     channels_dict=channels, writer=writer,
+                                                                     file_name=filename, progress=progress,
+                                                                     column_name=analysis_type,
+                                                                     checkpoint=checkpoint, jobs=experiment.jobs)
+
+    logging.warning('##### DETERMINING TEMPLATES TO USE')
+    # Determine if we add co-positivity_analysis
+    n_channels = max([len(i) for i in file_channels.values()])
+    add_copositivity = copositivity.has_copositivity(n_channels)
+    logging.warning(f'##### FOUND {n_channels} CHANNELS TO USE')
+    if n_channels > copositivity.MAX_COPOSITIVITY_CHANNELS:
+        logging.warning(f'##### CO-POSITIVITY SKIPPED: MORE THAN {copositivity.MAX_COPOSITIVITY_CHANNELS} CHANNELS')
+
+    # get templates
+    summary_template, sheet_template = core.get_templates(n_channels=n_channels, analysis_type=analysis_type.lower())
+    copositivity_summary_template, copositivity_sheet_template = core.get_copositivity_templates(
+        analysis_type=analysis_type.lower())
+
+    logging.warning('##### PARSING')
+    # Analysis computed natively, written as values instead of formulas
+    analysis_results = None
+    if output_mode == 'values':
+        analysis_results = analysis.compute_analysis(data, analysis_type=analysis_type,
+                                                     positivity_threshold=positivity_threshold, bin_edges=bin_edges)
+
+    analysis_end = parsing.main_parsing(writer=writer, filename=filename, sheets=sheets, file_channels=file_channels,
+                                        add_copositivity=add_copositivity, progress=progress,
+                                        sheet_template=sheet_template, summary_template=summary_template,
+                                        analysis_type=analysis_type, analysis=analysis_results,
+                                        checkpoint=checkpoint)
+
+    ### COPOSITIVITE
+    if add_copositivity:
+        logging.warning('##### COMPUTING CO-POSITIVITY')
+        copositivity.parse_copositivity_template(writer=writer, filename=filename, sheets=sheets,
+                                                 file_channels=file_channels, data=data, analysis_end=analysis_end,
+                                                 progress=progress, template_file=copositivity_sheet_template,
+                                                 positivity_threshold=positivity_threshold, output_mode=output_mode,
+                                                 analysis_type=analysis_type, checkpoint=checkpoint)
+
+        copositivity.parse_copositivity_summary(writer=writer, filename=filename,
+                                                summary_template=copositivity_summary_template,
+                                                n_channels=n_channels, file_channels=file_channels,
+                                                analysis_type=analysis_type,
+                                                checkpoint=checkpoint)
+
+    logging.warning('##### FORMATTING')
+    formatting.format_file(writer=writer, filename=filename, sheets=sheets, n_channels=len(channels),
+                           progress=progress)
+
+    logging.warning('##### SAVING')
+    core.save_xlsx_file(writer)
+
+    return data, skipped
+
+
+def iter_workbook(experiment, filename, analysis_type, output_mode='formulas', positivity_threshold=None,
+                  bin_edges=None, layout='sheets', backend='openpyxl', processes=1, checkpoint=False, append=False,
+                  progress=None) -> Iterator[tuple[str, pd.DataFrame]]:
+    """
+    Writes the .xlsx file of an experiment, yielding the merged data (sample, dataframe) of each sample once written.
+    The long layout and the XlsxWriter backend process one sample end-to-end at a time (read, merge, analyze,
+    write): memory is bounded by the largest sample as long as the consumer does not keep the yielded data.
+    The openpyxl backend builds the whole workbook in memory before saving it, checkpoint (saving the workbook after
+    every processing stage) is only available with it.
+    With append, only the samples new or changed since the previous run are written (see incremental.stream_workbook)
+    and yielded. Appended workbooks are always streamed with XlsxWriter, whatever the backend.
+    Progress of each stage is reported to progress(fraction, text), text starting with the stage name.
+    """
+
+    # thresholds are baked into the template formulas, custom values can only be written as computed values
+    if (positivity_threshold is not None or bin_edges is not None) and output_mode != 'values' and layout != 'long':
+        raise ValueError("Custom thresholds require output_mode='values' or layout='long'")
+    analysis.validate_thresholds(analysis_type, positivity_threshold, bin_edges)
+
+    if layout not in options.LAYOUTS:
+        raise ValueError(f'Unknown layout: {layout} (expected: {", ".join(options.LAYOUTS)})')
+
+    if checkpoint and (backend != 'openpyxl' or processes > 1):
+        raise ValueError("checkpoint saves the whole openpyxl workbook: it can not be used with "
+                         "backend='xlsxwriter' or processes > 1")
+
+    if append and (layout != 'sheets' or checkpoint):
+        raise ValueError("Samples can only be appended to a workbook with layout='sheets', without checkpoint")
+
+    if append:
+        logging.warning('##### APPENDING SAMPLES')
+        yield from incremental.stream_workbook(filename, files_attributes=experiment.files_attributes,
+                                               channels_dict=experiment.channels, analysis_type=analysis_type,
+                                               processes=processes, jobs=experiment.jobs, output_mode=output_mode,
+                                               positivity_threshold=positivity_threshold, bin_edges=bin_edges,
+                                               progress=progress)
+        return
+
+    if layout == 'long':
+        logging.warning('##### WRITING SAMPLES')
+        samples_channels = experiment.files_attributes.values()
+        channels = [channel for channel in experiment.channels
+                    if any(channel in channels_per_image for channels_per_image in samples_channels)]
+        yield from compact.stream_workbook(filename, iter_data(experiment, analysis_type), channels=channels,
+                                           analyze=partial(analysis.compute_analysis, analysis_type=analysis_type,
+                                                           positivity_threshold=positivity_threshold,
+                                                           bin_edges=bin_edges))
+        return
+
+    if processes > 1 or backend == 'xlsxwriter':
+        if processes > 1:
+            logging.warning(f'##### BUILDING SHEETS IN {processes} PROCESSES')
+        else:
+            logging.warning('##### BUILDING SHEETS')
+        yield from parallel.stream_workbook(filename, files_attributes=experiment.files_attributes,
+                                            channels_dict=experiment.channels, analysis_type=analysis_type,
+                                            processes=processes, jobs=experiment.jobs, output_mode=output_mode,
+                                            positivity_threshold=positivity_threshold, bin_edges=bin_edges,
+                                            progress=progress)
+        return
+
+    data, _ = write_sheets(experiment, filename, analysis_type, output_mode=output_mode,
+                           positivity_threshold=positivity_threshold, bin_edges=bin_edges, checkpoint=checkpoint,
+                           progress=progress)
+    yield from data.items()
+
+
+def write_workbook(experiment, filename, analysis_type, output_mode='formulas', positivity_threshold=None,
+                   bin_edges=None, layout='sheets', backend='openpyxl', processes=1, checkpoint=False, append=False,
+                   progress=None) -> tuple[dict, list]:
+    """
+    Writes the .xlsx file of an experiment (see iter_workbook).
+
+    Output: merged data {sample : dataframe} and the samples with missing channels
+    """
+
+    data = dict(iter_workbook(experiment, filename, analysis_type, output_mode=output_mode,
+                              positivity_threshold=positivity_threshold, bin_edges=bin_edges, layout=layout,
+                              backend=backend, processes=processes, checkpoint=checkpoint, append=append,
+                              progress=progress))
+    skipped = [sample for sample, df in data.items() if core.has_missing_channels(df.columns, experiment.channels)]
+
+    return data, skipped
@@ -0,0 +1,276 @@
+import os
+import re
+import glob
+import gzip
+import json
+import logging
+import hashlib
+from bisect import bisect_right
+from functools import cache, lru_cache
+
+import openpyxl
+from openpyxl.styles import Font, Border, Alignment, Protection
+from openpyxl.styles.fills import Fill
+from openpyxl.styles.differential import DifferentialStyle
+from openpyxl.formatting.formatting import ConditionalFormattingList
+from openpyxl.formatting.rule import Rule
+from openpyxl.worksheet.formula import ArrayFormula
+from openpyxl.xml.functions import tostring, fromstring
+
+
+#######################
+#       SETTINGS      #
+#######################
+
+# Templates are referenced by their path relative to src/, e.g. templates/count/template_sheet_count.xlsx
+SRC_FOLDER = os.path.dirname(__file__)
+TEMPLATES_PATTERN = os.path.join('templates', '*', 'template_*.xlsx')
+BUNDLE_FILE = os.path.join(SRC_FOLDER, 'templates', 'bundle.json.gz')
+BUNDLE_VERSION = 2
+
+# Style parts shared by all the templates of the bundle, serialized as their xlsx XML
+STYLE_PARTS = {'fonts': Font, 'fills': Fill, 'borders': Border, 'alignments': Alignment, 'protections': Protection}
+
+# Row number of the cell in formulas is replaced by a placeholder, so that rows repeating a formula share one pattern
+ROW_PLACEHOLDER = '{row}'
+CELL_REFERENCE = re.compile(r'(?<![A-Za-z0-9_])(\$?[A-Z]{1,3}\$?)(\d+)(?![\d(])')
+
+# Parsed templates kept in memory, from the bundle or the .xlsx files (see parsing.read_template): sheet and summary
+# templates with their co-positivity patterns, for both analyses
+TEMPLATE_CACHE_SIZE = 8
+
+
+#######################
+#       COMPILE       #
+#######################
+
+
+def get_file_hash(path) -> str:
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def to_pattern(formula: str, row: int) -> str:
+    """ Replaces the references to the cell row by the row placeholder, e.g. =B5/B10*100 in row 5 -> =B{row}/B10*100 """
+
+    if ROW_PLACEHOLDER in formula:
+        raise ValueError(f'Formula can not be compiled: {formula}')
+
+    return CELL_REFERENCE.sub(lambda match: match.group(1) + ROW_PLACEHOLDER if int(match.group(2)) == row else
+                              match.group(0), formula)
+
+
+def encode_value(value, row):
+    """ Cell value to JSON: formulas are stored as row patterns, array formulas as a [ref, text] list """
+
+    if isinstance(value, ArrayFormula):
+        return [to_pattern(value.ref, row), to_pattern(value.text, row)]
+    if isinstance(value, str) and value.startswith('='):
+        return to_pattern(value, row)
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    raise ValueError(f'Cell value can not be compiled: {value!r}')
+
+
+def encode_style(cell, tables, styles, workbook_styles) -> int | None:
+    """ Index of the cell style in the bundle styles, each style being a list of indexes in the style parts tables """
+
+    if not cell.has_style:
+        return None
+
+    # cells of the same workbook with identical styles share the same style array
+    key = tuple(cell._style)
+    if key in workbook_styles:
+        return workbook_styles[key]
+
+    style = []
+    for part, value in zip(STYLE_PARTS, (cell.font, cell.fill, cell.border, cell.alignment, cell.protection)):
+        xml = tostring(value.to_tree()).decode()
+        style.append(tables[part].setdefault(xml, len(tables[part])))
+    style.append(cell.number_format)
+
+    workbook_styles[key] = styles.setdefault(tuple(style), len(styles))
+    return workbook_styles[key]
+
+
+def compile_template(template_ws, tables, styles) -> dict:
+    """ Run-length encodes each column of a template sheet: [first row, last row, value pattern, style] runs """
+
+    columns = {}
+    workbook_styles = {}
+    for col in range(1, template_ws.max_column + 1):
+        runs = []
+        for row in range(1, template_ws.max_row + 1):
+            cell = template_ws._cells.get((row, col))
+            if cell is None or (cell.value is None and not cell.has_style):
+                continue
+
+            value, style = encode_value(cell.value, row), encode_style(cell, tables, styles, workbook_styles)
+            if runs and runs[-1][1] == row - 1 and runs[-1][2:] == [value, style]:
+                runs[-1][1] = row
+            else:
+                runs.append([row, row, value, style])
+
+        if runs:
+            columns[col] = runs
+
+    return {'max_row': template_ws.max_row, 'max_column': template_ws.max_column, 'columns': columns,
+            'conditional_formats': compile_conditional_formats(template_ws)}
+
+
+def compile_conditional_formats(template_ws) -> list:
+    """ Conditional formats of a template sheet: [range, [[rule XML, differential style XML or None], ...]] """
+
+    conditional_formats = []
+    for conditional_format in template_ws.conditional_formatting:
+        rules = [[tostring(rule.to_tree()).decode(),
+                  None if rule.dxf is None else tostring(rule.dxf.to_tree()).decode()]
+                 for rule in conditional_format.rules]
+        conditional_formats.append([str(conditional_format.sqref), rules])
+    return conditional_formats
+
+
+def build_bundle(bundle_file=BUNDLE_FILE) -> None:
+    """ Compiles every .xlsx template into a single bundle file """
+
+    tables = {part: {} for part in STYLE_PARTS}
+    styles = {}
+    templates = {}
+
+    for template in sorted(glob.glob(TEMPLATES_PATTERN, root_dir=SRC_FOLDER)):
+        template_path = os.path.join(SRC_FOLDER, template)
+        template_ws = openpyxl.load_workbook(template_path).worksheets[0]
+
+        spec = compile_template(template_ws, tables, styles)
+        spec['sha1'] = get_file_hash(template_path)
+        templates[template.replace(os.sep, '/')] = spec
+
+        logging.warning(f'##### COMPILED TEMPLATE: {template}')
+
+    bundle = {'version': BUNDLE_VERSION, 'templates': templates, 'styles': list(styles)}
+    bundle.update({part: list(table) for part, table in tables.items()})
+
+    # no timestamp in the archive: rebuilding unchanged templates gives the same file
+    with open(bundle_file, 'wb') as file:
+        file.write(gzip.compress(json.dumps(bundle, separators=(',', ':')).encode('utf-8'), mtime=0))
+
+    logging.warning(f'##### TEMPLATE BUNDLE WRITTEN: {bundle_file}')
+
+
+#######################
+#        LOAD         #
+#######################
+
+
+class TemplateStyle:
+    __slots__ = ('font', 'fill', 'border', 'alignment', 'protection', 'number_format')
+
+    def __init__(self, font, fill, border, alignment, protection, number_format):
+        self.font = font
+        self.fill = fill
+        self.border = border
+        self.alignment = alignment
+        self.protection = protection
+        self.number_format = number_format
+
+
+class TemplateCell:
+    """ Read-only template cell, with the attributes used by parsing.copy_cells """
+
+    __slots__ = ('value', 'style')
+
+    def __init__(self, value=None, style=None):
+        self.value = value
+        self.style = style
+
+    @property
+    def has_style(self):
+        return self.style is not None
+
+    def __getattr__(self, name):
+        return getattr(self.style, name)
+
+
+class TemplateSheet:
+    """ Template sheet rebuilt from a bundle, exposing the cell() method and the conditional formatting of openpyxl
+        worksheets """
+
+    def __init__(self, spec, styles):
+        self.max_row = spec['max_row']
+        self.max_column = spec['max_column']
+        self.styles = styles
+
+        self.conditional_formatting = ConditionalFormattingList()
+        for cell_range, rules in spec['conditional_formats']:
+            for rule_xml, dxf_xml in rules:
+                rule = Rule.from_tree(fromstring(rule_xml))
+                rule.dxf = None if dxf_xml is None else DifferentialStyle.from_tree(fromstring(dxf_xml))
+                self.conditional_formatting.add(cell_range, rule)
+
+        self.columns = {}
+        for col, runs in spec['columns'].items():
+            self.columns[int(col)] = ([run[0] for run in runs], runs)
+
+    def cell(self, row, column):
+        starts, runs = self.columns.get(column, ((), ()))
+
+        i = bisect_right(starts, row) - 1
+        if i < 0 or runs[i][1] < row:
+            return TemplateCell()
+
+        _, _, value, style = runs[i]
+        return TemplateCell(decode_value(value, row), None if style is None else self.styles[style])
+
+
+def decode_value(value, row):
+    if isinstance(value, list):
+        ref, text = value
+        return ArrayFormula(ref.replace(ROW_PLACEHOLDER, str(row)), text.replace(ROW_PLACEHOLDER, str(row)))
+    if isinstance(value, str) and value.startswith('='):
+        return value.replace(ROW_PLACEHOLDER, str(row))
+    return value
+
+
+@cache
+def load_bundle(bundle_file=BUNDLE_FILE) -> tuple[dict, list] | None:
+    """ Loads the bundle templates and builds the shared styles, None if no bundle was built """
+
+    if not os.path.exists(bundle_file):
+        return None
+
+    with gzip.open(bundle_file, 'rt', encoding='utf-8') as file:
+        bundle = json.load(file)
+
+    if bundle.get('version') != BUNDLE_VERSION:
+        logging.warning('##### TEMPLATE BUNDLE VERSION MISMATCH, REBUILD IT WITH: python -m src.bundles')
+        return None
+
+    tables = {part: [cls.from_tree(fromstring(xml)) for xml in bundle[part]] for part, cls in STYLE_PARTS.items()}
+    styles = [TemplateStyle(*(tables[part][index] for part, index in zip(STYLE_PARTS, style[:-1])), style[-1])
+              for style in bundle['styles']]
+
+    return bundle['templates'], styles
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def read_template(template: str, mtime: float) -> TemplateSheet | None:
+    """ Template sheet from the bundle, None if the template is not bundled or was edited since the bundle was built """
+
+    bundle = load_bundle()
+    if bundle is None:
+        return None
+
+    templates, styles = bundle
+    spec = templates.get(template.replace(os.sep, '/'))
+    if spec is None:
+        return None
+
+    if spec['sha1'] != get_file_hash(os.path.join(SRC_FOLDER, template)):
+        logging.warning(f'##### TEMPLATE BUNDLE OUTDATED FOR {template}, REBUILD IT WITH: python -m src.bundles')
+        return None
+
+    return TemplateSheet(spec, styles)
+
+
+if __name__ == '__main__':
+    build_bundle()
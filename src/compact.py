@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+
+#######################
+#       SETTINGS      #
+#######################
+
+# Rows of an .xlsx sheet, header included: longer tables continue on 'data (2)', 'data (3)', ...
+MAX_SHEET_ROWS = 1048576
+
+HEADER_FORMAT = {'bold': True, 'bottom': 1, 'align': 'center', 'valign': 'vcenter', 'text_wrap': True}
+DECIMAL_FORMAT = {'num_format': '0.00'}
+
+SAMPLE_COLUMN_WIDTH = 40
+COLUMN_WIDTH = 14
+
+
+#######################
+#        TABLES       #
+#######################
+
+
+def get_long_data(data) -> pd.DataFrame:
+    """
+    Input: {sample : dataframe} dictionary as returned by core.merge_image_channels
+    Output: one row per cell, with its sample, its number in the sample and its channels values
+    """
+
+    frames = list(data.values())
+    long_data = pd.concat(frames, ignore_index=True)
+
+    long_data.insert(0, 'Sample', np.repeat(list(data), [len(df) for df in frames]))
+    long_data.insert(1, 'Cell', np.concatenate([np.arange(1, len(df) + 1) for df in frames]))
+    return long_data
+
+
+class TableWriter:
+    """
+    Writes a table chunk by chunk, header first, on as many sheets as needed ('name', 'name (2)', ...).
+    Columns are the ones of the first chunk unless given, missing values are left empty.
+    """
+
+    def __init__(self, workbook, sheet_name, formats, columns=None, decimals=False):
+        self.workbook = workbook
+        self.sheet_name = sheet_name
+        self.formats = formats
+        self.columns = columns
+        self.decimals = decimals
+        self.decimal_columns = set()
+
+        # the first sheet is added right away to keep the sheets order, it is filled by the first chunk
+        self.sheets = [workbook.add_worksheet(sheet_name)]
+        self.row = None
+
+    def start_sheet(self, ws):
+        # column formats are set before any row is written (rows are flushed to disk in constant memory mode)
+        for col, column in enumerate(self.columns):
+            width = SAMPLE_COLUMN_WIDTH if column == 'Sample' else COLUMN_WIDTH
+            ws.set_column(col, col, width, self.formats['decimal'] if column in self.decimal_columns else None)
+
+        ws.write_row(0, 0, [str(column) for column in self.columns], self.formats['header'])
+        ws.freeze_panes(1, 0)
+        self.row = 1
+
+    def end_sheet(self):
+        self.sheets[-1].autofilter(0, 0, self.row - 1, len(self.columns) - 1)
+
+    def write(self, chunk: pd.DataFrame):
+        if self.row is None:
+            self.columns = list(chunk.columns) if self.columns is None else self.columns
+            if self.decimals:
+                self.decimal_columns = {column for column in self.columns
+                                        if column in chunk and pd.api.types.is_float_dtype(chunk[column])}
+            self.start_sheet(self.sheets[0])
+
+        chunk = chunk.reindex(columns=self.columns)
+        values = chunk.astype(object).where(chunk.notna(), None)
+        for row_values in values.itertuples(index=False, name=None):
+            if self.row == MAX_SHEET_ROWS:
+                self.end_sheet()
+                self.sheets.append(self.workbook.add_worksheet(f'{self.sheet_name} ({len(self.sheets) + 1})'))
+                self.start_sheet(self.sheets[-1])
+            self.sheets[-1].write_row(self.row, 0, row_values)
+            self.row += 1
+
+    def close(self):
+        if self.row is not None:
+            self.end_sheet()
+
+
+def get_sample_rows(sample, df) -> pd.DataFrame:
+    """ Rows of a sample in the 'data' sheet (see get_long_data) """
+
+    rows = df.reset_index(drop=True)
+    rows.insert(0, 'Sample', sample)
+    rows.insert(1, 'Cell', np.arange(1, len(df) + 1))
+    return rows
+
+
+#######################
+#        MAIN         #
+#######################
+
+
+def open_workbook(filename) -> tuple[xlsxwriter.Workbook, dict]:
+    workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+    formats = {'header': workbook.add_format(HEADER_FORMAT), 'decimal': workbook.add_format(DECIMAL_FORMAT)}
+    return workbook, formats
+
+
+def stream_workbook(filename, samples, channels, analyze):
+    """
+    Writes an experiment in the long layout, for experiments with too many samples for one sheet per sample:
+    - 'analysis': one row per sample x channel (see analysis.compute_analysis)
+    - 'data': one row per cell, one column per channel
+    Samples are written to both sheets one at a time, so that only one sample is held in memory.
+
+    Input: an iterable of (sample, dataframe), the data sheet channels columns, and analyze({sample : dataframe})
+    returning the analysis rows of a sample (see analysis.compute_analysis)
+    Output: generator yielding each (sample, dataframe) once written
+    """
+
+    workbook, formats = open_workbook(filename)
+
+    analysis_writer = TableWriter(workbook, 'analysis', formats, decimals=True)
+    data_writer = TableWriter(workbook, 'data', formats, columns=['Sample', 'Cell'] + list(channels))
+
+    for sample, df in samples:
+        analysis_writer.write(analyze({sample: df}))
+        data_writer.write(get_sample_rows(sample, df))
+        yield sample, df
+
+    analysis_writer.close()
+    data_writer.close()
+    workbook.close()
@@ -1,64 +1,72 @@
-import os
 import re
 from itertools import combinations
 
-import streamlit
-import openpyxl
+import numpy as np
 from openpyxl.utils import get_column_letter
 from openpyxl.formatting.rule import ColorScaleRule
 
 import src.parsing as parsing
+from src.analysis import get_bin_edges, divide
 
 
 #######################
 #     COORDINATES     #
 #######################
 
+# Maximum number of channels for co-positivity analysis: 2**13 combinations still fit in the 16384 columns of a sheet
+MAX_COPOSITIVITY_CHANNELS = 13
 
-def get_copositivity_analysis_coordinates(analysis_type, n_channels):
-    analysis_coordinates = {
-        'Count': {
-            2: (19, 23),
-            3: (27, 34),
-            4: (35, 49),
-            5: (43, 72),
-            6: (51, 111)},
+# Co-positivity layouts are stamped from the 2-channels templates, which hold a single channel combination
+PATTERN_CHANNELS = 2
 
-        'Area': {
-            2: (13, 17),
-            3: (18, 25),
-            4: (23, 37),
-            5: (28, 57),
-            6: (33, 93)}
-    }
 
-    return analysis_coordinates[analysis_type][n_channels]
+def has_copositivity(n_channels):
+    return 1 < n_channels <= MAX_COPOSITIVITY_CHANNELS
 
 
-def get_copositivity_coordinates(n_channels):
+def validate_n_channels(n_channels) -> None:
+    """ Raises a ValueError if the combinations of n_channels do not fit in a sheet """
+
+    if n_channels > MAX_COPOSITIVITY_CHANNELS:
+        raise ValueError(f'Co-positivity analysis is limited to {MAX_COPOSITIVITY_CHANNELS} channels, whose '
+                         f'combinations fit in the columns of a sheet (got {n_channels} channels)')
+
+
+def get_n_combinations(n_channels):
+    """ Number of combinations of at least 2 channels """
+    return 2 ** n_channels - n_channels - 1
 
-    coordinates = {
-        2: (10, 12),
-        3: (11, 16),
-        4: (12, 24),
-        5: (13, 40),
-        6: (14, 72),
-    }
 
-    return coordinates.get(n_channels, None)
+def get_channel_total_row(analysis_type, channel_index):
+    """ Row of the 'Total' line of a channel in the analysis part of a sheet """
+    return 10 + 8 * channel_index if analysis_type == 'Count' else 7 + 5 * channel_index
+
+
+def get_copositivity_analysis_coordinates(analysis_type, n_channels):
+    # blank row, header row, one row per combination and two closing rows after the channels analysis
+    rows_per_channel = 8 if analysis_type == 'Count' else 5
+    start_row = 3 + rows_per_channel * n_channels
+    return start_row, start_row + 3 + get_n_combinations(n_channels)
+
+
+def get_copositivity_coordinates(n_channels):
+    # separator column after the channels data, one column per combination and a closing separator
+    if n_channels < 2:
+        return None
+    validate_n_channels(n_channels)
+
+    col_start = 8 + n_channels
+    return col_start, col_start + get_n_combinations(n_channels) + 1
 
 
 def get_summary_coordinates(n_channels):
-    # coordinates for parsing copoitivite columns in summary file
-    coordinates = {
-        2: (10, 11), # 1 combination
-        3: (14, 18), # 4 combinations
-        4: (18, 29), # 11 combination
-        5: (22, 48), # 26 combinations
-        6: (26, 83) # 57 combinations    ## SHOULD BE GOOD
-    }
+    # coordinates for parsing copositivite columns in summary file: one column per combination and a blank column
+    if n_channels < 2:
+        return None
+    validate_n_channels(n_channels)
 
-    return coordinates.get(n_channels, None)
+    col_start = 4 * n_channels + 2
+    return col_start, col_start + get_n_combinations(n_channels)
 
 
 ########################
@@ -68,11 +76,8 @@ def get_summary_coordinates(n_channels):
 def combine_channels(channels) -> list:
     """Returns a list of all possible channels combinations"""
 
-    channels_combinations = []
-    for i in range(2, len(channels) + 1):
-        comb = [list(i) for i in list(combinations(channels, i))]
-        channels_combinations = channels_combinations + comb
-    return channels_combinations
+    channels = list(channels)
+    return [list(combination) for i in range(2, len(channels) + 1) for combination in combinations(channels, i)]
 
 
 def get_combination_name(channels_combinations):
@@ -83,6 +88,92 @@ def reformat_channel(channels_dict):
     return {channel_name: re.split(r'[()]', channel_number)[1] for channel_number, channel_name in channels_dict.items()}
 
 
+########################
+#  COPOSITIVITY ENGINE #
+########################
+
+
+def get_positivity_mask(values: np.ndarray, threshold) -> np.ndarray:
+    """ Packs the positivity of each cell (row) for every channel (column) into a bitmask: bit i <=> channel i """
+
+    # NaN never compares as positive, same as the ISNUMBER() check of the template formulas
+    with np.errstate(invalid='ignore'):
+        positive = values >= threshold
+
+    weights = 1 << np.arange(values.shape[1], dtype=np.int64)
+    return positive.astype(np.int64) @ weights
+
+
+def get_combinations_masks(n_channels) -> np.ndarray:
+    """ Bitmask of every channel combination, in the same order as combine_channels() """
+    return np.array([sum(1 << i for i in combination) for combination in combine_channels(range(n_channels))],
+                    dtype=np.int64)
+
+
+def count_copositive_cells(masks: np.ndarray, sample_index: np.ndarray, n_samples, n_channels) -> np.ndarray:
+    """
+    Returns a (n_samples, 2**n_channels) array holding, for every bitmask, the number of cells of each sample
+    positive for at least all the channels of the bitmask.
+    """
+
+    n_masks = 1 << n_channels
+    counts = np.bincount(sample_index * n_masks + masks, minlength=n_samples * n_masks).reshape(n_samples, n_masks)
+
+    # superset sums: fold every mask having a given bit set into the same mask without that bit
+    for bit in range(n_channels):
+        step = 1 << bit
+        view = counts.reshape(n_samples, -1, 2, step)
+        view[:, :, 0, :] += view[:, :, 1, :]
+
+    return counts
+
+
+def compute_copositivity(data, analysis_type, positivity_threshold=None) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    """
+    Input: {sample : dataframe} dictionary as returned by core.merge_image_channels (one column per channel)
+    Output: {sample : (cells flags [rows x combinations], co-positive cells count [combinations])}
+
+    Samples sharing the same number of channels are processed all at once.
+    """
+
+    threshold = get_bin_edges(analysis_type, positivity_threshold)[0]
+
+    groups = {}
+    for sample, df in data.items():
+        groups.setdefault(df.shape[1], []).append(sample)
+
+    results = {}
+    for n_channels, samples in groups.items():
+
+        if n_channels < 2:
+            continue
+        validate_n_channels(n_channels)
+
+        values = np.concatenate([data[sample].to_numpy(dtype=np.float64) for sample in samples])
+        lengths = [len(data[sample]) for sample in samples]
+        sample_index = np.repeat(np.arange(len(samples)), lengths)
+
+        masks = get_positivity_mask(values, threshold)
+        combinations_masks = get_combinations_masks(n_channels)
+        counts = count_copositive_cells(masks, sample_index, len(samples), n_channels)[:, combinations_masks]
+        flags = ((masks[:, None] & combinations_masks) == combinations_masks).astype(np.int8)
+
+        offsets = np.cumsum([0] + lengths)
+        for i, sample in enumerate(samples):
+            results[sample] = (flags[offsets[i]:offsets[i + 1]], counts[i])
+
+    return results
+
+
+def compute_copositive_percentages(df, counts) -> np.ndarray:
+    """ % of co-positive cells of each combination, relative to the average number of cells of the combined channels
+        (same as the formulas of the co-positivity analysis), NaN if the channels have no cell """
+
+    totals = df.notna().sum().to_numpy()
+    denominators = np.array([totals[combination].mean() for combination in combine_channels(range(df.shape[1]))])
+    return divide(counts, denominators) * 100
+
+
 ########################
 #  PARSING/FORMATTING  #
 ########################
@@ -128,62 +219,144 @@ def add_conditional_formatting(ws, col_start, col_end, row_start, row_end):
     ws.conditional_formatting.add(columns_range, format_rule)
 
 
-def parse_copositivity_analysis_template(template_ws, destination_ws, analysis_type, n_channels):
+def stamp_copositivity_columns(template_ws, destination_ws, n_channels, end_row, styles=None):
+    """ Stamp the co-positivity columns from the pattern template: separators + one column per combination """
+
+    template_start, template_end = get_copositivity_coordinates(PATTERN_CHANNELS)
+    col_start, col_end = get_copositivity_coordinates(n_channels)
+
+    columns = [(template_start, col_start)]
+    columns += [(template_start + 1, col) for col in range(col_start + 1, col_end)]
+    columns += [(template_end, col_end)]
+    template_max_row = template_ws.max_row
+
+    for row in range(1, end_row + 1):
+        # the separator column is not styled on the last template row, which closes the combination columns
+        separator_row = parsing.get_template_row(template_max_row, row)
+        template_row = parsing.get_template_row(template_max_row, row, last_row=end_row)
+        for template_col, destination_col in columns:
+            # only keep the 'CO-POSITIVE CELLS' title once, above the first combination
+            copy_value = row == 1 and destination_col == col_start + 1
+            parsing.copy_cells(template_ws, destination_ws, template_col=template_col, destination_col=destination_col,
+                               row=row, copy_value=copy_value, copy_style=True,
+                               template_row=separator_row if destination_col == col_start else template_row,
+                               styles=styles)
+
+
+def parse_copositivity_analysis_template(template_ws, destination_ws, analysis_type, n_channels, styles=None):
+    """ Stamp the co-positivity analysis rows from the pattern template: one row per combination """
+
+    template_start, _ = get_copositivity_analysis_coordinates(analysis_type, PATTERN_CHANNELS)
     start_row, end_row = get_copositivity_analysis_coordinates(analysis_type, n_channels)
+    n_combinations = get_n_combinations(n_channels)
+
+    rows = [(template_start, start_row), (template_start + 1, start_row + 1)]
+    rows += [(template_start + 2, row) for row in range(start_row + 2, start_row + 2 + n_combinations)]
+    rows += [(template_start + 3, end_row - 1), (template_start + 4, end_row)]
 
-    parsing.copy_from_template(template_ws=template_ws, destination_ws=destination_ws,
-                               start_row=start_row, end_row=end_row,
-                               template_start_col=1, template_end_col=6,
-                               destination_start_col=1, destination_end_col=6,
-                               copy_value=True, copy_style=True)
+    for template_row, destination_row in rows:
+        for col in range(1, 7):
+            parsing.copy_cells(template_ws, destination_ws, template_col=col, destination_col=col,
+                               row=destination_row, template_row=template_row,
+                               copy_value=template_row != template_start + 2, copy_style=True, styles=styles)
+
+    # % of co-positive cells relative to the average number of cells of the combined channels
+    for row, combination in enumerate(combine_channels(range(n_channels)), start=start_row + 2):
+        totals = ','.join(f'B{get_channel_total_row(analysis_type, i)}' for i in combination)
+        destination_ws.cell(row, 3).value = f'=B{row}/(AVERAGE({totals}))*100'
 
     return
 
 
+def stamp_copositivity_summary(template_ws, summary_ws, analysis_type, n_channels, end_row, styles=None):
+    """ Stamp the co-positivity columns of the summary sheet from the pattern template """
+
+    template_start, template_end = get_summary_coordinates(PATTERN_CHANNELS)
+    col_start, col_end = get_summary_coordinates(n_channels)
+    analysis_start, _ = get_copositivity_analysis_coordinates(analysis_type, n_channels)
+
+    columns = [(template_start, col) for col in range(col_start, col_end)] + [(template_end, col_end)]
+    template_max_row = template_ws.max_row
+
+    for row in range(1, end_row + 1):
+        template_row = parsing.get_template_row(template_max_row, row, last_row=end_row)
+        for template_col, destination_col in columns:
+            parsing.copy_cells(template_ws, summary_ws, template_col=template_col, destination_col=destination_col,
+                               row=row, copy_value=row == 2, copy_style=True, template_row=template_row,
+                               styles=styles)
+
+    # fetch % of co-positive cells from each sample sheet
+    for row in range(3, end_row + 1):
+        sample = summary_ws.cell(row, 1).value
+        if sample is None:
+            continue
+        for n, col in enumerate(range(col_start, col_end)):
+            summary_ws.cell(row, col).value = parsing.get_sheet_reference(sample, f'C{analysis_start + 2 + n}')
+
+
 #######################
 #        MAIN         #
 #######################
 
-def parse_copositivity_template(writer, sheets, filename, file_channels, analysis_end, analysis_type,
-                                template_file: str, progress_bar=None):
-    """ Copy template to add co-positivity columns """
+def write_copositivity_values(ws, flags, counts, col_start, start_row, percentages=None):
+    """ Writes co-positivity of each cell and number of co-positive cells as plain values, and the % of co-positive
+        cells instead of their formulas if given """
 
-    # Initialize progress_bar
+    for row, cell_flags in enumerate(flags.tolist(), start=4):
+        for col, flag in enumerate(cell_flags, start=col_start):
+            ws.cell(row, col).value = flag
+
+    for row, count in enumerate(counts.tolist(), start=start_row):
+        ws.cell(row, 2).value = count
+
+    if percentages is not None:
+        for row, percentage in enumerate(percentages, start=start_row):
+            ws.cell(row, 3).value = parsing.to_cell_value(percentage)
+
+
+def parse_copositivity_template(writer, sheets, filename, file_channels, data, analysis_end, analysis_type,
+                                template_file: str, progress=None, positivity_threshold=None, output_mode='formulas',
+                                checkpoint=False):
+    """ Copy template to add co-positivity columns
+        With output_mode 'values', the % of co-positive cells are written as values instead of formulas """
+
+    # Initialize progress
     step = 0
     steps = len(sheets)
-    if progress_bar:
-        progress_bar = streamlit.progress(step, f'Parsing co-positivity template: [{step}/{steps}]')
+    if progress:
+        progress(step, f'Parsing co-positivity template: [{step}/{steps}]')
 
     # Open the template file
-    template_rel_path = os.path.join(os.path.dirname(__file__), template_file)
-    template_wb = openpyxl.load_workbook(template_rel_path)
-    template_ws = template_wb.worksheets[0]
+    template_ws = parsing.load_template(template_file)
+    styles = {}  # template styles resolved once in the output workbook
 
     workbook = writer.book
 
+    # compute co-positivity for every sample at once
+    copositivity = compute_copositivity(data, analysis_type, positivity_threshold=positivity_threshold)
+
     for sheet in sheets:
 
         destination_ws = writer.sheets[sheet]
 
-        # get last row
-        end_row = destination_ws.max_row
+        # last data row: header on row 3, then one row per cell (max_row also counts the analysis rows)
+        end_row = 3 + len(data[sheet])
 
         # find number of channels used to determine columns to parse
         channels = file_channels[sheet]
         n_channels = len(channels)
 
         if n_channels < 2:
-            step += 1
-            progress_bar.progress(step / steps, f'Parsing co-positivity template: [{step}/{steps}]')
+            if progress:
+                step += 1
+                progress(step / steps, f'Parsing co-positivity template: [{step}/{steps}]')
             continue
 
         col_start, col_end = get_copositivity_coordinates(n_channels)
 
-        parsing.copy_from_template(template_ws=template_ws, destination_ws=destination_ws,
-                                   start_row=1, end_row=end_row,
-                                   template_start_col=col_start, template_end_col=col_end,
-                                   destination_start_col=col_start, destination_end_col=col_end,
-                                   copy_value=True, copy_style=True)
+        # stamp co-positivity columns (values are computed below)
+        stamp_copositivity_columns(template_ws=template_ws, destination_ws=destination_ws, n_channels=n_channels,
+                                   end_row=end_row, styles=styles)
 
         # rename columns
         rename_copositivity_columns(ws=destination_ws, channels=channels, start_col=col_start + 1)
@@ -195,20 +368,28 @@ def parse_copositivity_template(writer, sheets, filename, file_channels, analysi
 
         # parse copositivity analysis
         parse_copositivity_analysis_template(template_ws=template_ws, destination_ws=destination_ws,
-                                             analysis_type=analysis_type, n_channels=n_channels)
+                                             analysis_type=analysis_type, n_channels=n_channels, styles=styles)
 
         # rename_rows
         rename_copositivity_rows(ws=destination_ws, channels=channels, start_row=analysis_end[sheet] + 3)
 
-        if progress_bar:
+        # write co-positivity values
+        flags, counts = copositivity[sheet]
+        percentages = compute_copositive_percentages(data[sheet], counts) if output_mode == 'values' else None
+        write_copositivity_values(ws=destination_ws, flags=flags, counts=counts, col_start=col_start + 1,
+                                  start_row=analysis_end[sheet] + 3, percentages=percentages)
+
+        if progress:
             step += 1
-            progress_bar.progress(step / steps, f'Parsing co-positivity template: [{step}/{steps}]')
+            progress(step / steps, f'Parsing co-positivity template: [{step}/{steps}]')
 
-    workbook.save(filename)
+    if checkpoint:
+        workbook.save(filename)
     return
 
 
-def parse_copositivity_summary(writer, filename, n_channels, file_channels, summary_template: str):
+def parse_copositivity_summary(writer, filename, n_channels, file_channels, analysis_type, summary_template: str,
+                               checkpoint=False):
 
     # open summary sheet
     workbook = writer.book
@@ -218,18 +399,16 @@ def parse_copositivity_summary(writer, filename, n_channels, file_channels, summ
     start, end = get_summary_coordinates(n_channels)
 
     # Open the template file
-    template_rel_path = os.path.join(os.path.dirname(__file__), summary_template)
-    template_wb = openpyxl.load_workbook(template_rel_path)
-    template_ws = template_wb.worksheets[0]
+    template_ws = parsing.load_template(summary_template)
+    styles = {}  # template styles resolved once in the output workbook
 
-    # copy template analysis
-    parsing.copy_from_template(template_ws, summary_ws,
-                               start_row=1, end_row=max_rowdata,
-                               template_start_col=start, template_end_col=end,
-                               destination_start_col=start, destination_end_col=end)
+    # stamp co-positivity columns
+    stamp_copositivity_summary(template_ws=template_ws, summary_ws=summary_ws, analysis_type=analysis_type,
+                               n_channels=n_channels, end_row=max_rowdata, styles=styles)
 
     rename_summary_copositivity_columns(ws=summary_ws, file_channels=file_channels, start_row=start)
 
-    # save file
-    workbook.save(filename)
+    # save intermediate file
+    if checkpoint:
+        workbook.save(filename)
     return
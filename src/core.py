@@ -1,10 +1,27 @@
 import os
 import re
-from pathlib import Path
+import csv
+import logging
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
+from pathlib import Path, PurePosixPath
+from typing import IO, Iterator
+from zipfile import ZipFile
 
-import streamlit as st
 import pandas as pd
-from pydantic.v1.utils import deep_update
+
+
+# AURA macro output files are named <sample>_<channel>.csv
+FILENAME_PATTERN = re.compile(r'^(.+)_(.+).csv$')
+
+# Column of the AURA macro summary tables used by each analysis
+AURA_CSV_COLUMNS = {'Count': 'Count', 'Area': 'Total Area'}
+
+# .zip archives kept open by each process, the least recently used ones are closed
+ZIP_CACHE_SIZE = 4
 
 
 def create_directory(directory_path: [Path | str]) -> None:
@@ -14,14 +31,136 @@ def create_directory(directory_path: [Path | str]) -> None:
         os.makedirs(out_path, exist_ok=True)
 
 
-def create_xlsx_file(filename: str, output_folder: str = '.') -> tuple[pd.ExcelWriter, str]:
-    """ Creates an .xlsx file that can be manipulated """
-    file_name = os.path.join(output_folder, f"{filename}.xlsx")
-    writer = pd.ExcelWriter(file_name, engine='openpyxl')
-    return writer, file_name
+def open_xlsx_writer(file_name: str) -> pd.ExcelWriter:
+    """ In-memory workbook written to file_name on save """
+    return pd.ExcelWriter(file_name, engine='openpyxl')
+
+
+def save_xlsx_file(writer: pd.ExcelWriter) -> None:
+    """ Writes the in-memory workbook to disk once every processing stage is done """
+    writer.close()
+
+
+@cache
+def get_csv_engine() -> str:
+    """ Use the pyarrow csv parser when it is installed, fallback to pandas' default C parser otherwise """
+    try:
+        import pyarrow  # noqa: F401
+        return 'pyarrow'
+    except ImportError:
+        return 'c'
+
+
+def read_csv_header(file) -> list[str]:
+    """ Column names of a .csv file (path or file object), the position of file objects is left unchanged """
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as binary_file:
+            line = binary_file.readline()
+    else:
+        position = file.tell()
+        line = file.readline()
+        file.seek(position)
+
+    if isinstance(line, bytes):
+        line = line.decode('utf-8-sig', 'backslashreplace')
+    return next(csv.reader([line]), [])
+
+
+def read_aura_csv(file, column_name=None) -> pd.DataFrame:
+    """
+    Reads a .csv file output by the AURA macro, keeping only the column of the column_name analysis (see
+    AURA_CSV_COLUMNS), or every analysed column of the file if None.
+    Raises a ValueError if the column is missing, or has non-numeric values.
+    """
+
+    header = read_csv_header(file)
+    if column_name is None:
+        columns = [column for column in AURA_CSV_COLUMNS.values() if column in header]
+    else:
+        columns = [AURA_CSV_COLUMNS[column_name]]
+
+    missing = [column for column in columns if column not in header]
+    if missing or not columns:
+        expected = ', '.join(missing or AURA_CSV_COLUMNS.values())
+        raise ValueError(f'File does not match the AURA macro output format (missing columns: {expected})')
+
+    # blank cells are read as NaN
+    try:
+        filedata = pd.read_csv(file, usecols=columns, dtype=dict.fromkeys(columns, 'float64'),
+                               engine=get_csv_engine())
+    except ValueError as error:
+        raise ValueError(f'File has non-numeric values in columns {", ".join(columns)}: {error}') from error
+
+    # counts are stored as int32 unless some of them are blank
+    counts = filedata.get('Count')
+    if counts is not None and counts.notna().all() and (counts % 1 == 0).all():
+        filedata['Count'] = counts.astype('int32')
+
+    return filedata
+
+
+# {(path, modification time, size) : archive}, in the order archives were last used
+zip_files: OrderedDict[tuple, ZipFile] = OrderedDict()
+zip_files_lock = threading.Lock()
+
+
+def clear_zip_files() -> None:
+    # forked processes open their own archives: file positions are not shared with the parent process
+    global zip_files_lock
+    zip_files.clear()
+    zip_files_lock = threading.Lock()
+
 
+os.register_at_fork(after_in_child=clear_zip_files)
 
-def get_channels_from_settings_file(uploaded_file: st.file_uploader) -> dict[str, str]:
+
+def open_zip_file(path) -> ZipFile:
+    """
+    Archive opened once per process and per version of the file: its central directory is only parsed once.
+    At most ZIP_CACHE_SIZE archives are kept open, members still being read when their archive is closed can be read
+    until they are closed.
+    """
+
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+
+    with zip_files_lock:
+        zip_file = zip_files.get(key)
+        if zip_file is None:
+            zip_file = zip_files[key] = ZipFile(path)
+        zip_files.move_to_end(key)
+
+        while len(zip_files) > ZIP_CACHE_SIZE:
+            _, least_recent = zip_files.popitem(last=False)
+            least_recent.close()
+
+    return zip_file
+
+
+class ZipMember:
+    """ A file of a .zip archive, decompressed only when it is opened """
+
+    __slots__ = ('archive', 'name')
+
+    def __init__(self, archive, name):
+        self.archive = archive      # ZipFile, or path of the .zip file (members can then be sent to other processes)
+        self.name = name            # member name in the archive
+
+    def open(self) -> IO[bytes]:
+        archive = self.archive if isinstance(self.archive, ZipFile) else open_zip_file(self.archive)
+        return archive.open(self.name)
+
+    def __reduce__(self):
+        if isinstance(self.archive, ZipFile):
+            raise TypeError('Files of an opened .zip file can not be sent to other processes, open it from its path')
+        return ZipMember, (self.archive, self.name)
+
+    def __repr__(self):
+        return self.name
+
+
+def get_channels_from_settings_file(uploaded_file: IO) -> dict[str, str]:
     """ Parse channels present in settings file and returns it as a list """
 
     channels = {}
@@ -52,75 +191,175 @@ def get_templates(n_channels, analysis_type):
     return summary_template, sheet_template
 
 
-def build_files_attributes_dict(files_dict: dict[str, pd.DataFrame], channels_list: dict, error_space: st.empty = None,
-                                progress_bar=None) -> dict:
-    """ Input: a {filename : filedata} dictionary"""
+def get_copositivity_templates(analysis_type):
+    """ Templates used as a pattern to stamp co-positivity columns, whatever the number of channels """
+
+    summary_template = f'templates/{analysis_type}/template_summary_{analysis_type}_2channels.xlsx'
+    sheet_template = f'templates/{analysis_type}/template_sheet_{analysis_type}_2channels.xlsx'
+
+    return summary_template, sheet_template
+
+
+def build_files_attributes_dict(files_dict: dict[str, pd.DataFrame], channels_list: dict, on_error=None,
+                                progress=None) -> dict:
+    """ Input: a {filename or .zip member path : filedata} dictionary
+        Output: a {sample : {channel : filedata}} dictionary, built in a single pass over the files
+        Files of unknown channels are left out. Unknown and duplicated channels are reported to on_error(message),
+        or logged """
 
-    # generate progress bar
+    # initialize progress
     samples = len(files_dict)
-    count = 0
 
-    if progress_bar:
-        progress_bar.progress(count, text=f"Processing input files: [{count}/{samples}]")
+    if progress:
+        progress(0, f"Processing input files: [0/{samples}]")
 
     # processing files
     errors = []
-    files_attributes = {}
-    for filename, filedata in files_dict.items():
+    duplicates = []
+    channels = set(channels_list)
+    files_attributes: dict[str, dict[str, pd.DataFrame]] = {}
+    for count, (filename, filedata) in enumerate(files_dict.items(), start=1):
 
-        # use regex to process file names
-        matches = re.match(r'^(.+)_(.+).csv$', filename)
+        # use regex to process file names (.zip archive members are keyed by their path)
+        matches = FILENAME_PATTERN.match(PurePosixPath(filename).name)
         sample = str(matches.group(1)) if matches else None
         channel = str(matches.group(2)) if matches else None
 
-        channels = [i for i in channels_list.keys()]
-
         if channel not in channels:
             errors.append((filename, channel))
-
-        # make dictionary from values
-        file_dict: dict[str, dict[str, pd.DataFrame]] = {sample: {channel: filedata}}
-
-        # update main dictionary
-        files_attributes = deep_update(files_attributes, file_dict)
-
-        # updating progress bar
-        count += 1
-        if progress_bar:
-            progress_bar.progress(count/samples, text=f'Processing input files: [{count}/{samples}]')
-
-    if errors and error_space:
+        else:
+            # group channels by sample, the last file read wins if the same sample/channel pair is found twice
+            sample_channels = files_attributes.setdefault(sample, {})
+            if channel in sample_channels:
+                duplicates.append((filename, sample, channel))
+            sample_channels[channel] = filedata
+
+        # updating progress, skipped files included
+        if progress:
+            progress(count/samples, f'Processing input files: [{count}/{samples}]')
+
+    if (errors or duplicates) and on_error:
         error_string = [f'Found unknown channel [**{channel}**] in file: **{filename}**\n\n'
                         for (filename, channel) in errors]
+        error_string += [f'Found duplicated channel [**{channel}**] for sample **{sample}** in file: **{filename}**\n\n'
+                         for (filename, sample, channel) in duplicates]
         error_string = ''.join(error_string)
         settings_channels = '| '.join(channels_list)
         settings_channels = f'File **Analysis_settings.txt** specify the following channels: {settings_channels}'
         string = error_string + settings_channels
-        error_space.error(string)
+        on_error(string)
     else:
         # add log output for CLI
-        ...
+        for (filename, channel) in errors:
+            logging.warning(f'##### FOUND UNKNOWN CHANNEL [{channel}] IN FILE: {filename}')
+        for (filename, sample, channel) in duplicates:
+            logging.warning(f'##### FOUND DUPLICATED CHANNEL [{channel}] FOR SAMPLE {sample} IN FILE: {filename}')
 
     return files_attributes
 
 
-def merge_image_channels(files_attributes, channels_dict, writer, file_name, progress_bar=None, column_name='Count'):
-    """ For each image sample, merge corresponding channels together """
+def get_sample_channels(channels_per_image, channels_dict) -> dict[str, str]:
+    """ {'Channel n (Cn)' : stain name} of the channels found for a sample, in the order of the settings file """
+    return {channels_dict[col]: col for col in channels_dict if col in channels_per_image}
+
+
+def merge_sample_channels(channels_per_image, channels_dict, column_name='Count') -> pd.DataFrame:
+    """ Merge the channels of one image sample: one row per cell (Slice_1, Slice_2, ...), one column per channel """
+
+    column_name = AURA_CSV_COLUMNS[column_name]
+
+    # store separate channel dataframes in list
+    image_dfs = []
+    for channel, filedata in channels_per_image.items():
+        df_length = len(filedata)
+        slices = [f'Slice_{i}' for i in range(1, df_length+1)]
+        filedata['Slice'] = slices
+        filedata = filedata.set_index('Slice')[[column_name]]
+        filedata.columns = [channel]
+        image_dfs.append(filedata)
+
+    # concat dataframes from same sample+channel, reorder columns based on names (no file could be read: empty)
+    df = pd.concat(image_dfs, axis=1) if image_dfs else pd.DataFrame()
+
+    # reindex columns
+    c = []
+    for key, value in channels_dict.items():
+        if key in df.columns:
+            c.append(key)
+    return df.reindex(c, axis=1)
+
+
+def read_sample_files(channels_per_image, column_name=None) -> dict[str, pd.DataFrame]:
+    """
+    {channel : filedata} of a sample: files indexed but not read yet (paths, file objects or archive members) are
+    read now, keeping only the column of the column_name analysis (every analysed column if None).
+    Files that can not be read, or without the analysed column, are logged and left out.
+    """
+
+    filedata = {}
+    for channel, file in channels_per_image.items():
+        if isinstance(file, pd.DataFrame):
+            # tables read beforehand, with every analysed column found in the file
+            if column_name is not None and AURA_CSV_COLUMNS[column_name] not in file.columns:
+                logging.error(f'##### MISSING COLUMN {AURA_CSV_COLUMNS[column_name]} IN FILE OF CHANNEL {channel}')
+            else:
+                filedata[channel] = file
+            continue
+        try:
+            if isinstance(file, ZipMember):
+                with file.open() as member:
+                    filedata[channel] = read_aura_csv(member, column_name)
+            elif hasattr(file, 'read_table'):
+                # files reading their own table, e.g. through the parsed files cache (see csv_cache.CachedFile)
+                filedata[channel] = file.read_table(column_name)
+            else:
+                filedata[channel] = read_aura_csv(file, column_name)
+        except Exception as error:
+            logging.error(f'##### COULD NOT READ FILE {file}: {error}')
+
+    return filedata
+
+
+def iter_sample_files(files_attributes, jobs=1, column_name=None) -> Iterator[tuple[str, dict[str, pd.DataFrame]]]:
+    """
+    Yields the {channel : filedata} tables of each sample, in the samples order (see read_sample_files).
+    The next jobs samples are read in background threads while the current one is processed.
+    """
+
+    samples = iter(files_attributes.items())
+    read_files = partial(read_sample_files, column_name=column_name)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        pending = deque((sample, executor.submit(read_files, channels_per_image))
+                        for sample, channels_per_image in itertools.islice(samples, max(jobs, 1)))
+        while pending:
+            sample, future = pending.popleft()
+            for next_sample, channels_per_image in itertools.islice(samples, 1):
+                pending.append((next_sample, executor.submit(read_files, channels_per_image)))
+            yield sample, future.result()
+
+
+def has_missing_channels(sample_channels, channels_dict) -> bool:
+    """ True if some channels of the settings file (but the nuclei channel) were not found for a sample """
+    return len(sample_channels) < len(channels_dict) - 1
+
+
+def merge_image_channels(files_attributes, channels_dict, writer, file_name, progress=None, column_name='Count',
+                         checkpoint=False, jobs=1):
+    """ For each image sample, merge corresponding channels together, jobs threads reading the next samples """
 
     warnings = []
 
-    # generate progress bar
+    # initialize progress
     samples = len(files_attributes)
     i = 0
-    if progress_bar:
-        progress_bar: st.progress = st.progress(0, text=f"Merging image channels: [{i}/{samples}]")
+    if progress:
+        progress(0, f"Merging image channels: [{i}/{samples}]")
 
     # initialize variables
     counter = 3
     sheets = []
     data = {}
     file_channels = {}
-    column_name = 'Total Area' if column_name == 'Area' else column_name
 
     # create summary sheet in first position
     workbook = writer.book
@@ -128,36 +367,14 @@ def merge_image_channels(files_attributes, channels_dict, writer, file_name, pro
     summary_sheet = writer.sheets['summary']
 
     # Loop over samples
-    for sample, channels_per_image in files_attributes.items():
-
-        # store separate channel dataframes in list
-        image_dfs = []
-        channel_count = 0
-        for channel, filedata in channels_per_image.items():
-            channel_count += 1
-            df_length = len(filedata)
-            slices = [f'Slice_{i}' for i in range(1, df_length+1)]
-            filedata['Slice'] = slices
-            filedata = filedata.set_index('Slice')[[column_name]]
-            filedata.columns = [channel]
-            image_dfs.append(filedata)
-
-        # concat dataframes from same sample+channel, reorder columns based on names and store in dictionary
-        df = pd.concat(image_dfs, axis=1)
-
-        # reindex columns
-        c = []
-        for key, value in channels_dict.items():
-            if key in df.columns:
-                c.append(key)
-        df = df.reindex(c, axis=1)
+    for sample, channels_per_image in iter_sample_files(files_attributes, jobs=jobs, column_name=column_name):
+
+        df = merge_sample_channels(channels_per_image, channels_dict, column_name=column_name)
         data[sample] = df
-        file_channels[sample] = {channels_dict[col]: col for col in df.columns}
+        file_channels[sample] = get_sample_channels(df.columns, channels_dict)
 
         # check if all channels are found
-        expected = len(channels_dict) - 1
-        found = len(file_channels[sample])
-        if found < expected:
+        if has_missing_channels(file_channels[sample], channels_dict):
             warnings.append(sample)
 
         sheets.append(sample)
@@ -169,12 +386,13 @@ def merge_image_channels(files_attributes, channels_dict, writer, file_name, pro
         summary_sheet[f"A{counter}"] = sample
         counter = counter + 1
 
-        # updating progress bar
-        if progress_bar:
+        # updating progress
+        if progress:
             i += 1
-            progress_bar.progress(i / samples, text=f'Merging image channels: [{i}/{samples}]')
+            progress(i / samples, f'Merging image channels: [{i}/{samples}]')
 
-    # save file
-    workbook.save(file_name)
+    # save intermediate file (debugging only, final save is done by the caller)
+    if checkpoint:
+        workbook.save(file_name)
 
     return sheets, data, file_channels, warnings
@@ -0,0 +1,145 @@
+import os
+import hashlib
+import logging
+import tempfile
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import src.core as core
+
+
+#######################
+#       SETTINGS      #
+#######################
+
+# Bumped when the parsed tables change (e.g. core.read_aura_csv), older entries are then never read again
+CACHE_VERSION = 2
+
+CACHE_SUFFIX = '.npz'
+
+
+#######################
+#        CACHE        #
+#######################
+
+
+def read_file_bytes(file) -> bytes:
+    """ Raw content of an input file: path, .zip archive member or file object """
+
+    if isinstance(file, core.ZipMember):
+        with file.open() as member:
+            return member.read()
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as binary_file:
+            return binary_file.read()
+
+    return file.read()
+
+
+class CsvCache:
+    """
+    Directory of parsed AURA .csv files, one .npz file of the analysed columns per file content and analysis (SHA-1 of
+    the file and the analysis column, see core.read_aura_csv).
+    Entries are touched when read, the least recently used ones are removed once the directory exceeds max_size
+    bytes. The cache can be shared by threads and processes: entries are written to a temporary file then renamed.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = str(directory)
+        self.max_size = max_size
+        self.size = None    # bytes of the directory, scanned on the first write of each process
+
+        core.create_directory(self.directory)
+        self.evict()
+
+    def __getstate__(self):
+        # the size of the directory is scanned again by each process
+        return self.directory, self.max_size
+
+    def __setstate__(self, state):
+        self.directory, self.max_size = state
+        self.size = None
+
+    def get_path(self, content: bytes, column_name=None) -> str:
+        digest = hashlib.sha1(f'aura-csv-v{CACHE_VERSION}-{column_name}'.encode('utf-8') + content).hexdigest()
+        return os.path.join(self.directory, f'{digest}{CACHE_SUFFIX}')
+
+    def get_entries(self) -> list[os.DirEntry]:
+        with os.scandir(self.directory) as entries:
+            return [entry for entry in entries if entry.is_file() and entry.name.endswith(CACHE_SUFFIX)]
+
+    def load(self, path) -> pd.DataFrame | None:
+        try:
+            with np.load(path) as columns:
+                filedata = pd.DataFrame({column: columns[column] for column in columns.files})
+            # least recently used entries are the ones with the oldest modification time
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # entry removed by another process, or partially written
+            return None
+
+        return filedata
+
+    def store(self, path, filedata: pd.DataFrame) -> None:
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as file:
+            np.savez(file, **{column: filedata[column].to_numpy() for column in filedata.columns})
+        size = os.path.getsize(file.name)
+        os.replace(file.name, path)
+
+        if self.size is None:
+            self.size = sum(entry.stat().st_size for entry in self.get_entries())
+        else:
+            self.size += size
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self) -> None:
+        """ Removes the least recently used entries until the cache fits in max_size bytes """
+
+        entries = sorted((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in self.get_entries())
+        self.size = sum(size for _, size, _ in entries)
+
+        for _, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already removed by another process
+                pass
+            self.size -= size
+
+        logging.info(f'##### CACHE SIZE: {self.size / 2**20:.1f} MB')
+
+    def read(self, file, column_name=None) -> pd.DataFrame:
+        """ Parsed .csv file, read from the cache if a file with the same content was already parsed """
+
+        content = read_file_bytes(file)
+        path = self.get_path(content, column_name)
+
+        filedata = self.load(path) if os.path.exists(path) else None
+        if filedata is None:
+            filedata = core.read_aura_csv(BytesIO(content), column_name)
+            self.store(path, filedata)
+
+        return filedata
+
+
+class CachedFile:
+    """ An input file read through a CsvCache """
+
+    __slots__ = ('file', 'cache')
+
+    def __init__(self, file, cache):
+        self.file = file
+        self.cache = cache
+
+    def read_table(self, column_name=None) -> pd.DataFrame:
+        return self.cache.read(self.file, column_name)
+
+    def __repr__(self):
+        return str(self.file)
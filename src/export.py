@@ -0,0 +1,49 @@
+import os
+
+import pandas as pd
+
+import src.compact as compact
+import src.options as options
+
+
+#######################
+#       FORMATS       #
+#######################
+
+
+def get_available_formats() -> list[str]:
+    return [fmt for fmt in options.EXPORT_FORMATS if fmt not in options.PYARROW_FORMATS or options.has_pyarrow()]
+
+
+#######################
+#        WRITE        #
+#######################
+
+
+def write_table(table: pd.DataFrame, path: str, fmt: str) -> None:
+    if fmt == 'parquet':
+        table.to_parquet(path, index=False)
+    elif fmt == 'arrow':
+        table.reset_index(drop=True).to_feather(path)
+    else:
+        table.to_csv(path, index=False)
+
+
+def export_results(output_folder, experiment_name, data, analysis, formats) -> list[str]:
+    """
+    Writes the merged data (one row per cell, see compact.get_long_data) and the analysis (one row per
+    sample x channel, see analysis.compute_analysis) in each format, as <experiment>_data.<ext> and
+    <experiment>_analysis.<ext>. Returns the written files.
+    """
+
+    options.validate_formats(formats)
+    tables = {'data': compact.get_long_data(data), 'analysis': analysis}
+
+    paths = []
+    for fmt in formats:
+        for name, table in tables.items():
+            path = os.path.join(output_folder, f'{experiment_name}_{name}{options.EXPORT_FORMATS[fmt]}')
+            write_table(table, path, fmt)
+            paths.append(path)
+
+    return paths
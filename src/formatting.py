@@ -1,4 +1,3 @@
-import streamlit as st
 from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.dimensions import ColumnDimension, DimensionHolder, RowDimension
 
@@ -85,24 +84,21 @@ def resize_rows(writer, sheets):
 #######################
 
 
-def format_file(writer, filename, sheets, n_channels, progress_bar=None):
+def format_file(writer, filename, sheets, n_channels, progress=None):
     """ Handles formatting of colums width and row height all at once """
 
-    if progress_bar:
-        progress_bar = st.progress(0, text=f"Formatting final table: [0/2]")
-
-    workbook = writer.book
+    if progress:
+        progress(0, f"Formatting final table: [0/2]")
 
     # resize columns
     resize_summary_columns(writer)
     resize_analysis_columns(writer, sheets, n_channels)
-    if progress_bar:
-        progress_bar.progress(1/2, text=f"Formatting final table: [1/2]")
+    if progress:
+        progress(1/2, f"Formatting final table: [1/2]")
 
     # resize rows
     resize_rows(writer, sheets)
-    if progress_bar:
-        progress_bar.progress(2/2, text=f"Formatting final table: [2/2]")
+    if progress:
+        progress(2/2, f"Formatting final table: [2/2]")
 
-    workbook.save(filename)
     return
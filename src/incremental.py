@@ -0,0 +1,246 @@
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import pandas as pd
+import xlsxwriter
+
+import src.core as core
+import src.parallel as parallel
+import src.streaming as streaming
+import src.csv_cache as csv_cache
+
+
+#######################
+#       SETTINGS      #
+#######################
+
+# Bumped when the manifest or the sheets change, previous workbooks are then rebuilt from scratch
+MANIFEST_VERSION = 2
+
+# Options of the workbooks, recorded in the manifest with the XlsxWriter version: the numbering of the formats and the
+# parts of the sheets depend on them, workbooks written with other options or versions are rebuilt
+WORKBOOK_OPTIONS = {'constant_memory': True}
+
+
+#######################
+#       MANIFEST      #
+#######################
+
+
+def get_manifest_file(filename) -> str:
+    """ The manifest of <experiment>.xlsx is <experiment>_manifest.json, next to it """
+    return f'{os.path.splitext(filename)[0]}_manifest.json'
+
+
+def get_source_file(file):
+    """ File a sample table is read from: path, .zip archive member, file object or table read beforehand """
+    return file.file if isinstance(file, csv_cache.CachedFile) else file
+
+
+def get_file_stat(file) -> list | None:
+    """ [size, modification time in ns] of a file, [size, CRC-32] of a .zip archive member (read from the central
+        directory of the archive), None for file objects and tables read beforehand """
+
+    file = get_source_file(file)
+    if isinstance(file, core.ZipMember):
+        archive = file.archive if isinstance(file.archive, ZipFile) else core.open_zip_file(file.archive)
+        info = archive.getinfo(file.name)
+        return [info.file_size, info.CRC]
+
+    if isinstance(file, (str, os.PathLike)):
+        stat = os.stat(file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    return None
+
+
+def get_sample_stats(channels_per_image) -> dict | None:
+    """ {channel : file stat} of a sample (see get_file_stat), None if a file has no stat """
+    stats = {channel: get_file_stat(file) for channel, file in channels_per_image.items()}
+    return None if None in stats.values() else stats
+
+
+def get_sample_hash(channels_per_image) -> str:
+    """ SHA-1 of the channels names and files content of a sample """
+
+    sample_hash = hashlib.sha1()
+    for channel in sorted(channels_per_image):
+        file = get_source_file(channels_per_image[channel])
+
+        if isinstance(file, pd.DataFrame):
+            content = pd.util.hash_pandas_object(file).to_numpy().tobytes()
+        else:
+            content = csv_cache.read_file_bytes(file)
+
+        sample_hash.update(channel.encode('utf-8'))
+        sample_hash.update(hashlib.sha1(content).digest())
+
+    return sample_hash.hexdigest()
+
+
+def read_manifest(filename, settings) -> dict | None:
+    """ Manifest of the workbook, None if the workbook has to be rebuilt (missing, or written with other settings) """
+
+    manifest_file = get_manifest_file(filename)
+    if not os.path.isfile(filename) or not os.path.isfile(manifest_file):
+        return None
+
+    try:
+        with open(manifest_file) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError) as error:
+        logging.warning(f'##### COULD NOT READ MANIFEST {manifest_file}: {error}')
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('settings') != settings:
+        logging.warning('##### WORKBOOK WRITTEN WITH OTHER SETTINGS, REBUILDING IT')
+        return None
+
+    # JSON arrays back to the hashable format properties
+    manifest['formats'] = {kind: [tuple(tuple(item) for item in properties) for properties in formats]
+                           for kind, formats in manifest['formats'].items()}
+    return manifest
+
+
+def write_manifest(filename, settings, n_channels, samples, formats) -> None:
+    manifest = {'version': MANIFEST_VERSION, 'settings': settings, 'n_channels': n_channels, 'formats': formats,
+                'samples': samples}
+
+    # replaced at once, a manifest never describes a partially written workbook
+    manifest_file = get_manifest_file(filename)
+    with open(f'{manifest_file}.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+
+
+#######################
+#       WORKBOOK      #
+#######################
+
+
+def copy_sheets(filename, previous_filename, output_filename, parts) -> None:
+    """
+    Copies the .xlsx file, replacing the {part : previous part} sheets by the ones of the previous workbook.
+    Raises a ValueError if sheets of the workbooks refer to shared strings or other parts (see
+    streaming.SHEET_PART).
+    """
+
+    with ZipFile(filename) as new_zip, ZipFile(previous_filename) as previous_zip:
+        for zip_file in (new_zip, previous_zip):
+            streaming.check_sheets_parts(zip_file)
+
+    with ZipFile(filename) as new_zip, ZipFile(previous_filename) as previous_zip, \
+            ZipFile(output_filename, 'w', compression=ZIP_DEFLATED) as output_zip:
+        for info in new_zip.infolist():
+            if info.filename in parts:
+                output_zip.writestr(info, previous_zip.read(parts[info.filename]))
+            else:
+                output_zip.writestr(info, new_zip.read(info))
+
+
+def stream_workbook(filename, files_attributes, channels_dict, analysis_type, processes=1, jobs=1,
+                    output_mode='formulas', positivity_threshold=None, bin_edges=None, progress=None):
+    """
+    Adds new samples to a workbook written by this function, its manifest listing the samples already written
+    (name, hash and size and modification time of their files). Files whose size and modification time did not
+    change are not read, the other samples are hashed. Only the new and changed samples are rendered (see
+    parallel.render_samples), the sheets of the other samples are copied from the previous workbook without reading
+    their files, and the summary is rewritten for every sample, last, from the channels of the files which could be
+    read.
+    Samples of the previous workbook missing from the input files are kept. The workbook is rebuilt from scratch
+    when it has no manifest, or was written with other settings or another XlsxWriter version.
+
+    Output: generator yielding the merged data (sample, dataframe) of each rendered sample once written
+    """
+
+    # templates are chosen before any file is read, from the channels of the indexed files
+    files_channels = {sample: core.get_sample_channels(channels_per_image, channels_dict)
+                      for sample, channels_per_image in files_attributes.items()}
+    settings = {'analysis_type': analysis_type, 'output_mode': output_mode,
+                'positivity_threshold': positivity_threshold,
+                'bin_edges': None if bin_edges is None else list(bin_edges), 'channels': channels_dict,
+                'writer': {'xlsxwriter': xlsxwriter.__version__, **WORKBOOK_OPTIONS}}
+
+    # templates depend on the number of channels: a new sample with more channels changes every sheet
+    manifest = read_manifest(filename, settings)
+    previous = {entry['name']: entry for entry in manifest['samples']} if manifest else {}
+    n_channels = max(len(channels) for channels in [*files_channels.values()] +
+                     [entry['channels'] for entry in previous.values()])
+    if manifest and n_channels != manifest['n_channels']:
+        logging.warning(f'##### FOUND {n_channels} CHANNELS INSTEAD OF {manifest["n_channels"]}, REBUILDING WORKBOOK')
+        manifest, previous = None, {}
+
+    # files with the size and modification time recorded in the manifest are not read: only the other samples are
+    # hashed, and only the ones whose content changed are rendered
+    stats = {sample: get_sample_stats(channels_per_image) for sample, channels_per_image in files_attributes.items()}
+    hashes = {sample: previous[sample]['hash'] for sample in files_attributes
+              if sample in previous and stats[sample] is not None and stats[sample] == previous[sample]['files']}
+    hashed = [sample for sample in files_attributes if sample not in hashes]
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        hashes.update(zip(hashed, executor.map(get_sample_hash, [files_attributes[sample] for sample in hashed])))
+    rendered = {sample: channels_per_image for sample, channels_per_image in files_attributes.items()
+                if sample not in previous or previous[sample]['hash'] != hashes[sample]}
+
+    if manifest and not rendered:
+        logging.warning('##### NO NEW OR CHANGED SAMPLE')
+        return
+
+    # previous samples keep their sheet, new samples are added at the end
+    samples = list(previous) + [sample for sample in files_attributes if sample not in previous]
+    file_channels = {sample: previous[sample]['channels'] for sample in samples if sample not in rendered}
+    logging.warning(f'##### RENDERING {len(rendered)} OF {len(samples)} SAMPLES')
+
+    workbook_filename = f'{filename}.tmp'
+    workbook = xlsxwriter.Workbook(workbook_filename, WORKBOOK_OPTIONS)
+    formats = {}
+    if manifest:
+        streaming.set_format_indexes(workbook, manifest['formats']['cells'], manifest['formats']['conditional'],
+                                     formats)
+
+    # the summary is written once every rendered sample is read
+    summary_ws = workbook.add_worksheet('summary')
+    worksheets = {sample: workbook.add_worksheet(sample) for sample in samples}
+
+    renders = parallel.iter_renders(rendered, channels_dict, processes=processes, jobs=jobs,
+                                    analysis_type=analysis_type, n_channels=n_channels, output_mode=output_mode,
+                                    positivity_threshold=positivity_threshold, bin_edges=bin_edges)
+
+    step, steps = 0, len(rendered)
+    for batch_renders, batch_data in renders:
+        for render in batch_renders:
+            streaming.write_worksheet(workbook, render, formats, destination_ws=worksheets[render['title']])
+
+        if progress:
+            step += len(batch_renders)
+            progress(step / steps, f'Writing file: [{step}/{steps}]')
+
+        for sample, df in batch_data.items():
+            file_channels[sample] = core.get_sample_channels(df.columns, channels_dict)
+            yield sample, df
+
+    file_channels = {sample: file_channels[sample] for sample in samples}
+    streaming.write_worksheet(workbook, parallel.render_summary(samples, file_channels, analysis_type), formats,
+                              destination_ws=summary_ws)
+    workbook.close()
+
+    # sheets of the samples which were not rendered are empty: they are replaced by the previous ones
+    parts = {streaming.SHEET_PART.format(index): previous[sample]['sheet']
+             for index, sample in enumerate(samples, start=2) if sample not in rendered}
+    if parts:
+        copy_sheets(workbook_filename, filename, f'{filename}.copy', parts)
+        os.replace(f'{filename}.copy', filename)
+        os.remove(workbook_filename)
+    else:
+        os.replace(workbook_filename, filename)
+
+    cell_formats, conditional_formats = streaming.get_format_indexes(formats)
+    entries = [{'name': sample, 'hash': hashes[sample] if sample in hashes else previous[sample]['hash'],
+                'files': stats[sample] if sample in stats else previous[sample]['files'],
+                'channels': file_channels[sample], 'sheet': streaming.SHEET_PART.format(index)}
+               for index, sample in enumerate(samples, start=2)]
+    write_manifest(filename, settings, n_channels, entries,
+                   formats={'cells': cell_formats, 'conditional': conditional_formats})
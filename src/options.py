@@ -0,0 +1,99 @@
+import math
+from importlib.util import find_spec
+
+
+# Processing options and their validation. This module only depends on the standard library, so that the CLI
+# can parse and check its arguments without importing pandas, numpy or openpyxl.
+
+
+#######################
+#        INPUT        #
+#######################
+
+# Maximum size of the parsed input files cache, in MB
+DEFAULT_CACHE_SIZE = 1024
+
+# Watched folders are scanned every WATCH_INTERVAL seconds, a file is complete once unchanged for WATCH_DEBOUNCE seconds
+WATCH_INTERVAL = 1
+WATCH_DEBOUNCE = 5
+
+
+#######################
+#       ANALYSIS      #
+#######################
+
+# Smallest positive value, i.e. '>0'
+POSITIVE = math.nextafter(0, 1)
+
+# A cell is positive for a channel when its value is >= threshold: at least 1 dot, or any signal area
+DEFAULT_POSITIVITY_THRESHOLDS = {'Count': 1, 'Area': POSITIVE}
+
+# Dots/Cell bins of the Count analysis (after the positivity threshold): 0 | 1-3 | 4-9 | 10-15 | >15
+# Bins are weighted 0 to 4 in the H-score
+DEFAULT_BIN_EDGES = (4, 10, 16)
+
+
+def validate_positivity_threshold(positivity_threshold=None) -> None:
+    """ Raises a ValueError if the positivity threshold is not greater than 0 """
+
+    if positivity_threshold is not None and positivity_threshold <= 0:
+        raise ValueError(f'Positivity threshold must be greater than 0 (got {positivity_threshold})')
+
+
+def validate_thresholds(analysis_type, positivity_threshold=None, bin_edges=None) -> None:
+    """
+    Raises a ValueError if thresholds can not be used for the given analysis: with the Count analysis, the positivity
+    threshold must be lower than the H-score bin edges (the default ones if None)
+    """
+
+    validate_positivity_threshold(positivity_threshold)
+
+    if bin_edges is not None and analysis_type != 'Count':
+        raise ValueError('H-score bin edges can only be used with the Count analysis')
+    if analysis_type != 'Count':
+        return
+
+    threshold = DEFAULT_POSITIVITY_THRESHOLDS[analysis_type] if positivity_threshold is None else positivity_threshold
+    if bin_edges is None:
+        if threshold >= DEFAULT_BIN_EDGES[0]:
+            raise ValueError(f'Positivity threshold must be lower than the first default H-score bin edge '
+                             f'{DEFAULT_BIN_EDGES[0]} (got {threshold}), set higher bin edges')
+        return
+
+    edges = [threshold] + list(bin_edges)
+    if len(bin_edges) != len(DEFAULT_BIN_EDGES) or any(low >= high for low, high in zip(edges[:-1], edges[1:])):
+        raise ValueError(f'H-score bin edges must be {len(DEFAULT_BIN_EDGES)} increasing values greater than the '
+                         f'positivity threshold (got {list(bin_edges)} with threshold {threshold})')
+
+
+#######################
+#       OUTPUT        #
+#######################
+
+# Libraries writing the .xlsx file: openpyxl serializes the whole workbook at once, XlsxWriter streams it sheet by sheet
+XLSX_BACKENDS = ('openpyxl', 'xlsxwriter')
+
+# Layouts of the workbook: one sheet per sample, or one data sheet and one analysis sheet for every sample
+LAYOUTS = ('sheets', 'long')
+
+# Columnar formats the tables can be exported to, with their file extension (Arrow IPC file = Feather v2)
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow', 'csv': '.csv'}
+
+# Formats written with pyarrow, which is an optional dependency
+PYARROW_FORMATS = ('parquet', 'arrow')
+
+
+def has_pyarrow() -> bool:
+    # look the package up without importing it
+    return find_spec('pyarrow') is not None
+
+
+def validate_formats(formats) -> None:
+    """ Raises a ValueError for unknown formats, an ImportError if pyarrow is needed but not installed """
+
+    unknown = [fmt for fmt in formats if fmt not in EXPORT_FORMATS]
+    if unknown:
+        raise ValueError(f'Unknown export formats: {", ".join(unknown)} (expected: {", ".join(EXPORT_FORMATS)})')
+
+    if any(fmt in PYARROW_FORMATS for fmt in formats) and not has_pyarrow():
+        raise ImportError('Parquet and Arrow exports require pyarrow: pip install pyarrow')
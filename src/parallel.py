@@ -0,0 +1,312 @@
+import math
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from typing import Iterator
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import pandas as pd
+import xlsxwriter
+
+import src.core as core
+import src.analysis as analysis
+import src.parsing as parsing
+import src.formatting as formatting
+import src.copositivity as copositivity
+import src.streaming as streaming
+
+
+# Sample sheets built in a pool of processes are written by the workers as finished worksheet XML parts (see
+# streaming.SHEET_PART): the parent process only zips them, with the workbook, styles and content types parts of a
+# workbook of empty sample sheets. Cells refer to their formats by index: workers add the formats they use to a table
+# shared by the pool before writing, and the parent creates the formats of the table in the same order.
+
+
+#######################
+#       SETTINGS      #
+#######################
+
+# Samples are sent to the workers in batches, several batches per process to balance samples of uneven sizes
+BATCHES_PER_PROCESS = 4
+
+# Batches submitted ahead of the one being written, per process: bounds the rendered sheets waiting in memory
+PENDING_BATCHES_PER_PROCESS = 2
+
+# Sheets written in constant_memory mode have inline strings, their XML can be moved to another workbook
+WORKBOOK_OPTIONS = {'constant_memory': True}
+
+
+#######################
+#       WORKERS       #
+#######################
+
+
+def get_batches(samples, processes) -> list[list]:
+    size = max(1, math.ceil(len(samples) / (processes * BATCHES_PER_PROCESS)))
+    return [samples[i:i + size] for i in range(0, len(samples), size)]
+
+
+def render_samples(files_attributes, channels_dict, analysis_type, n_channels, output_mode='formulas',
+                   positivity_threshold=None, bin_edges=None) -> tuple[list[dict], dict]:
+    """
+    Runs every sheet stage of the serial pipeline on a batch of samples, in a private in-memory workbook.
+    Files not read yet are read here. Returns the rendered sample sheets (see streaming.render_worksheet) and
+    the merged data.
+    """
+
+    writer = pd.ExcelWriter(BytesIO(), engine='openpyxl')
+    add_copositivity = copositivity.has_copositivity(n_channels)
+    _, sheet_template = core.get_templates(n_channels=n_channels, analysis_type=analysis_type.lower())
+    _, copositivity_sheet_template = core.get_copositivity_templates(analysis_type=analysis_type.lower())
+
+    # the summary sheet created by the merge is left empty, it is rendered once by the parent process
+    sheets, data, file_channels, _ = core.merge_image_channels(files_attributes=files_attributes,
+                                                                     channels_dict=channels_dict, writer=writer,
+                                                                     file_name=None, column_name=analysis_type)
+
+    analysis_results = None
+    if output_mode == 'values':
+        analysis_results = analysis.compute_analysis(data, analysis_type=analysis_type,
+                                                     positivity_threshold=positivity_threshold, bin_edges=bin_edges)
+
+    parsing.copy_columns_style(writer=writer, filename=None, sheets=sheets, sheet_template=sheet_template)
+    parsing.rename_channels_from_settings(writer=writer, file_channels=file_channels)
+    analysis_end = parsing.parse_analysis_template(writer=writer, filename=None, sheets=sheets,
+                                                   file_channels=file_channels, analysis_type=analysis_type,
+                                                   add_copositivity=add_copositivity, sheet_template=sheet_template,
+                                                   analysis=analysis_results)
+
+    if add_copositivity:
+        copositivity.parse_copositivity_template(writer=writer, filename=None, sheets=sheets,
+                                                 file_channels=file_channels, data=data, analysis_end=analysis_end,
+                                                 template_file=copositivity_sheet_template,
+                                                 positivity_threshold=positivity_threshold, output_mode=output_mode,
+                                                 analysis_type=analysis_type)
+
+    formatting.resize_analysis_columns(writer, sheets, n_channels=len(channels_dict))
+    formatting.resize_rows(writer, sheets)
+
+    styles = {}
+    renders = [streaming.render_worksheet(writer.sheets[sheet], styles) for sheet in sheets]
+
+    return renders, data
+
+
+def register_formats(renders, format_table) -> tuple[list[tuple], list[tuple]]:
+    """
+    Adds the formats used by the renders and missing from the format table shared by the pool: (lock, cell formats,
+    conditional formats) in the order they were first registered. Returns the formats of the table, the renders
+    formats are among them and keep their index once the table grows (see streaming.set_format_indexes).
+    """
+
+    lock, shared_cell_formats, shared_conditional_formats = format_table
+    cell_formats = dict.fromkeys(properties for render in renders for *_, properties in render['cells']
+                                 if properties is not None)
+    conditional_formats = dict.fromkeys(options['format'] for render in renders
+                                        for _, options in render['conditional_formats'] if 'format' in options)
+
+    with lock:
+        for shared_formats, formats in ((shared_cell_formats, cell_formats),
+                                        (shared_conditional_formats, conditional_formats)):
+            registered = set(shared_formats)
+            shared_formats.extend([properties for properties in formats if properties not in registered])
+        return list(shared_cell_formats), list(shared_conditional_formats)
+
+
+def write_samples(files_attributes, format_table, **kwargs) -> tuple[list[tuple[str, bytes]], dict]:
+    """
+    Renders a batch of samples (see render_samples) and writes their sheets as worksheet XML parts, cells referring to
+    the formats of the shared format table by index (see register_formats). Returns the (title, sheet part) of each
+    sample sheet and the merged data.
+    """
+
+    renders, data = render_samples(files_attributes, **kwargs)
+    cell_formats, conditional_formats = register_formats(renders, format_table)
+
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, WORKBOOK_OPTIONS)
+    formats = {}
+    streaming.set_format_indexes(workbook, cell_formats, conditional_formats, formats)
+
+    # the first sheet is selected when the workbook is opened: the summary is the first sheet of every workbook
+    workbook.add_worksheet('summary')
+    for render in renders:
+        streaming.write_worksheet(workbook, render, formats)
+    workbook.close()
+
+    with ZipFile(output) as zip_file:
+        streaming.check_sheets_parts(zip_file)
+        parts = [(render['title'], zip_file.read(streaming.SHEET_PART.format(index)))
+                 for index, render in enumerate(renders, start=2)]
+
+    return parts, data
+
+
+def render_summary(samples, file_channels, analysis_type) -> dict:
+    """ Rendered summary sheet, which only depends on the samples names and the channels of the files read """
+
+    n_channels = max(len(channels) for channels in file_channels.values())
+    writer = pd.ExcelWriter(BytesIO(), engine='openpyxl')
+    summary_template, _ = core.get_templates(n_channels=n_channels, analysis_type=analysis_type.lower())
+    copositivity_summary_template, _ = core.get_copositivity_templates(analysis_type=analysis_type.lower())
+
+    summary_ws = writer.book.create_sheet('summary')
+    for row, sample in enumerate(samples, start=3):
+        summary_ws[f'A{row}'] = sample
+
+    parsing.parse_summary_template(writer=writer, filename=None, file_channels=file_channels,
+                                   analysis_type=analysis_type, summary_template=summary_template)
+
+    if copositivity.has_copositivity(n_channels):
+        copositivity.parse_copositivity_summary(writer=writer, filename=None, n_channels=n_channels,
+                                                file_channels=file_channels, analysis_type=analysis_type,
+                                                summary_template=copositivity_summary_template)
+
+    formatting.resize_summary_columns(writer)
+
+    return streaming.render_worksheet(summary_ws, {})
+
+
+#######################
+#        MAIN         #
+#######################
+
+
+def iter_batches(worker, files_attributes, processes) -> Iterator[tuple]:
+    """ Yields worker(batch) for each batch of samples, in the samples order. Batches are run in a pool of processes,
+        a few batches ahead of the one being consumed, each process reading its own files """
+
+    batches = ({sample: files_attributes[sample] for sample in batch}
+               for batch in get_batches(list(files_attributes), processes))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque(executor.submit(worker, batch)
+                        for batch in itertools.islice(batches, processes * PENDING_BATCHES_PER_PROCESS))
+        while pending:
+            result = pending.popleft().result()
+            for batch in itertools.islice(batches, 1):
+                pending.append(executor.submit(worker, batch))
+            yield result
+
+
+def iter_renders(files_attributes, channels_dict, processes=1, jobs=1, **kwargs):
+    """
+    Yields the rendered sheets and merged data of each batch of samples (see render_samples), in the samples order.
+    Batches are rendered in a pool of processes (see iter_batches). Or one sample at a time in this process, jobs
+    threads reading the files of the next samples.
+    """
+
+    worker = partial(render_samples, channels_dict=channels_dict, **kwargs)
+
+    if processes <= 1:
+        for sample, channels_per_image in core.iter_sample_files(files_attributes, jobs=jobs,
+                                                                 column_name=kwargs['analysis_type']):
+            yield worker({sample: channels_per_image})
+        return
+
+    yield from iter_batches(worker, files_attributes, processes)
+
+
+def stream_rendered_sheets(filename, files_attributes, channels_dict, jobs=1, progress=None, **kwargs):
+    """ Writes the sheets rendered in this process (see stream_workbook), cell by cell """
+
+    samples = list(files_attributes)
+    workbook = xlsxwriter.Workbook(filename, WORKBOOK_OPTIONS)
+    formats = {}
+
+    # the summary stays the first sheet, it is written once every sample is read
+    summary_ws = workbook.add_worksheet('summary')
+    file_channels = {}
+
+    step, steps = 0, len(samples)
+    for batch_renders, batch_data in iter_renders(files_attributes, channels_dict, jobs=jobs, **kwargs):
+        for render in batch_renders:
+            streaming.write_worksheet(workbook, render, formats)
+
+        if progress:
+            step += len(batch_renders)
+            progress(step / steps, f'Writing file: [{step}/{steps}]')
+
+        for sample, df in batch_data.items():
+            file_channels[sample] = core.get_sample_channels(df.columns, channels_dict)
+            yield sample, df
+
+    streaming.write_worksheet(workbook, render_summary(samples, file_channels, kwargs['analysis_type']), formats,
+                              destination_ws=summary_ws)
+    workbook.close()
+
+
+def stream_sheets_parts(filename, files_attributes, channels_dict, processes, progress=None, **kwargs):
+    """
+    Zips the sheets parts written by the pool of processes (see write_samples) as they come, then the parts of a
+    workbook of empty sample sheets, with the summary and the formats of the shared format table.
+    """
+
+    samples = list(files_attributes)
+    file_channels, titles = {}, []
+
+    with multiprocessing.Manager() as manager, ZipFile(filename, 'w', compression=ZIP_DEFLATED) as output_zip:
+        format_table = (manager.Lock(), manager.list(), manager.list())
+        worker = partial(write_samples, format_table=format_table, channels_dict=channels_dict, **kwargs)
+
+        # sample sheets follow the summary (sheet1.xml)
+        step, steps = 0, len(samples)
+        for batch_parts, batch_data in iter_batches(worker, files_attributes, processes):
+            for title, part in batch_parts:
+                titles.append(title)
+                streaming.write_part(output_zip, streaming.SHEET_PART.format(len(titles) + 1), part)
+
+            if progress:
+                step += len(batch_parts)
+                progress(step / steps, f'Writing file: [{step}/{steps}]')
+
+            for sample, df in batch_data.items():
+                file_channels[sample] = core.get_sample_channels(df.columns, channels_dict)
+                yield sample, df
+
+        output = BytesIO()
+        workbook = xlsxwriter.Workbook(output, WORKBOOK_OPTIONS)
+        formats = {}
+        streaming.set_format_indexes(workbook, list(format_table[1]), list(format_table[2]), formats)
+
+        summary_ws = workbook.add_worksheet('summary')
+        for title in titles:
+            workbook.add_worksheet(title)
+        streaming.write_worksheet(workbook, render_summary(samples, file_channels, kwargs['analysis_type']), formats,
+                                  destination_ws=summary_ws)
+        workbook.close()
+
+        written = set(output_zip.namelist())
+        with ZipFile(output) as workbook_zip:
+            for info in workbook_zip.infolist():
+                if info.filename not in written:
+                    output_zip.writestr(info, workbook_zip.read(info))
+
+
+def stream_workbook(filename, files_attributes, channels_dict, analysis_type, processes=1, jobs=1,
+                    output_mode='formulas', positivity_threshold=None, bin_edges=None, progress=None):
+    """
+    Builds the sample sheets one sample at a time (or one batch per task in a pool of processes) and streams them to
+    disk with XlsxWriter, in the samples order. Sheets have the same cells and styles as the serial pipeline ones.
+    Samples built in this process are written cell by cell, the ones built in a pool of processes are written by
+    the workers, this process only zips their sheets (see stream_sheets_parts).
+    Only the samples being rendered or written are held in memory. The summary is written last, from the channels
+    of the files which could be read.
+
+    Output: generator yielding the merged data (sample, dataframe) of each sample once written
+    """
+
+    # templates are chosen before any file is read, from the channels of the indexed files
+    n_channels = max(len(core.get_sample_channels(channels_per_image, channels_dict))
+                     for channels_per_image in files_attributes.values())
+    kwargs = dict(analysis_type=analysis_type, n_channels=n_channels, output_mode=output_mode,
+                  positivity_threshold=positivity_threshold, bin_edges=bin_edges)
+
+    if processes > 1:
+        yield from stream_sheets_parts(filename, files_attributes, channels_dict, processes, progress=progress,
+                                       **kwargs)
+    else:
+        yield from stream_rendered_sheets(filename, files_attributes, channels_dict, jobs=jobs, progress=progress,
+                                          **kwargs)
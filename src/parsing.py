@@ -1,12 +1,40 @@
 import os
+import math
 from copy import copy
+from functools import lru_cache
 
 import openpyxl
-import streamlit as st
 from openpyxl.formatting.rule import ColorScaleRule, CellIsRule
 from openpyxl.styles import PatternFill
+from openpyxl.styles.cell_style import StyleArray
 from openpyxl.utils import get_column_letter
 
+import src.bundles as bundles
+
+
+#######################
+#      TEMPLATES      #
+#######################
+
+
+@lru_cache(maxsize=bundles.TEMPLATE_CACHE_SIZE)
+def read_template(template_path: str, mtime: float) -> openpyxl.Workbook:
+    """ Parses a template workbook, cached by path and modification time so that an edited template is reloaded """
+    return openpyxl.load_workbook(template_path)
+
+
+def load_template(template: str):
+    """ Returns the first sheet of a template (path relative to src/), parsed once per process.
+        Templates are read from the precompiled bundle when it is up to date (see src/bundles.py), from the .xlsx
+        file otherwise. The sheet is shared between runs and must only be read """
+    template_path = os.path.join(os.path.dirname(__file__), template)
+    mtime = os.path.getmtime(template_path)
+
+    template_ws = bundles.read_template(template, mtime)
+    if template_ws is None:
+        template_ws = read_template(template_path, mtime).worksheets[0]
+    return template_ws
+
 
 #######################
 #   UTILS FUNCTIONS   #
@@ -23,14 +51,41 @@ def copy_cell_style(template_cell, destination_cell):
     return
 
 
+def get_style_key(template_cell):
+    """ Identifies the style of a template cell: bundle style, or style array of the template workbook """
+    return template_cell.style if isinstance(template_cell, bundles.TemplateCell) else tuple(template_cell._style)
+
+
+def stamp_cell_style(template_cell, destination_cell, styles):
+    """ Each template style is copied once into the destination workbook, the cells sharing it are then stamped with
+        the resulting style ids. styles: {template style : style array} cache of a single destination workbook """
+    key = get_style_key(template_cell)
+    if key in styles:
+        destination_cell._style = StyleArray(styles[key])
+    else:
+        copy_cell_style(template_cell, destination_cell)
+        styles[key] = StyleArray(destination_cell._style)
+    return
+
+
 def copy_cell_value(template_cell, destination_cell):
     destination_cell.value = template_cell.value
     return
 
 
-def copy_cells(template_ws, destination_ws, template_col, destination_col, row, copy_value, copy_style):
-    # reading cell value from template file
-    template_cell = template_ws.cell(row=row, column=template_col)
+def get_template_row(template_max_row, row, last_row=None):
+    """ The last template row closes the table: it is only used for the last row of the data (last_row), the other
+        rows past the template body repeat its last body row.
+        template_max_row is read once by the caller: max_row scans every cell of openpyxl worksheets """
+    if row == last_row:
+        return template_max_row
+    return row if row < template_max_row else template_max_row - 1
+
+
+def copy_cells(template_ws, destination_ws, template_col, destination_col, row, copy_value, copy_style,
+               template_row=None, styles=None):
+    # reading cell value from template file (same row as destination unless specified)
+    template_cell = template_ws.cell(row=template_row or row, column=template_col)
 
     # destination cell
     destination_cell = destination_ws.cell(row=row, column=destination_col)
@@ -41,25 +96,84 @@ def copy_cells(template_ws, destination_ws, template_col, destination_col, row,
 
     # copy template cell style
     if copy_style and template_cell.has_style:
-        copy_cell_style(template_cell, destination_cell)
+        if styles is None:
+            copy_cell_style(template_cell, destination_cell)
+        else:
+            stamp_cell_style(template_cell, destination_cell, styles)
 
     return
 
 
+def iter_style_runs(template_ws, template_col, start_row, end_row, template_max_row, last_row=None):
+    """ Groups the destination rows start_row..end_row of a column into runs stamped from template cells sharing a
+        style: yields (first row, last row, template cell). Template cells are only read up to the template body, the
+        rows past it repeat its last body row (see get_template_row) and form a single run whatever the data size """
+    body_end = min(end_row, template_max_row - 1)
+    rows = [(row, row, get_template_row(template_max_row, row, last_row)) for row in range(start_row, body_end + 1)]
+    repeat_start = max(start_row, template_max_row)
+    repeat_end = end_row - 1 if last_row == end_row else end_row
+    if repeat_start <= repeat_end:
+        rows.append((repeat_start, repeat_end, template_max_row - 1))
+    if last_row is not None and max(start_row, template_max_row) <= last_row <= end_row:
+        rows.append((last_row, last_row, template_max_row))
+
+    run = None
+    for first, last, template_row in rows:
+        template_cell = template_ws.cell(row=template_row, column=template_col)
+        key = get_style_key(template_cell) if template_cell.has_style else None
+        if run is not None and run[3] == key and run[1] == first - 1:
+            run[1] = last
+            continue
+        if run is not None:
+            yield tuple(run[:3])
+        run = [first, last, template_cell, key]
+    if run is not None:
+        yield tuple(run[:3])
+
+
+def stamp_rows_style(template_cell, destination_ws, column, start_row, end_row, styles):
+    """ Stamps the rows start_row..end_row of a destination column with the style of a template cell, resolved once
+        for the whole range. openpyxl keeps a style per cell (and Excel ignores the column style of written cells):
+        the resolved style array is copied to each cell """
+    if not template_cell.has_style:
+        # the cells are still created: they count in the sheet dimensions
+        for row in range(start_row, end_row + 1):
+            destination_ws.cell(row=row, column=column)
+        return
+    stamp_cell_style(template_cell, destination_ws.cell(row=start_row, column=column), styles)
+    style = styles[get_style_key(template_cell)]
+    for row in range(start_row + 1, end_row + 1):
+        destination_ws.cell(row=row, column=column)._style = StyleArray(style)
+    return
+
+
 def copy_from_template(template_ws, destination_ws, start_row, end_row, template_start_col, template_end_col,
-                       destination_start_col, destination_end_col, copy_value=True, copy_style=True):
-    for row in range(start_row, end_row + 1):
-        # copy to different columns
-        if (template_start_col != destination_start_col) or (template_end_col != destination_end_col):
-            for destination_col, template_col in zip(range(template_start_col, template_end_col + 1),
-                                                     range(destination_start_col, destination_end_col + 1)):
-                copy_cells(template_ws, destination_ws, template_col=template_col, destination_col=destination_col,
-                           row=row, copy_value=copy_value, copy_style=copy_style)
-        # copy to same columns
-        else:
-            for col in range(template_start_col, template_end_col + 1):
-                copy_cells(template_ws, destination_ws, template_col=col, destination_col=col, row=row,
-                           copy_value=copy_value, copy_style=copy_style)
+                       destination_start_col, destination_end_col, copy_value=True, copy_style=True, styles=None,
+                       last_row=None):
+    # template styles resolved in the destination workbook, shared with the caller when given
+    # last_row: last data row, stamped from the last template row (see get_template_row)
+    styles = {} if styles is None else styles
+    template_max_row = template_ws.max_row
+
+    # copy to different columns
+    if (template_start_col != destination_start_col) or (template_end_col != destination_end_col):
+        columns = zip(range(destination_start_col, destination_end_col + 1),
+                      range(template_start_col, template_end_col + 1))
+    # copy to same columns
+    else:
+        columns = ((col, col) for col in range(template_start_col, template_end_col + 1))
+
+    for template_col, destination_col in columns:
+        if copy_value:
+            for row in range(start_row, end_row + 1):
+                template_row = get_template_row(template_max_row, row, last_row)
+                copy_cell_value(template_ws.cell(row=template_row, column=template_col),
+                                destination_ws.cell(row=row, column=destination_col))
+        # each run of rows sharing a template style is stamped at once
+        if copy_style:
+            for first, last, template_cell in iter_style_runs(template_ws, template_col, start_row, end_row,
+                                                              template_max_row, last_row):
+                stamp_rows_style(template_cell, destination_ws, destination_col, first, last, styles)
     return
 
 
@@ -98,27 +212,48 @@ def get_channel_color(index):
     return channel_mappings.get(index, None)
 
 
+def get_sheet_reference(sheet, cell):
+    """ Direct (non-volatile) reference to a cell of another sheet, e.g. ='Image 1'!C10 """
+    sheet = sheet.replace("'", "''")
+    return f"='{sheet}'!{cell}"
+
+
 ##############################
 #   PARSE SUMMARY TEMPLATE   #
 ##############################
 
 
-def parse_summary_template(writer, filename, file_channels, summary_template: str):
+def parse_summary_template(writer, filename, file_channels, analysis_type, summary_template: str, checkpoint=False):
     workbook = writer.book
     destination_ws = writer.sheets['summary']
     max_rowdata = destination_ws.max_row
 
     # Open the template file
-    template_rel_path = os.path.join(os.path.dirname(__file__), summary_template)
-    template_wb = openpyxl.load_workbook(template_rel_path)
-    template_ws = template_wb.worksheets[0]
+    template_ws = load_template(summary_template)
+    styles = {}  # template styles resolved once in the output workbook
 
-    # copy template analysis
+    # copy template analysis: header values, style only for the samples rows (references are written below)
     n_channels = max([len(channels) for channels in file_channels.values()])
 
-    copy_from_template(template_ws, destination_ws, start_row=1, end_row=max_rowdata,
+    copy_from_template(template_ws, destination_ws, start_row=1, end_row=2,
                        template_start_col=2, template_end_col=4 * n_channels,
-                       destination_start_col=2, destination_end_col=4 * n_channels)
+                       destination_start_col=2, destination_end_col=4 * n_channels, styles=styles)
+
+    copy_from_template(template_ws, destination_ws, start_row=3, end_row=max_rowdata,
+                       template_start_col=2, template_end_col=4 * n_channels,
+                       destination_start_col=2, destination_end_col=4 * n_channels,
+                       copy_value=False, copy_style=True, styles=styles, last_row=max_rowdata)
+
+    # fetch each channel statistics (% positive cells, H-score/total area, average) from the sample sheets:
+    # 'Total' line of the Count analysis, positive ('>0') line of the Area analysis
+    for row in range(3, max_rowdata + 1):
+        sample = destination_ws.cell(row, 1).value
+        if sample is None:
+            continue
+        for n in range(n_channels):
+            sheet_row = 10 + 8 * n if analysis_type == 'Count' else 6 + 5 * n
+            for col, sheet_col in enumerate('CDE', start=(4 * n) + 2):
+                destination_ws.cell(row, col).value = get_sheet_reference(sample, f'{sheet_col}{sheet_row}')
 
     # Add channels name to summary header
     chans = {}
@@ -134,8 +269,9 @@ def parse_summary_template(writer, filename, file_channels, summary_template: st
         cell = destination_ws.cell(1, col)
         cell.value = name
 
-    # save file
-    workbook.save(filename)
+    # save intermediate file
+    if checkpoint:
+        workbook.save(filename)
     return
 
 
@@ -144,35 +280,34 @@ def parse_summary_template(writer, filename, file_channels, summary_template: st
 ##############################
 
 
-def copy_columns_style(writer, filename, sheets, sheet_template: str):
+def copy_columns_style(writer, filename, sheets, sheet_template: str, checkpoint=False):
     """
     Copy style from template for data columns (merged from input files)
     """
 
     # Open the template file
-    template_rel_path = os.path.join(os.path.dirname(__file__), sheet_template)
-    template_wb = openpyxl.load_workbook(template_rel_path)
-    template_ws = template_wb.worksheets[0]
+    template_ws = load_template(sheet_template)
+    styles = {}  # template styles resolved once in the output workbook
 
     workbook = writer.book
 
     for sheet in sheets:
 
         destination_ws = writer.sheets[sheet]
-        max_rowdata = max(destination_ws.max_row, 50)
+        max_rowdata = destination_ws.max_row
         max_coldata = destination_ws.max_column
         min_coldata = destination_ws.min_column
 
         # copy template RNAscope header
         copy_from_template(template_ws, destination_ws, start_row=1, end_row=2,
                            template_start_col=min_coldata, template_end_col=max_coldata,
-                           destination_start_col=min_coldata, destination_end_col=max_coldata)
+                           destination_start_col=min_coldata, destination_end_col=max_coldata, styles=styles)
 
         # format RNAscope columns
         copy_from_template(template_ws, destination_ws, start_row=3, end_row=max_rowdata,
                            template_start_col=min_coldata, template_end_col=max_coldata,
                            destination_start_col=min_coldata, destination_end_col=max_coldata,
-                           copy_value=False, copy_style=True)
+                           copy_value=False, copy_style=True, styles=styles, last_row=max_rowdata)
 
         for i, col in enumerate(range(min_coldata + 1, max_coldata + 1), start=1):
             color = get_channel_color(i)
@@ -181,25 +316,29 @@ def copy_columns_style(writer, filename, sheets, sheet_template: str):
                                        col_end=get_column_letter(col),
                                        end_color=color)
 
-        # copy blank column
-        copy_from_template(template_ws=template_ws, destination_ws=destination_ws, start_row=1, end_row=max_rowdata,
+        # copy blank column (separator spans at least the first 50 rows for samples with few cells)
+        copy_from_template(template_ws=template_ws, destination_ws=destination_ws, start_row=1,
+                           end_row=max(max_rowdata, 50),
                            template_start_col=6, template_end_col=6,
                            destination_start_col=max_coldata + 1, destination_end_col=max_coldata + 1,
-                           copy_value=False, copy_style=True)
+                           copy_value=False, copy_style=True, styles=styles)
 
-    workbook.save(filename)
+    if checkpoint:
+        workbook.save(filename)
     return
 
 
-def parse_analysis_template(writer, filename, sheets, file_channels, analysis_type, add_copositivity, sheet_template: str):
-    """ Copy template to analyse image data - e.g. %Cell, H-score, etc """
+def parse_analysis_template(writer, filename, sheets, file_channels, analysis_type, add_copositivity,
+                            sheet_template: str, analysis=None, checkpoint=False):
+    """ Copy template to analyse image data - e.g. %Cell, H-score, etc
+        If analysis results are given (see src.analysis), they are written as values instead of formulas """
 
     analysis_end = {}
+    analysis_per_sample = dict(tuple(analysis.groupby('Sample', sort=False))) if analysis is not None else {}
 
     # Open the template file
-    template_rel_path = os.path.join(os.path.dirname(__file__), sheet_template)
-    template_wb = openpyxl.load_workbook(template_rel_path)
-    template_ws = template_wb.worksheets[0]
+    template_ws = load_template(sheet_template)
+    styles = {}  # template styles resolved once in the output workbook
 
     workbook = writer.book
 
@@ -215,7 +354,7 @@ def parse_analysis_template(writer, filename, sheets, file_channels, analysis_ty
         # copy template analysis
         copy_from_template(template_ws, destination_ws, start_row=1, end_row=end_row,
                            template_start_col=1, template_end_col=6,
-                           destination_start_col=1, destination_end_col=6)
+                           destination_start_col=1, destination_end_col=6, styles=styles)
 
         # copy image data channel header into analysis part
         for n in range(n_channels):
@@ -229,15 +368,76 @@ def parse_analysis_template(writer, filename, sheets, file_channels, analysis_ty
                 # do nothing
                 continue
 
+        if sheet in analysis_per_sample:
+            write_analysis_values(destination_ws, analysis_per_sample[sheet], analysis_type)
+
         analysis_end[sheet] = end_row
 
         if not add_copositivity:
             add_separator(destination_ws, end_row)
 
-    workbook.save(filename)
+    if checkpoint:
+        workbook.save(filename)
     return analysis_end
 
 
+def to_cell_value(value):
+    """ Converts numpy values to python values, empty cell for NaN (i.e. #DIV/0! in the formulas) """
+    value = value.item() if hasattr(value, 'item') else value
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def write_bin_label(destination_ws, row, label):
+    """ Overwrite template bin label, only if thresholds differ from the template ones """
+    cell = destination_ws.cell(row, 1)
+    if str(cell.value) != label:
+        cell.value = label
+
+
+def write_analysis_values(destination_ws, sample_analysis, analysis_type):
+    """ Replace the formulas of the analysis part of a sheet by the values computed by src.analysis """
+
+    # bins columns are found between 'Channel' and 'Total'
+    columns = list(sample_analysis.columns)
+    bin_labels = columns[columns.index('Channel') + 1:columns.index('Total')]
+
+    for n, channel_analysis in enumerate(sample_analysis.to_dict('records')):
+
+        if analysis_type == 'Count':
+            start_row = 3 + n * 8
+            total = channel_analysis['Total']
+            for weight, label in enumerate(bin_labels):
+                row = start_row + 2 + weight
+                percentage = channel_analysis[label] / total * 100 if total else math.nan
+                write_bin_label(destination_ws, row, label)
+                destination_ws.cell(row, 2).value = to_cell_value(channel_analysis[label])
+                destination_ws.cell(row, 3).value = to_cell_value(percentage)
+                destination_ws.cell(row, 4).value = to_cell_value(percentage * weight)
+
+            row = start_row + 7
+            destination_ws.cell(row, 2).value = to_cell_value(total)
+            destination_ws.cell(row, 3).value = to_cell_value(channel_analysis['% Positive Cells'])
+            destination_ws.cell(row, 4).value = to_cell_value(channel_analysis['H-Score'])
+            destination_ws.cell(row, 5).value = to_cell_value(channel_analysis['Avg Dots/Cell'])
+
+        elif analysis_type == 'Area':
+            start_row = 3 + n * 5
+            total = channel_analysis['Total']
+            negative, positive = bin_labels
+            percentage = channel_analysis[negative] / total * 100 if total else math.nan
+            write_bin_label(destination_ws, start_row + 2, negative)
+            destination_ws.cell(start_row + 2, 2).value = to_cell_value(channel_analysis[negative])
+            destination_ws.cell(start_row + 2, 3).value = to_cell_value(percentage)
+
+            write_bin_label(destination_ws, start_row + 3, positive)
+            destination_ws.cell(start_row + 3, 2).value = to_cell_value(channel_analysis[positive])
+            destination_ws.cell(start_row + 3, 3).value = to_cell_value(channel_analysis['% Positive Cells'])
+            destination_ws.cell(start_row + 3, 4).value = to_cell_value(channel_analysis['Total Area'])
+            destination_ws.cell(start_row + 3, 5).value = to_cell_value(channel_analysis['Avg Area/Cell'])
+
+            destination_ws.cell(start_row + 4, 2).value = to_cell_value(total)
+
+
 def rename_channels_from_settings(writer, file_channels):
     """ Attribute correct channel number based on settings file """
 
@@ -256,34 +456,36 @@ def rename_channels_from_settings(writer, file_channels):
 
 
 def main_parsing(writer, filename, sheets, file_channels, add_copositivity, analysis_type, summary_template,
-                 sheet_template, progress_bar=None):
-    # Initialize progress bar
+                 sheet_template, progress=None, analysis=None, checkpoint=False):
+    # Initialize progress
     steps = 3
     step = 0
-    if progress_bar:
-        progress_bar = st.progress(step, text=f"Parsing templates: [{step}/{steps}]")
+    if progress:
+        progress(step, f"Parsing templates: [{step}/{steps}]")
 
     # AURA-macro data table
-    copy_columns_style(writer=writer, filename=filename, sheets=sheets, sheet_template=sheet_template)
+    copy_columns_style(writer=writer, filename=filename, sheets=sheets, sheet_template=sheet_template,
+                       checkpoint=checkpoint)
     rename_channels_from_settings(writer=writer, file_channels=file_channels)
-    if progress_bar:
+    if progress:
         step += 1
-        progress_bar.progress(step / steps, text=f"Parsing templates: [{step}/{steps}]")
+        progress(step / steps, f"Parsing templates: [{step}/{steps}]")
 
     # Analysis template
     analysis_end = parse_analysis_template(writer=writer, filename=filename, sheets=sheets,
                                            add_copositivity=add_copositivity, file_channels=file_channels,
-                                           sheet_template=sheet_template, analysis_type=analysis_type)
-    if progress_bar:
+                                           sheet_template=sheet_template, analysis_type=analysis_type,
+                                           analysis=analysis, checkpoint=checkpoint)
+    if progress:
         step += 1
-        progress_bar.progress(step / steps, text=f"Parsing templates: [{step}/{steps}]")
+        progress(step / steps, f"Parsing templates: [{step}/{steps}]")
 
     # Summary template
     parse_summary_template(writer=writer, filename=filename, file_channels=file_channels,
-                           summary_template=summary_template)
+                           analysis_type=analysis_type, summary_template=summary_template, checkpoint=checkpoint)
 
-    if progress_bar:
+    if progress:
         step += 1
-        progress_bar.progress(step / steps, text=f"Parsing templates: [{step}/{steps}]")
+        progress(step / steps, f"Parsing templates: [{step}/{steps}]")
 
     return analysis_end
@@ -1,16 +1,14 @@
 import os
 from pathlib import Path
-from typing import IO, Tuple, Dict, List, Any
 from zipfile import ZipFile
 
 import streamlit as st
-import pandas as pd
-from pandas import DataFrame
 
+import src.aura as aura
 import src.core as core
-import src.parsing as parsing
-import src.formatting as formatting
-import src.copositivity as copositivity
+import src.analysis as analysis
+import src.export as export
+import src.options as options
 
 
 ##############################
@@ -18,77 +16,35 @@ import src.copositivity as copositivity
 ##############################
 
 
-def app_zipfile_handler(input_file: IO[bytes]) -> tuple[dict[str, DataFrame], dict[str, str]]:
-    """
-    Input: .zip files uploaded through stream.file_uploader() -> bytes-like
-    Output:  dictionnary {filename : filedata}
-    """
+def get_progress_callback():
+    """ Progress callback of the processing stages, showing one progress bar per stage """
 
-    files_dict = {}
-    channels = []
+    progress_bars = {}
 
-    zip_file = ZipFile(input_file)
+    def progress(fraction, text):
+        stage = text.split(':')[0]
+        if stage not in progress_bars:
+            progress_bars[stage] = st.progress(fraction, text=text)
+        else:
+            progress_bars[stage].progress(fraction, text=text)
 
-    for file in zip_file.infolist():
+    return progress
 
-        file = file.filename
-        name = Path(file).name
 
-        if file.startswith('.') or file.startswith('_') or file.endswith(os.sep):
-            continue
-
-        if name.endswith('.csv'):
-            files_dict[name] = pd.read_csv(zip_file.open(file))
-
-        if name.startswith('Analysis_Settings') and name.endswith('.txt'):
-            settings_file = zip_file.open(file)
-            channels = core.get_channels_from_settings_file(settings_file)
-
-    return files_dict, channels
-
-
-def app_filename_handler(input_files):
-    """
-    Input: .csv files + .txt file uploaded through stream.file_uploader() -> bytes-like
-    Output:  dictionnary {filename : filedata}
-    """
-
-    files_dict = {}
-    channels = []
-
-    for file in input_files:
-
-        if file.name.endswith('.csv'):
-            files_dict[file.name] = pd.read_csv(file)
-
-        if file.name.startswith('Analysis_Settings') and file.name.endswith('.txt'):
-            channels = core.get_channels_from_settings_file(file)
-
-    return files_dict, channels
-
-
-def process_file_input(input_format, input_data, error_space):
+def process_file_input(input_format, input_data, error_space) -> aura.Experiment:
 
     # Process data based on user-input
-    if input_format == '.zip Folder':
-        files_dict, channels = app_zipfile_handler(input_data)
-    elif input_format == '.csv Files':
-        files_dict, channels = app_filename_handler(input_data)
-    else:
+    if input_format not in ('.zip Folder', '.csv Files'):
         st.error('Files could not be processed - check input and retry')
         st.stop()
 
     # Terminate if no files detected
-    if not files_dict:
+    try:
+        return aura.load_experiment(input_data, on_error=error_space.error, progress=get_progress_callback())
+    except ValueError:
         st.error('Files could not be processed - check input and retry')
         st.stop()
 
-    # Process files attributes
-    progress_bar = st.empty()
-    files_attributes = core.build_files_attributes_dict(files_dict, channels_list=channels, error_space=error_space,
-                                                        progress_bar=progress_bar)
-    return files_attributes, channels
-
 
 ######################
 #   PROCESS OUTPUT   #
@@ -136,51 +92,26 @@ def download_file(filename):
 #####################
 
 
-def process_aura_files(experiment_name: str, input_format: str, uploaded_files: st.file_uploader, analysis_column):
+def process_aura_files(experiment_name: str, input_format: str, uploaded_files: st.file_uploader, analysis_column,
+                       output_mode='formulas', positivity_threshold=None, bin_edges=None, backend='openpyxl',
+                       checkpoint=False, export_formats=()):
     ######################
     ### PROCESSING
+    options.validate_formats(export_formats)
 
     # Process user input
     error_space = st.empty()
-    files_attributes, channels = process_file_input(input_format=input_format, input_data=uploaded_files,
-                                                    error_space=error_space)
-
-    # Create output file
-    writer, filename = core.create_xlsx_file(experiment_name, output_folder='.')
-
-    # Merge AURA tables
-    sheets, data, file_channels, skipped = core.merge_image_channels(files_attributes, channels, writer, filename,
-                                                            progress_bar=True, column_name=analysis_column)
-
-    # Determine if we add co-positivity_analysis
-    n_channels = max([len(i) for i in file_channels.values()])
-    add_copositivity = True if 1 < n_channels < 7 else False
-
-    # get templates
-    summary_template, sheet_template = core.get_templates(n_channels=n_channels, analysis_type=analysis_column.lower())
+    experiment = process_file_input(input_format=input_format, input_data=uploaded_files, error_space=error_space)
 
-    ######################
-    ### PARSING TEMPLATES
-    analysis_end = parsing.main_parsing(writer=writer, filename=filename, sheets=sheets, file_channels=file_channels,
-                                        add_copositivity=add_copositivity, progress_bar=True,
-                                        sheet_template=sheet_template, summary_template=summary_template,
-                                        analysis_type=analysis_column)
-
-    #####################
-    ### COPOSITIVITE
-    if add_copositivity:
-        copositivity.parse_copositivity_template(writer=writer, filename=filename, sheets=sheets,
-                                                 file_channels=file_channels, analysis_end=analysis_end,
-                                                 progress_bar=True, template_file=sheet_template,
-                                                 analysis_type=analysis_column)
+    # Create output file, in a folder downloaded as a .zip file when tables are exported along with it
+    out_path = Path(experiment_name) if export_formats else Path('.')
+    core.create_directory(out_path)
+    filename = os.path.join(out_path, f'{experiment_name}.xlsx')
 
-        copositivity.parse_copositivity_summary(writer=writer, filename=filename, summary_template=summary_template,
-                                                n_channels=n_channels, file_channels=file_channels)
-
-    #####################
-    ### FORMATTING
-    formatting.format_file(writer=writer, filename=filename, sheets=sheets, n_channels=len(channels),
-                           progress_bar=True)
+    # Merge, parse templates, format and write the workbook
+    data, skipped = aura.write_workbook(experiment, filename, analysis_type=analysis_column, output_mode=output_mode,
+                                        positivity_threshold=positivity_threshold, bin_edges=bin_edges,
+                                        backend=backend, checkpoint=checkpoint, progress=get_progress_callback())
 
     if skipped:
         with st.expander('**Warning: potentially missing channels for the following files**', expanded=True):
@@ -197,7 +128,14 @@ def process_aura_files(experiment_name: str, input_format: str, uploaded_files:
 
     #####################
     ## DOWNLOAD RESULTS
-    download_file(f'{experiment_name}.xlsx')
+    if export_formats:
+        analysis_results = analysis.compute_analysis(data, analysis_type=analysis_column,
+                                                     positivity_threshold=positivity_threshold, bin_edges=bin_edges)
+        export.export_results(out_path, experiment_name, data=data, analysis=analysis_results,
+                              formats=export_formats)
+        output_result(experiment_name, out_path)
+    else:
+        download_file(f'{experiment_name}.xlsx')
     return
 
 
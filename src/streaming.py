@@ -0,0 +1,371 @@
+import logging
+from zipfile import ZipInfo, ZIP_DEFLATED
+
+from openpyxl.styles.colors import COLOR_INDEX
+from openpyxl.utils import column_index_from_string
+from openpyxl.worksheet.formula import ArrayFormula
+
+
+#######################
+#       SETTINGS      #
+#######################
+
+# Default Office theme colors, in the order used by the theme index of openpyxl colors (light 1, dark 1, ...)
+THEME_COLORS = ['FFFFFF', '000000', 'E7E6E6', '44546A', '4472C4', 'ED7D31', 'A5A5A5', 'FFC000', '5B9BD5', '70AD47']
+
+# openpyxl style names, listed in the order of the XlsxWriter indexes
+FILL_PATTERNS = [None, 'solid', 'mediumGray', 'darkGray', 'lightGray', 'darkHorizontal', 'darkVertical', 'darkDown',
+                 'darkUp', 'darkGrid', 'darkTrellis', 'lightHorizontal', 'lightVertical', 'lightDown', 'lightUp',
+                 'lightGrid', 'lightTrellis', 'gray125', 'gray0625']
+
+BORDER_STYLES = [None, 'thin', 'medium', 'dashed', 'dotted', 'thick', 'double', 'hair', 'mediumDashed', 'dashDot',
+                 'mediumDashDot', 'dashDotDot', 'mediumDashDotDot', 'slantDashDot']
+
+HORIZONTAL_ALIGNMENTS = {'left': 'left', 'center': 'center', 'right': 'right', 'fill': 'fill', 'justify': 'justify',
+                         'centerContinuous': 'center_across', 'distributed': 'distributed'}
+
+VERTICAL_ALIGNMENTS = {'top': 'top', 'center': 'vcenter', 'bottom': 'bottom', 'justify': 'vjustify',
+                       'distributed': 'vdistributed'}
+
+UNDERLINES = {'single': 1, 'double': 2, 'singleAccounting': 33, 'doubleAccounting': 34}
+
+# XlsxWriter adds the cell padding (5 pixels, for a 7 pixels digit width) to columns width, openpyxl does not
+COLUMN_PADDING = 5 / 7
+
+CELL_IS_OPERATORS = {'greaterThan': '>', 'greaterThanOrEqual': '>=', 'lessThan': '<', 'lessThanOrEqual': '<=',
+                     'equal': '==', 'notEqual': '!=', 'between': 'between', 'notBetween': 'not between'}
+
+# Sheets parts of an .xlsx file, numbered in the sheets order
+# Sheets are moved between workbooks as raw XML, they must only refer to the styles of the workbook, by index (see
+# set_format_indexes). In constant_memory mode XlsxWriter writes strings inline: sheets do not refer to the shared
+# strings table, nor to any other part of the workbook
+SHEET_PART = 'xl/worksheets/sheet{}.xml'
+SHARED_STRINGS_PART = 'xl/sharedStrings.xml'
+SHEET_RELATIONSHIPS = 'xl/worksheets/_rels/'
+
+# Date of the parts written by XlsxWriter, which keeps .xlsx files reproducible
+PART_DATE_TIME = (1980, 1, 31, 0, 0, 0)
+
+
+#######################
+#        STYLES       #
+#######################
+
+
+def get_color(color) -> str | None:
+    """ openpyxl color (rgb, theme or indexed) to XlsxWriter '#RRGGBB' color, alpha channel is ignored """
+
+    if color is None:
+        return None
+    if color.type == 'rgb':
+        return f'#{color.rgb[-6:]}'
+    if color.type == 'theme' and color.theme < len(THEME_COLORS):
+        return f'#{THEME_COLORS[color.theme]}'
+    if color.type == 'indexed' and color.indexed < len(COLOR_INDEX):
+        return f'#{COLOR_INDEX[color.indexed][-6:]}'
+    return None
+
+
+def get_font_properties(font) -> dict:
+    properties = {'font_name': font.name, 'font_size': font.sz, 'bold': font.b, 'italic': font.i,
+                  'font_strikeout': font.strike, 'underline': UNDERLINES.get(font.u),
+                  'font_color': get_color(font.color)}
+    return properties
+
+
+def get_fill_properties(fill) -> dict:
+    if getattr(fill, 'fill_type', None) not in FILL_PATTERNS[1:]:
+        return {}
+
+    # XlsxWriter uses the background color for solid fills
+    if fill.fill_type == 'solid':
+        return {'pattern': 1, 'bg_color': get_color(fill.fgColor)}
+    return {'pattern': FILL_PATTERNS.index(fill.fill_type), 'fg_color': get_color(fill.fgColor),
+            'bg_color': get_color(fill.bgColor)}
+
+
+def get_border_properties(border) -> dict:
+    properties = {}
+    for side in ('left', 'right', 'top', 'bottom'):
+        border_side = getattr(border, side)
+        if border_side is None or border_side.style not in BORDER_STYLES[1:]:
+            continue
+        properties[side] = BORDER_STYLES.index(border_side.style)
+        properties[f'{side}_color'] = get_color(border_side.color)
+    return properties
+
+
+def get_alignment_properties(alignment) -> dict:
+    properties = {'align': HORIZONTAL_ALIGNMENTS.get(alignment.horizontal),
+                  'valign': VERTICAL_ALIGNMENTS.get(alignment.vertical),
+                  'text_wrap': alignment.wrap_text, 'shrink': alignment.shrink_to_fit,
+                  'rotation': alignment.text_rotation, 'indent': alignment.indent}
+    return properties
+
+
+def get_cell_properties(cell, styles) -> tuple | None:
+    """ XlsxWriter format properties of an openpyxl cell, as a hashable tuple shared by the cells of the same style """
+
+    if not cell.has_style:
+        return None
+
+    # cells of the same workbook with identical styles share the same style array
+    key = tuple(cell._style)
+    if key not in styles:
+        properties = get_font_properties(cell.font)
+        properties.update(get_fill_properties(cell.fill))
+        properties.update(get_border_properties(cell.border))
+        properties.update(get_alignment_properties(cell.alignment))
+        if cell.number_format != 'General':
+            properties['num_format'] = cell.number_format
+
+        properties = {name: value for name, value in properties.items() if value}
+        if not cell.protection.locked:
+            properties['locked'] = False
+
+        styles[key] = tuple(sorted(properties.items()))
+
+    return styles[key]
+
+
+def get_format(workbook, properties, formats):
+    """ XlsxWriter format of the given properties, created once per workbook """
+
+    if properties is None:
+        return None
+    if properties not in formats:
+        formats[properties] = workbook.add_format(dict(properties))
+    return formats[properties]
+
+
+def get_format_indexes(formats) -> tuple[list[tuple], list[tuple]]:
+    """ Properties of the cell formats and of the conditional formatting formats, in the order of their indexes """
+
+    cell_formats = sorted((fmt.xf_index, properties) for properties, fmt in formats.items() if fmt.xf_index is not None)
+    conditional_formats = sorted((fmt.dxf_index, properties) for properties, fmt in formats.items()
+                                 if fmt.dxf_index is not None)
+    return [properties for _, properties in cell_formats], [properties for _, properties in conditional_formats]
+
+
+def set_format_indexes(workbook, cell_formats, conditional_formats, formats) -> None:
+    """
+    Creates the formats of a previous workbook with the same indexes (see get_format_indexes), so that sheets of the
+    previous workbook can be copied as is: cells and conditional formatting rules refer to formats by index.
+    Must be called before anything is written, XlsxWriter numbers formats in the order they are first used.
+    """
+
+    for properties in cell_formats:
+        get_format(workbook, properties, formats)._get_xf_index()
+    for properties in conditional_formats:
+        get_format(workbook, properties, formats)._get_dxf_index()
+
+
+##############################
+#   CONDITIONAL FORMATTING   #
+##############################
+
+
+def get_differential_properties(dxf) -> tuple | None:
+    """ Format properties applied by a conditional formatting rule """
+
+    if dxf is None:
+        return None
+
+    properties = {}
+    if dxf.font is not None:
+        properties.update(get_font_properties(dxf.font))
+    if dxf.fill is not None:
+        properties.update(get_fill_properties(dxf.fill))
+    if dxf.border is not None:
+        properties.update(get_border_properties(dxf.border))
+
+    return tuple(sorted((name, value) for name, value in properties.items() if value))
+
+
+def get_color_scale_options(color_scale) -> dict:
+    points = ['min', 'max'] if len(color_scale.cfvo) == 2 else ['min', 'mid', 'max']
+    options = {'type': f'{len(points)}_color_scale'}
+
+    for point, cfvo, color in zip(points, color_scale.cfvo, color_scale.color):
+        options[f'{point}_type'] = cfvo.type
+        options[f'{point}_color'] = get_color(color)
+        if cfvo.val is not None:
+            options[f'{point}_value'] = cfvo.val
+
+    return options
+
+
+def get_rule_options(rule) -> dict | None:
+    """ openpyxl conditional formatting rule to XlsxWriter conditional_format() options, format given as properties """
+
+    if rule.type == 'colorScale':
+        return get_color_scale_options(rule.colorScale)
+
+    if rule.type == 'cellIs' and rule.operator in CELL_IS_OPERATORS:
+        options = {'type': 'cell', 'criteria': CELL_IS_OPERATORS[rule.operator],
+                   'format': get_differential_properties(rule.dxf)}
+        if rule.operator in ('between', 'notBetween'):
+            options['minimum'], options['maximum'] = rule.formula
+        else:
+            options['value'] = rule.formula[0]
+        return options
+
+    if rule.type == 'expression':
+        return {'type': 'formula', 'criteria': f'={rule.formula[0]}',
+                'format': get_differential_properties(rule.dxf)}
+
+    return None
+
+
+def render_conditional_formatting(source_ws) -> list[tuple[str, dict]]:
+    rules = []
+    for conditional_formatting in source_ws.conditional_formatting:
+        ranges = str(conditional_formatting.sqref).split()
+
+        for rule in sorted(conditional_formatting.rules, key=lambda cf_rule: cf_rule.priority):
+            options = get_rule_options(rule)
+
+            if options is None:
+                logging.warning(f'##### UNSUPPORTED CONDITIONAL FORMATTING [{rule.type}] IN SHEET: {source_ws.title}')
+                continue
+
+            if rule.stopIfTrue:
+                options['stop_if_true'] = True
+            if len(ranges) > 1:
+                options['multi_range'] = ' '.join(ranges)
+
+            rules.append((ranges[0], options))
+
+    return rules
+
+
+#######################
+#        RENDER       #
+#######################
+
+
+def render_dimensions(source_ws) -> list[tuple]:
+    """ Columns width and hidden columns, as (first column, last column, width, hidden) """
+
+    columns = []
+    for dimension in source_ws.column_dimensions.values():
+        if dimension.width is None and not dimension.hidden:
+            continue
+        first_col = (dimension.min or column_index_from_string(dimension.index)) - 1
+        last_col = (dimension.max or first_col + 1) - 1
+        width = dimension.width
+        if width and width > 1 + COLUMN_PADDING:
+            width -= COLUMN_PADDING
+        columns.append((first_col, last_col, width, dimension.hidden))
+    return columns
+
+
+def render_cell(cell) -> tuple[str, object]:
+    """ Kind of XlsxWriter write call and value of an openpyxl cell """
+
+    value = cell.value
+
+    if value is None:
+        return 'blank', None
+    if cell.data_type == 'f':
+        if isinstance(value, ArrayFormula):
+            return 'array_formula', (value.ref, value.text)
+        return 'formula', value
+    if cell.data_type == 'n':
+        return 'number', value
+    if cell.data_type == 'b':
+        return 'boolean', value
+    if cell.data_type == 'd':
+        return 'datetime', value
+    return 'string', str(value)
+
+
+def render_worksheet(source_ws, styles) -> dict:
+    """
+    Picklable description of an openpyxl worksheet: columns, rows height, cells (row, column, kind, value, format
+    properties) in row order and conditional formats. Renders built in another process are written with the same
+    formats as the sheets of the writing process.
+    """
+
+    rows = sorted((row - 1, dimension.height) for row, dimension in source_ws.row_dimensions.items()
+                  if dimension.height)
+
+    # iterate over existing cells only (iter_rows() would create every missing cell of the sheet dimension)
+    cells = []
+    for (row, col), cell in sorted(source_ws._cells.items()):
+        if cell.value is None and not cell.has_style:
+            continue
+        cells.append((row - 1, col - 1, *render_cell(cell), get_cell_properties(cell, styles)))
+
+    return {'title': source_ws.title, 'columns': render_dimensions(source_ws), 'rows': rows, 'cells': cells,
+            'conditional_formats': render_conditional_formatting(source_ws)}
+
+
+#######################
+#        WRITE        #
+#######################
+
+
+def write_cell(destination_ws, row, col, kind, value, cell_format):
+    if kind == 'blank':
+        destination_ws.write_blank(row, col, None, cell_format)
+
+    # empty cached results force the spreadsheet to compute formulas when the file is opened
+    elif kind == 'array_formula':
+        destination_ws.write_array_formula(*value, cell_format, '')
+    elif kind == 'formula':
+        destination_ws.write_formula(row, col, value, cell_format, '')
+
+    elif kind == 'number':
+        destination_ws.write_number(row, col, value, cell_format)
+    elif kind == 'boolean':
+        destination_ws.write_boolean(row, col, value, cell_format)
+    elif kind == 'datetime':
+        destination_ws.write_datetime(row, col, value, cell_format)
+    else:
+        destination_ws.write_string(row, col, value, cell_format)
+
+
+def write_worksheet(workbook, render, formats, destination_ws=None):
+    """ Writes a rendered worksheet, row by row, as a new XlsxWriter worksheet or in an empty one """
+
+    if destination_ws is None:
+        destination_ws = workbook.add_worksheet(render['title'])
+
+    for first_col, last_col, width, hidden in render['columns']:
+        destination_ws.set_column(first_col, last_col, width, None, {'hidden': hidden})
+
+    # rows are flushed to disk once the next one is started: heights are set before writing the cells of a row
+    row_heights = list(render['rows'])
+
+    for row, col, kind, value, properties in render['cells']:
+        while row_heights and row_heights[0][0] <= row:
+            height_row, height = row_heights.pop(0)
+            destination_ws.set_row(height_row, height)
+
+        write_cell(destination_ws, row, col, kind, value, get_format(workbook, properties, formats))
+
+    for height_row, height in row_heights:
+        destination_ws.set_row(height_row, height)
+
+    for cell_range, options in render['conditional_formats']:
+        if 'format' in options:
+            options = dict(options, format=get_format(workbook, options['format'], formats))
+        destination_ws.conditional_format(cell_range, options)
+
+
+#######################
+#       PACKAGE       #
+#######################
+
+
+def check_sheets_parts(zip_file) -> None:
+    """ Raises a ValueError if the sheets of an opened .xlsx file refer to shared strings or other parts """
+    if any(name == SHARED_STRINGS_PART or name.startswith(SHEET_RELATIONSHIPS) for name in zip_file.namelist()):
+        raise ValueError(f'Sheets of {zip_file.filename or "the workbook"} refer to other parts of the workbook, they '
+                         f'can not be copied')
+
+
+def write_part(output_zip, name, content) -> None:
+    """ Writes a part to an opened .xlsx file, dated and compressed as the parts written by XlsxWriter """
+    output_zip.writestr(ZipInfo(name, date_time=PART_DATE_TIME), content, compress_type=ZIP_DEFLATED)
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+import src.analysis as analysis
+import src.copositivity as copositivity
+
+
+#######################
+#       LEVELS        #
+#######################
+
+
+def get_threshold_levels(values, thresholds) -> np.ndarray:
+    """
+    Number of (sorted) thresholds each value is greater or equal to: a value is positive at threshold j if its level
+    is > j. Empty cells (NaN) are never positive (level 0).
+    """
+
+    levels = np.searchsorted(thresholds, values, side='right')
+    levels[np.isnan(values)] = 0
+    return levels
+
+
+def count_positive_per_threshold(levels, offsets, n_thresholds) -> np.ndarray:
+    """ Returns a (segments x thresholds) array with the number of cells >= each threshold """
+
+    n_segments = len(offsets) - 1
+    segment_index = np.repeat(np.arange(n_segments), np.diff(offsets))
+
+    histogram = np.bincount(segment_index * (n_thresholds + 1) + levels, minlength=n_segments * (n_thresholds + 1))
+    histogram = histogram.reshape(n_segments, n_thresholds + 1)
+
+    # cells >= threshold j are the cells with a level > j: reversed cumulative sum of the levels histogram
+    return np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+
+#######################
+#       CHANNELS      #
+#######################
+
+
+def sweep_channels(data, analysis_type, thresholds, bin_edges=None) -> pd.DataFrame:
+    """ % positive cells (and H-score for the Count analysis) of every sample x channel at every threshold """
+
+    values, offsets, keys = analysis.concatenate_channels(data)
+
+    levels = get_threshold_levels(values, thresholds)
+    positive = count_positive_per_threshold(levels, offsets, len(thresholds))
+
+    segment_index = np.repeat(np.arange(len(keys)), np.diff(offsets))
+    total = np.bincount(segment_index, weights=~np.isnan(values), minlength=len(keys))[:, None]
+
+    sweep = {'% Positive Cells': analysis.divide(positive, total) * 100}
+
+    if analysis_type == 'Count':
+        # H-score = sum of the bins weights = number of cells above each bin edge: threshold + upper bins edges
+        edges = analysis.get_bin_edges(analysis_type, bin_edges=bin_edges)[1:]
+        upper = analysis.count_bins(values, offsets, edges)
+        above_edges = np.cumsum(upper[:, ::-1], axis=1)[:, ::-1][:, 1:].sum(axis=1)[:, None]
+        h_score = analysis.divide(positive + above_edges, total) * 100
+        # bins are only defined while the threshold stays below the first upper bin edge
+        sweep['H-Score'] = np.where(np.asarray(thresholds) <= edges[0], h_score, np.nan)
+
+    n_thresholds = len(thresholds)
+    result = pd.DataFrame({
+        'Sample': np.repeat([sample for sample, _ in keys], n_thresholds),
+        'Channel': np.repeat([channel for _, channel in keys], n_thresholds),
+        'Threshold': np.tile(thresholds, len(keys)),
+    })
+    for column, array in sweep.items():
+        result[column] = array.ravel()
+
+    return result
+
+
+#######################
+#    CO-POSITIVITY    #
+#######################
+
+
+def sweep_copositivity(data, thresholds) -> pd.DataFrame:
+    """ % co-positive cells of every sample x channels combination at every threshold """
+
+    groups = {}
+    for sample, df in data.items():
+        groups.setdefault(df.shape[1], []).append(sample)
+
+    results = []
+    for n_channels, samples in groups.items():
+
+        if not copositivity.has_copositivity(n_channels):
+            continue
+
+        values = np.concatenate([data[sample].to_numpy(dtype=np.float64) for sample in samples])
+        lengths = [len(data[sample]) for sample in samples]
+        sample_index = np.repeat(np.arange(len(samples)), lengths)
+
+        levels = get_threshold_levels(values, thresholds)
+        weights = 1 << np.arange(n_channels, dtype=np.int64)
+        combinations = copositivity.combine_channels(range(n_channels))
+        combinations_masks = copositivity.get_combinations_masks(n_channels)
+
+        # % co-positive cells are relative to the average number of cells of the combined channels
+        totals = np.stack([np.bincount(sample_index, weights=~np.isnan(values[:, i]), minlength=len(samples))
+                           for i in range(n_channels)], axis=1)
+        denominators = np.stack([totals[:, combination].mean(axis=1) for combination in combinations], axis=1)
+
+        # (samples x combinations x thresholds)
+        counts = np.stack([copositivity.count_copositive_cells((levels > j).astype(np.int64) @ weights,
+                                                               sample_index, len(samples),
+                                                               n_channels)[:, combinations_masks]
+                           for j in range(len(thresholds))], axis=2)
+        fractions = analysis.divide(counts, denominators[:, :, None]) * 100
+
+        for i, sample in enumerate(samples):
+            channels = list(data[sample].columns)
+            names = ['+'.join(channels[k] for k in combination) for combination in combinations]
+            results.append(pd.DataFrame({
+                'Sample': sample,
+                'Channel': np.repeat(names, len(thresholds)),
+                'Threshold': np.tile(thresholds, len(names)),
+                '% Positive Cells': fractions[i].ravel(),
+            }))
+
+    columns = ['Sample', 'Channel', 'Threshold', '% Positive Cells']
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=columns)
+
+
+#######################
+#        MAIN         #
+#######################
+
+
+def compute_threshold_sweep(data, analysis_type, thresholds, bin_edges=None) -> pd.DataFrame:
+    """
+    Evaluates % positive cells, H-score (Count analysis) and % co-positive cells over a grid of positivity
+    thresholds, without re-running the analysis for each threshold.
+
+    Input: {sample : dataframe} dictionary as returned by core.merge_image_channels
+    Output: tidy table, one row per sample x channel (or channels combination) x threshold
+    """
+
+    # thresholds may exceed the bin edges, the H-score is then not defined
+    analysis.validate_thresholds(analysis_type, bin_edges=bin_edges)
+    for threshold in thresholds:
+        analysis.validate_positivity_threshold(threshold)
+
+    thresholds = np.unique(np.asarray(thresholds, dtype=np.float64))
+
+    channels_sweep = sweep_channels(data, analysis_type, thresholds, bin_edges=bin_edges)
+    copositivity_sweep = sweep_copositivity(data, thresholds)
+
+    # keep samples in input order, channels before their combinations
+    sweep = pd.concat([channels_sweep, copositivity_sweep], ignore_index=True)
+    sample_order = {sample: i for i, sample in enumerate(data)}
+    sweep = sweep.sort_values('Sample', key=lambda samples: samples.map(sample_order), kind='stable')
+
+    return sweep.reset_index(drop=True)
@@ -0,0 +1,114 @@
+import os
+import time
+import logging
+
+import src.core as core
+import src.options as options
+
+
+#######################
+#        FILES        #
+#######################
+
+
+def scan_folder(input_folder) -> dict[str, tuple[int, int]]:
+    """ {filename : (size, modification time)} of the .csv files of a folder """
+
+    files = {}
+    with os.scandir(input_folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.csv'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # removed while scanning
+                continue
+            files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+    return files
+
+
+def wait_for_settings(input_folder, interval=options.WATCH_INTERVAL) -> dict[str, str]:
+    """ Channels of the Analysis_Settings.txt file, once it is written """
+
+    settings_file = os.path.join(input_folder, 'Analysis_Settings.txt')
+    if not os.path.isfile(settings_file):
+        logging.warning('##### WAITING FOR Analysis_Settings.txt')
+    while not os.path.isfile(settings_file):
+        time.sleep(interval)
+
+    with open(settings_file) as file:
+        return core.get_channels_from_settings_file(file)
+
+
+def group_samples(filenames, channels) -> dict[str, dict[str, str]]:
+    """ {sample : {channel : filename}} of the files of the settings channels """
+
+    samples = {}
+    for filename in sorted(filenames):
+        matches = core.FILENAME_PATTERN.match(filename)
+        if matches and matches.group(2) in channels:
+            samples.setdefault(matches.group(1), {})[matches.group(2)] = filename
+    return samples
+
+
+#######################
+#        WATCH        #
+#######################
+
+
+def iter_ready_files(input_folder, interval=options.WATCH_INTERVAL, debounce=options.WATCH_DEBOUNCE,
+                     idle_timeout=None):
+    """
+    Watches a folder written by the AURA macro, one sample at a time.
+    A sample is ready once a file of every channel of the settings file (but the nuclei channel) is written, and
+    none of its files changed for debounce seconds: files being written are not read. Samples are yielded again if
+    one of their files changes.
+    Watching stops once no file changed for idle_timeout seconds (never if None), samples still missing channels
+    are then yielded as they are.
+
+    Output: generator yielding the {filename : file path} of the samples ready since the previous scan, and the
+    settings channels
+    """
+
+    channels = wait_for_settings(input_folder, interval=interval)
+
+    changes = {}        # {filename : ((size, modification time), time of the last change)}
+    processed = {}      # {filename : (size, modification time) when yielded}
+    last_change = time.monotonic()
+
+    while True:
+        now = time.monotonic()
+        files = scan_folder(input_folder)
+        for filename, signature in files.items():
+            if filename not in changes or changes[filename][0] != signature:
+                changes[filename] = (signature, now)
+                last_change = now
+
+        idle = idle_timeout is not None and now - last_change >= idle_timeout
+
+        ready, ready_files = [], {}
+        for sample, sample_files in group_samples(files, channels).items():
+            filenames = list(sample_files.values())
+
+            # empty files are created before being written
+            if any(now - changes[filename][1] < debounce or not changes[filename][0][0] for filename in filenames):
+                continue
+            if all(processed.get(filename) == changes[filename][0] for filename in filenames):
+                continue
+            if core.has_missing_channels(sample_files, channels) and not idle:
+                continue
+
+            ready.append(sample)
+            ready_files.update({filename: os.path.join(input_folder, filename) for filename in filenames})
+
+        if ready:
+            logging.warning(f'##### SAMPLES READY: {", ".join(ready)}')
+            processed.update({filename: changes[filename][0] for filename in ready_files})
+            yield ready_files, channels
+        elif idle:
+            logging.warning(f'##### NO CHANGE FOR {idle_timeout:g} SECONDS, STOPPING')
+            return
+        else:
+            time.sleep(interval)
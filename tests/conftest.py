@@ -0,0 +1,43 @@
+import pytest
+
+
+CHANNELS = ['Opal520', 'Opal570', 'Opal650']
+
+
+class AuraFiles:
+    """ Writes the files of an AURA macro run: the settings file, then one .csv file per sample x channel """
+
+    def __init__(self, channels=CHANNELS):
+        self.channels = channels
+
+    def get_settings(self) -> str:
+        settings = ['Channel 1: DAPI', 'Nuclei channel: DAPI']
+        settings += [f'Channel {index}: {channel}' for index, channel in enumerate(self.channels, start=2)]
+        return '\n'.join(settings) + '\n'
+
+    def get_table(self, channel, seed=0, cells=20) -> str:
+        """ Table of a sample channel, seed changes its values and adds seed cells """
+        offset = self.channels.index(channel)
+        rows = [' ,Slice,Count,Total Area,Mean']
+        for cell in range(1, cells + seed + 1):
+            count = (cell * (seed + offset + 1)) % 7
+            rows.append(f'{cell},{channel}_{cell},{count},{count * 0.125},255')
+        return '\n'.join(rows) + '\n'
+
+    def write_settings(self, folder):
+        (folder / 'Analysis_Settings.txt').write_text(self.get_settings())
+
+    def write_sample(self, folder, sample, seed=0, cells=20):
+        for channel in self.channels:
+            (folder / f'{sample}_{channel}.csv').write_text(self.get_table(channel, seed, cells))
+
+    def write_experiment(self, folder, samples=1, cells=20):
+        """ Settings, and samples Image000, Image001, ... """
+        self.write_settings(folder)
+        for seed in range(samples):
+            self.write_sample(folder, f'Image{seed:03d}', seed=seed, cells=cells)
+
+
+@pytest.fixture
+def aura_files() -> AuraFiles:
+    return AuraFiles()
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.analysis as analysis
+
+
+def test_area_threshold_is_continuous():
+    data = {'Image000': pd.DataFrame({'Opal520': [0, 2.5, 3, 4.5, np.nan], 'Opal570': [1, 2, 2.9, np.nan, np.nan]})}
+
+    results = analysis.compute_analysis(data, 'Area', positivity_threshold=3)
+
+    # an area of 2.5 is below the threshold, whatever the integer edges look like
+    assert list(results.columns[2:4]) == ['<3', '>=3']
+    assert results['<3'].tolist() == [2, 3]
+    assert results['>=3'].tolist() == [2, 0]
+    assert results['Total'].tolist() == [4, 3]
+    assert results['% Positive Cells'].tolist() == [50, 0]
+    # only the areas of the positive cells are summed
+    assert results['Total Area'].tolist() == [7.5, 0]
+    assert results['Avg Area/Cell'].tolist() == [pytest.approx(7.5 / 4), 0]
+
+
+def get_random_data(analysis_type, seed=0) -> dict[str, pd.DataFrame]:
+    """ Samples of 1 to 3 channels with empty cells: dots counts, or areas including values on the thresholds """
+
+    rng = np.random.default_rng(seed)
+    data = {}
+    for sample, (n_channels, n_cells) in enumerate([(3, 50), (1, 20), (2, 1), (3, 35)]):
+        if analysis_type == 'Count':
+            values = rng.integers(0, 25, size=(n_cells, n_channels)).astype(np.float64)
+        else:
+            values = rng.choice([0, 0.5, 1.5, 2.5, 3, 7.25], size=(n_cells, n_channels))
+        values[rng.random(values.shape) < 0.1] = np.nan
+        data[f'Image{sample:03d}'] = pd.DataFrame(values, columns=[f'Opal{520 + 50 * i}' for i in range(n_channels)])
+    return data
+
+
+def get_reference_analysis(data, analysis_type, edges) -> pd.DataFrame:
+    """ One channel at a time with pandas, bins being [edge, next edge) intervals """
+
+    rows = []
+    for sample, df in data.items():
+        for channel, column in df.items():
+            cells = column.dropna()
+            total = len(cells)
+            bounds = [-np.inf, *edges, np.inf]
+            counts = [cells.between(low, high, inclusive='left').sum() for low, high in zip(bounds[:-1], bounds[1:])]
+            positive = cells[cells >= edges[0]]
+
+            row = [sample, channel, *counts, total, len(positive) / total * 100 if total else np.nan]
+            if analysis_type == 'Count':
+                h_score = sum(weight * count for weight, count in enumerate(counts)) / total * 100 if total else np.nan
+                row += [h_score, cells.sum() / total if total else np.nan]
+            else:
+                row += [positive.sum(), positive.sum() / total if total else np.nan]
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('analysis_type, threshold, bin_edges', [
+    ('Count', None, None), ('Count', 2, None), ('Count', 3, (5, 12, 20)), ('Count', None, (2, 6, 9)),
+    ('Area', None, None), ('Area', 3, None), ('Area', 1.5, None)])
+def test_analysis_matches_pandas_reference(analysis_type, threshold, bin_edges):
+    data = get_random_data(analysis_type)
+
+    results = analysis.compute_analysis(data, analysis_type, positivity_threshold=threshold, bin_edges=bin_edges)
+
+    edges = analysis.get_bin_edges(analysis_type, threshold, bin_edges)
+    expected = get_reference_analysis(data, analysis_type, edges)
+    # same columns order: sample, channel, bins, total, % positive cells and statistics
+    expected.columns = results.columns
+    pd.testing.assert_frame_equal(results, expected, check_dtype=False)
@@ -0,0 +1,52 @@
+from zipfile import ZipFile
+
+import src.aura as aura
+
+
+def write_zip(filename, members):
+    with ZipFile(filename, 'w') as zip_file:
+        for name, content in members:
+            zip_file.writestr(name, content)
+
+
+def test_zip_samples_are_sorted(tmp_path, aura_files):
+    filename = tmp_path / 'experiment.zip'
+    write_zip(filename, [('Analysis_Settings.txt', aura_files.get_settings())] +
+              [(f'{sample}_{channel}.csv', aura_files.get_table(channel, seed, cells=5))
+               for seed, sample in enumerate(['Image001', 'Image000']) for channel in reversed(aura_files.channels)])
+
+    experiment = aura.load_experiment(filename)
+    assert experiment.samples == ['Image000', 'Image001']
+    assert list(experiment.files_attributes['Image000']) == aura_files.channels
+
+
+def test_zip_duplicated_channels_are_reported(tmp_path, aura_files):
+    filename = tmp_path / 'experiment.zip'
+    write_zip(filename, [('Analysis_Settings.txt', aura_files.get_settings())] +
+              [(f'run1/Image000_{channel}.csv', aura_files.get_table(channel)) for channel in aura_files.channels] +
+              [('run2/Image000_Opal520.csv', aura_files.get_table('Opal520', seed=1))])
+
+    errors = []
+    experiment = aura.load_experiment(filename, on_error=errors.append)
+    assert experiment.samples == ['Image000']
+    assert len(errors) == 1
+    assert 'Found duplicated channel [**Opal520**] for sample **Image000** in file: **run2/Image000_Opal520.csv**' \
+        in errors[0]
+
+
+def test_progress_counts_skipped_files(tmp_path, aura_files):
+    aura_files.write_experiment(tmp_path, samples=2, cells=5)
+    # stray files: not named <sample>_<channel>.csv, or not of a settings channel
+    (tmp_path / 'notes.csv').write_text(' ,Slice,Count\n')
+    (tmp_path / 'Image000_Opal690.csv').write_text(aura_files.get_table('Opal520'))
+
+    fractions = []
+    errors = []
+    experiment = aura.load_experiment(tmp_path, on_error=errors.append,
+                                      progress=lambda fraction, text: fractions.append(fraction))
+
+    assert experiment.samples == ['Image000', 'Image001']
+    assert len(errors) == 1
+    assert fractions[0] == 0
+    assert fractions[-1] == 1
+    assert len(fractions) == 1 + 2 * len(aura_files.channels) + 2
@@ -0,0 +1,107 @@
+import os
+import glob
+import gzip
+import json
+
+import openpyxl
+import pytest
+from openpyxl.xml.functions import tostring
+
+import src.aura as aura
+import src.bundles as bundles
+
+
+STYLE_ATTRIBUTES = ('font', 'fill', 'border', 'alignment', 'protection', 'number_format')
+
+
+# Recompiled by the tests: both analyses, templates with and without conditional formats (compiling every template
+# takes over a minute, the others are only checked against their hash)
+COMPILED_TEMPLATES = ['templates/count/template_sheet_count.xlsx',
+                      'templates/count/template_sheet_count_2channels.xlsx',
+                      'templates/area/template_sheet_area_3channels.xlsx',
+                      'templates/area/template_summary_area_2channels.xlsx']
+
+
+def read_bundle(bundle_file) -> dict:
+    with gzip.open(bundle_file, 'rt', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def resolve_template(spec, styles, tables) -> dict:
+    """ Template spec with the style indexes replaced by the XML of the style parts, which do not depend on the other
+        templates of the bundle """
+
+    def resolve_style(style):
+        if style is None:
+            return None
+        *parts, number_format = styles[style]
+        return [tables[part][index] for part, index in zip(bundles.STYLE_PARTS, parts)] + [number_format]
+
+    columns = {int(col): [[start, end, value, resolve_style(style)] for start, end, value, style in runs]
+               for col, runs in spec['columns'].items()}
+    return {**spec, 'columns': columns}
+
+
+def test_bundle_is_up_to_date():
+    # rebuild with: python -m src.bundles
+    bundle = read_bundle(bundles.BUNDLE_FILE)
+    assert bundle['version'] == bundles.BUNDLE_VERSION
+
+    templates = sorted(glob.glob(bundles.TEMPLATES_PATTERN, root_dir=bundles.SRC_FOLDER))
+    assert sorted(bundle['templates']) == [template.replace(os.sep, '/') for template in templates]
+    for template, spec in bundle['templates'].items():
+        assert spec['sha1'] == bundles.get_file_hash(os.path.join(bundles.SRC_FOLDER, template)), template
+
+    committed_tables = {part: bundle[part] for part in bundles.STYLE_PARTS}
+    for template in COMPILED_TEMPLATES:
+        tables, styles = {part: {} for part in bundles.STYLE_PARTS}, {}
+        template_ws = openpyxl.load_workbook(os.path.join(bundles.SRC_FOLDER, template)).worksheets[0]
+        spec = bundles.compile_template(template_ws, tables, styles)
+
+        compiled = resolve_template(spec, list(styles), {part: list(table) for part, table in tables.items()})
+        committed = resolve_template({key: value for key, value in bundle['templates'][template].items()
+                                      if key != 'sha1'}, bundle['styles'], committed_tables)
+        assert compiled == committed, template
+
+
+def get_conditional_formats(ws) -> list:
+    return [(str(conditional_format.sqref), [tostring(rule.to_tree()) for rule in conditional_format.rules])
+            for conditional_format in ws.conditional_formatting]
+
+
+def test_bundle_keeps_conditional_formats():
+    templates, styles = bundles.load_bundle()
+    for template in COMPILED_TEMPLATES:
+        template_ws = openpyxl.load_workbook(os.path.join(bundles.SRC_FOLDER, template)).worksheets[0]
+        bundle_ws = bundles.TemplateSheet(templates[template], styles)
+        assert get_conditional_formats(bundle_ws) == get_conditional_formats(template_ws), template
+    assert any(bundles.TemplateSheet(templates[template], styles).conditional_formatting
+               for template in COMPILED_TEMPLATES)
+
+
+def read_cells(filename) -> dict:
+    """ {sheet : {coordinate : (value, style attributes)}} of every written cell """
+
+    cells = {}
+    for ws in openpyxl.load_workbook(filename):
+        cells[ws.title] = {cell.coordinate: (cell.value, *(repr(getattr(cell, name)) for name in STYLE_ATTRIBUTES))
+                           for row in ws.iter_rows() for cell in row if cell.value is not None or cell.has_style}
+    return cells
+
+
+@pytest.mark.parametrize('analysis_type', ['Count', 'Area'])
+def test_bundle_renders_the_same_sheets_as_the_templates(tmp_path, monkeypatch, aura_files, analysis_type):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_experiment(input_folder, samples=2, cells=6)
+    experiment = aura.load_experiment(input_folder)
+
+    bundled = tmp_path / 'bundled.xlsx'
+    aura.write_workbook(experiment, str(bundled), analysis_type)
+
+    # templates are then parsed from the .xlsx files
+    monkeypatch.setattr(bundles, 'read_template', lambda template, mtime: None)
+    parsed = tmp_path / 'parsed.xlsx'
+    aura.write_workbook(experiment, str(parsed), analysis_type)
+
+    assert read_cells(bundled) == read_cells(parsed)
@@ -0,0 +1,45 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+import src.options as options
+
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_SCRIPT = os.path.join(ROOT_FOLDER, 'CLI_aura_data_processing.py')
+
+
+def run_cli(tmp_path, *args) -> subprocess.CompletedProcess:
+    # arguments are checked before the input folder is read
+    command = [sys.executable, CLI_SCRIPT, '-n', 'test', '-i', str(tmp_path), '-o', str(tmp_path), *args]
+    return subprocess.run(command, cwd=ROOT_FOLDER, capture_output=True, text=True)
+
+
+@pytest.mark.parametrize('threshold', ['4', '5'])
+def test_threshold_above_default_bin_edges_is_rejected(tmp_path, threshold):
+    result = run_cli(tmp_path, '-a', 'Count', '-m', 'values', '-t', threshold)
+    assert result.returncode == 2
+    assert 'error: Positivity threshold must be lower than the first default H-score bin edge' in result.stderr
+    assert 'Traceback' not in result.stderr
+
+
+def test_threshold_with_higher_bin_edges_is_accepted():
+    options.validate_thresholds('Count', 5, (6, 10, 16))
+    options.validate_thresholds('Count', 3)
+    options.validate_thresholds('Area', 5)
+
+
+def test_sweep_thresholds_may_exceed_bin_edges():
+    # the H-score is not defined above the first bin edge, but the % of positive cells is
+    options.validate_positivity_threshold(10)
+    with pytest.raises(ValueError):
+        options.validate_positivity_threshold(0)
+
+
+def test_checkpoint_requires_openpyxl_writer(tmp_path):
+    # checkpoints are saved from the in-memory openpyxl workbook, the streamed writer would then keep it in memory too
+    result = run_cli(tmp_path, '-a', 'Count', '-w', 'xlsxwriter', '--checkpoint')
+    assert result.returncode == 2
+    assert 'error: --checkpoint can not be used with --processes or --writer xlsxwriter' in result.stderr
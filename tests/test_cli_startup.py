@@ -0,0 +1,44 @@
+import os
+import sys
+import json
+import subprocess
+
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_SCRIPT = os.path.join(ROOT_FOLDER, 'CLI_aura_data_processing.py')
+
+# Modules only imported once the CLI arguments are parsed and checked
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl', 'streamlit', 'xlsxwriter')
+
+# Imports the CLI in a fresh interpreter and parses the given arguments, then prints whether they were accepted and
+# the heavy modules imported
+STARTUP_SCRIPT = '''
+import sys, json, runpy
+sys.path.insert(0, {root!r})
+cli = runpy.run_path({script!r})
+sys.argv = [{script!r}, *{args!r}]
+try:
+    cli['parse_args']()
+    parsed = True
+except SystemExit:
+    parsed = False
+print(json.dumps({{'parsed': parsed, 'modules': [name for name in {modules!r} if name in sys.modules]}}))
+'''
+
+
+def parse_cli_args(*args) -> dict:
+    script = STARTUP_SCRIPT.format(root=ROOT_FOLDER, script=CLI_SCRIPT, args=list(args), modules=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', script], cwd=ROOT_FOLDER, capture_output=True, text=True,
+                            check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_help_does_not_import_heavy_modules():
+    assert parse_cli_args('-h') == {'parsed': False, 'modules': []}
+
+
+def test_arguments_are_checked_without_heavy_modules(tmp_path, aura_files):
+    aura_files.write_settings(tmp_path)
+    args = ['-n', 'test', '-a', 'Count', '-i', str(tmp_path), '-o', str(tmp_path), '-m', 'values', '-t', '2',
+            '--sweep', '1', '2', '-w', 'xlsxwriter']
+    assert parse_cli_args(*args) == {'parsed': True, 'modules': []}
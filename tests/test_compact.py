@@ -0,0 +1,42 @@
+import openpyxl
+import pandas as pd
+
+import src.aura as aura
+import src.analysis as analysis
+import src.compact as compact
+
+
+def read_table(ws) -> pd.DataFrame:
+    rows = list(ws.iter_rows(values_only=True))
+    return pd.DataFrame(rows[1:], columns=rows[0])
+
+
+def test_long_tables_continue_on_new_sheets(tmp_path, monkeypatch, aura_files):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    # 3 samples of 8, 9 and 10 cells: 27 data rows
+    aura_files.write_experiment(input_folder, samples=3, cells=8)
+    experiment = aura.load_experiment(input_folder)
+
+    # header + 10 rows per sheet
+    monkeypatch.setattr(compact, 'MAX_SHEET_ROWS', 11)
+    filename = tmp_path / 'experiment.xlsx'
+    aura.write_workbook(experiment, str(filename), 'Count', layout='long')
+
+    workbook = openpyxl.load_workbook(filename)
+    assert workbook.sheetnames == ['analysis', 'data', 'data (2)', 'data (3)']
+
+    columns = ['Sample', 'Cell'] + aura_files.channels
+    sheets = [workbook[name] for name in ('data', 'data (2)', 'data (3)')]
+    assert [ws.max_row for ws in sheets] == [11, 11, 8]
+    for ws in sheets:
+        assert [cell.value for cell in ws[1]] == columns
+        assert ws.freeze_panes == 'A2'
+        assert ws.auto_filter.ref == f'A1:E{ws.max_row}'
+
+    data = dict(aura.iter_data(experiment, 'Count'))
+    long_data = pd.concat([read_table(ws) for ws in sheets], ignore_index=True)
+    pd.testing.assert_frame_equal(long_data, compact.get_long_data(data), check_dtype=False)
+
+    expected_analysis = analysis.compute_analysis(data, 'Count')
+    pd.testing.assert_frame_equal(read_table(workbook['analysis']), expected_analysis, check_dtype=False)
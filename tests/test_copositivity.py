@@ -0,0 +1,118 @@
+from itertools import combinations
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+
+import src.aura as aura
+import src.copositivity as copositivity
+from src.options import DEFAULT_POSITIVITY_THRESHOLDS
+
+
+def get_random_data(seed) -> dict[str, pd.DataFrame]:
+    """ Samples of 1 to 4 channels, with empty cells, e.g. channels of different lengths """
+
+    rng = np.random.default_rng(seed)
+    data = {}
+    for sample, (n_channels, n_cells) in enumerate([(3, 40), (2, 25), (4, 60), (3, 1), (1, 10), (4, 33)]):
+        values = rng.integers(0, 6, size=(n_cells, n_channels)).astype(np.float64)
+        values[rng.random(values.shape) < 0.15] = np.nan
+        data[f'Image{sample:03d}'] = pd.DataFrame(values, columns=[f'Opal{520 + 50 * i}' for i in range(n_channels)])
+    return data
+
+
+def get_reference_copositivity(df, threshold) -> tuple[np.ndarray, np.ndarray]:
+    """ Cell by cell, as the IF() formulas of the templates """
+
+    n_channels = df.shape[1]
+    channels_combinations = [combination for n in range(2, n_channels + 1)
+                             for combination in combinations(range(n_channels), n)]
+
+    flags = np.zeros((len(df), len(channels_combinations)), dtype=np.int8)
+    for row, cell in enumerate(df.itertuples(index=False)):
+        for col, combination in enumerate(channels_combinations):
+            # empty cells are never positive
+            flags[row, col] = all(not np.isnan(cell[i]) and cell[i] >= threshold for i in combination)
+
+    return flags, flags.sum(axis=0)
+
+
+@pytest.mark.parametrize('analysis_type, threshold', [('Count', None), ('Count', 3), ('Area', None), ('Area', 2.5)])
+def test_copositivity_matches_cell_by_cell_reference(analysis_type, threshold):
+    data = get_random_data(seed=0)
+    results = copositivity.compute_copositivity(data, analysis_type, positivity_threshold=threshold)
+
+    # single channel samples have no co-positivity
+    assert set(results) == {sample for sample, df in data.items() if df.shape[1] > 1}
+
+    threshold = DEFAULT_POSITIVITY_THRESHOLDS[analysis_type] if threshold is None else threshold
+    for sample, (flags, counts) in results.items():
+        expected_flags, expected_counts = get_reference_copositivity(data[sample], threshold)
+        np.testing.assert_array_equal(flags, expected_flags)
+        np.testing.assert_array_equal(counts, expected_counts)
+
+
+@pytest.mark.parametrize('backend', ['openpyxl', 'xlsxwriter'])
+def test_values_mode_sheets_have_no_formulas(tmp_path, aura_files, backend):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_experiment(input_folder, cells=8)
+    filename = tmp_path / 'experiment.xlsx'
+    aura.write_workbook(aura.load_experiment(input_folder), str(filename), 'Count', output_mode='values',
+                        backend=backend)
+
+    ws = openpyxl.load_workbook(filename)['Image000']
+    formulas = [cell.coordinate for row in ws.iter_rows() for cell in row
+                if isinstance(cell.value, str) and cell.value.startswith('=')]
+    assert formulas == []
+
+    # % of co-positive cells of the first combination (Opal520+Opal570), below its header row
+    start_row = copositivity.get_copositivity_analysis_coordinates('Count', len(aura_files.channels))[0] + 2
+    df = pd.read_csv(input_folder / 'Image000_Opal520.csv')['Count'].to_frame('Opal520')
+    df['Opal570'] = pd.read_csv(input_folder / 'Image000_Opal570.csv')['Count']
+    expected = ((df >= 1).all(axis=1)).sum() / len(df) * 100
+    assert ws.cell(start_row, 3).value == pytest.approx(expected)
+
+
+def test_layout_of_more_than_six_channels(tmp_path, aura_files):
+    aura_files.channels = [f'Opal{520 + 50 * i}' for i in range(7)]
+    aura_files.write_experiment(tmp_path, cells=4)
+    filename = tmp_path / 'experiment.xlsx'
+    aura.write_workbook(aura.load_experiment(tmp_path), str(filename), 'Count')
+    workbook = openpyxl.load_workbook(filename)
+
+    # channels C2 to C8: 120 combinations of at least 2 channels
+    names = [copositivity.get_combination_name(combination)
+             for combination in copositivity.combine_channels(f'C{i}' for i in range(2, 9))]
+    assert len(names) == 2 ** 7 - 7 - 1
+
+    # one column per combination between the separators following the data (G: slice, H-N: channels)
+    ws = workbook['Image000']
+    col_start, col_end = copositivity.get_copositivity_coordinates(7)
+    assert (col_start, col_end) == (15, 15 + len(names) + 1)
+    assert [ws.cell(2, col).value for col in range(col_start + 1, col_end)] == names
+    assert ws.cell(2, col_end).value is None
+
+    # one analysis row per combination, relative to the 'Total' rows of the combined channels
+    start_row, end_row = copositivity.get_copositivity_analysis_coordinates('Count', 7)
+    rows = range(start_row + 2, start_row + 2 + len(names))
+    assert [ws.cell(row, 1).value for row in rows] == names
+    assert ws.cell(rows[-1], 3).value == f'=B{rows[-1]}/(AVERAGE(B10,B18,B26,B34,B42,B50,B58))*100'
+    assert end_row == rows[-1] + 2
+
+    # summary: one column per combination referring to the sample sheet
+    summary_ws = workbook['summary']
+    summary_start, summary_end = copositivity.get_summary_coordinates(7)
+    assert [summary_ws.cell(3, col).value for col in range(summary_start, summary_end)] == \
+        [f"='Image000'!C{row}" for row in rows]
+
+
+def test_too_many_channels_are_rejected():
+    n_channels = copositivity.MAX_COPOSITIVITY_CHANNELS + 1
+    data = {'Image000': pd.DataFrame(np.ones((3, n_channels)))}
+
+    with pytest.raises(ValueError, match=f'limited to {copositivity.MAX_COPOSITIVITY_CHANNELS} channels'):
+        copositivity.compute_copositivity(data, 'Count')
+    with pytest.raises(ValueError, match=f'got {n_channels} channels'):
+        copositivity.get_copositivity_coordinates(n_channels)
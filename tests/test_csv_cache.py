@@ -0,0 +1,85 @@
+import os
+
+import pandas as pd
+import pytest
+
+import src.aura as aura
+import src.core as core
+import src.csv_cache as csv_cache
+
+
+@pytest.fixture
+def parsed_files(monkeypatch) -> list:
+    """ Tables parsed by core.read_aura_csv """
+
+    parsed = []
+    read_aura_csv = core.read_aura_csv
+
+    def record_parse(file, column_name=None):
+        parsed.append(file)
+        return read_aura_csv(file, column_name)
+
+    monkeypatch.setattr(core, 'read_aura_csv', record_parse)
+    return parsed
+
+
+def read_experiment(input_folder, cache_dir, max_size=2**20) -> dict[str, pd.DataFrame]:
+    cache = csv_cache.CsvCache(cache_dir, max_size=max_size)
+    return dict(aura.iter_data(aura.load_experiment(input_folder, cache=cache), 'Count'))
+
+
+def test_rerun_reads_the_cache(tmp_path, aura_files, parsed_files):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_experiment(input_folder, samples=2)
+
+    data = read_experiment(input_folder, tmp_path / 'cache')
+    assert len(parsed_files) == 2 * len(aura_files.channels)
+
+    parsed_files.clear()
+    cached_data = read_experiment(input_folder, tmp_path / 'cache')
+    assert parsed_files == []
+    for sample, df in data.items():
+        pd.testing.assert_frame_equal(cached_data[sample], df)
+
+
+def test_changed_file_is_parsed_again(tmp_path, aura_files, parsed_files):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_experiment(input_folder, samples=2)
+    read_experiment(input_folder, tmp_path / 'cache')
+
+    # same name, new content
+    (input_folder / 'Image001_Opal570.csv').write_text(aura_files.get_table('Opal570', seed=5))
+
+    parsed_files.clear()
+    data = read_experiment(input_folder, tmp_path / 'cache')
+    assert len(parsed_files) == 1
+    assert len(data['Image001']) == 20 + 5
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, aura_files):
+    files = []
+    for seed in range(4):
+        files.append(tmp_path / f'Image00{seed}_Opal520.csv')
+        files[-1].write_text(aura_files.get_table('Opal520', seed=seed))
+
+    cache = csv_cache.CsvCache(tmp_path / 'cache', max_size=2**20)
+    paths = []
+    for age, file in enumerate(files[:3]):
+        cache.read(str(file), 'Count')
+        paths.append(cache.get_path(file.read_bytes(), 'Count'))
+        # entries used one after the other, a second apart
+        os.utime(paths[-1], ns=(age * 10**9, age * 10**9))
+    entry_size = max(os.path.getsize(path) for path in paths)
+
+    # reading the oldest entry makes it the most recently used
+    cache.read(str(files[0]), 'Count')
+
+    # room for 3 entries: storing a 4th one removes the least recently used one
+    cache = csv_cache.CsvCache(tmp_path / 'cache', max_size=3 * entry_size + entry_size // 2)
+    cache.read(str(files[3]), 'Count')
+
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+    assert os.path.exists(cache.get_path(files[3].read_bytes(), 'Count'))
+    assert cache.size <= cache.max_size
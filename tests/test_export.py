@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+import src.aura as aura
+import src.analysis as analysis
+import src.compact as compact
+import src.export as export
+import src.options as options
+
+
+READERS = {'parquet': pd.read_parquet, 'arrow': pd.read_feather, 'csv': pd.read_csv}
+
+
+@pytest.fixture
+def experiment(tmp_path, aura_files):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_experiment(input_folder, samples=3, cells=6)
+    # a blank count: the channel is read as floats, with a missing value
+    (input_folder / 'Image001_Opal570.csv').write_text(' ,Slice,Count\n1,Opal570_1,\n2,Opal570_2,3\n')
+    return aura.load_experiment(input_folder)
+
+
+@pytest.mark.parametrize('fmt', list(options.EXPORT_FORMATS))
+def test_exported_tables_round_trip(tmp_path, experiment, fmt):
+    if fmt in options.PYARROW_FORMATS:
+        pytest.importorskip('pyarrow')
+
+    data = dict(aura.iter_data(experiment, 'Count'))
+    analysis_results = analysis.compute_analysis(data, 'Count')
+    paths = export.export_results(str(tmp_path), 'experiment', data=data, analysis=analysis_results, formats=[fmt])
+
+    extension = options.EXPORT_FORMATS[fmt]
+    assert paths == [str(tmp_path / f'experiment_data{extension}'), str(tmp_path / f'experiment_analysis{extension}')]
+
+    exported_data, exported_analysis = (READERS[fmt](path) for path in paths)
+    # .csv files do not keep the column types
+    check_dtype = fmt != 'csv'
+    pd.testing.assert_frame_equal(exported_data, compact.get_long_data(data), check_dtype=check_dtype)
+    pd.testing.assert_frame_equal(exported_analysis, analysis_results, check_dtype=check_dtype)
+
+
+def test_pyarrow_formats_require_pyarrow(tmp_path, experiment, monkeypatch):
+    monkeypatch.setattr(options, 'has_pyarrow', lambda: False)
+    assert export.get_available_formats() == ['csv']
+
+    data = dict(aura.iter_data(experiment, 'Count'))
+    with pytest.raises(ImportError, match='pip install pyarrow'):
+        export.export_results(str(tmp_path), 'experiment', data=data, analysis=analysis.compute_analysis(data, 'Count'),
+                              formats=['csv', 'parquet'])
+    # nothing is written before the formats are checked
+    assert not list(tmp_path.glob('experiment_*'))
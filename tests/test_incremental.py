@@ -0,0 +1,97 @@
+import os
+import json
+import logging
+from zipfile import ZipFile
+
+import src.aura as aura
+import src.incremental as incremental
+
+
+def read_parts(filename) -> dict[str, bytes]:
+    """ Sheets and styles of an .xlsx file, the parts copied or numbered by incremental.stream_workbook """
+    with ZipFile(filename) as zip_file:
+        return {name: zip_file.read(name) for name in zip_file.namelist()
+                if name.startswith('xl/worksheets/') or name == 'xl/styles.xml'}
+
+
+def write_workbook(folder, filename, **kwargs):
+    return aura.write_workbook(aura.load_experiment(folder), str(filename), 'Count', **kwargs)
+
+
+def test_appended_workbook_matches_full_build(tmp_path, aura_files):
+    input_folder, full_folder = tmp_path / 'input', tmp_path / 'full'
+    input_folder.mkdir()
+    full_folder.mkdir()
+    aura_files.write_settings(input_folder)
+    aura_files.write_sample(input_folder, 'Image000', seed=0)
+    aura_files.write_sample(input_folder, 'Image001', seed=1)
+
+    appended = tmp_path / 'appended.xlsx'
+    write_workbook(input_folder, appended, append=True)
+
+    # a new sample, and a changed sample
+    aura_files.write_sample(input_folder, 'Image002', seed=2)
+    aura_files.write_sample(input_folder, 'Image000', seed=3)
+    data, _ = write_workbook(input_folder, appended, append=True)
+    assert list(data) == ['Image000', 'Image002']
+
+    full = tmp_path / 'full.xlsx'
+    write_workbook(input_folder, full, backend='xlsxwriter')
+
+    assert read_parts(appended) == read_parts(full)
+
+
+def test_workbook_of_other_writer_is_rebuilt(tmp_path, aura_files, caplog):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_settings(input_folder)
+    aura_files.write_sample(input_folder, 'Image000', seed=0)
+
+    filename = tmp_path / 'appended.xlsx'
+    write_workbook(input_folder, filename, append=True)
+
+    # formats could be numbered differently by another XlsxWriter version
+    manifest_file = incremental.get_manifest_file(str(filename))
+    with open(manifest_file) as file:
+        manifest = json.load(file)
+    manifest['settings']['writer']['xlsxwriter'] = '0.0'
+    with open(manifest_file, 'w') as file:
+        json.dump(manifest, file)
+
+    with caplog.at_level(logging.WARNING):
+        data, _ = write_workbook(input_folder, filename, append=True)
+    assert 'WORKBOOK WRITTEN WITH OTHER SETTINGS' in caplog.text
+    assert list(data) == ['Image000']
+
+
+def test_unchanged_files_are_not_read(tmp_path, aura_files, monkeypatch):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_settings(input_folder)
+    aura_files.write_sample(input_folder, 'Image000', seed=0)
+    aura_files.write_sample(input_folder, 'Image001', seed=1)
+
+    filename = tmp_path / 'appended.xlsx'
+    write_workbook(input_folder, filename, append=True)
+
+    read_files = []
+    read_file_bytes, read_aura_csv = incremental.csv_cache.read_file_bytes, incremental.core.read_aura_csv
+    monkeypatch.setattr(incremental.csv_cache, 'read_file_bytes',
+                        lambda file: read_files.append(os.path.basename(file)) or read_file_bytes(file))
+    monkeypatch.setattr(incremental.core, 'read_aura_csv',
+                        lambda file, *args: read_files.append(os.path.basename(file)) or read_aura_csv(file, *args))
+
+    # the files of the previous samples are neither hashed nor read, their sheets are copied
+    aura_files.write_sample(input_folder, 'Image002', seed=2)
+    data, _ = write_workbook(input_folder, filename, append=True)
+    assert list(data) == ['Image002']
+    assert {file.split('_')[0] for file in read_files} == {'Image002'}
+
+    # a file rewritten with the same content is hashed again, the sample is not rendered
+    read_files.clear()
+    aura_files.write_sample(input_folder, 'Image001', seed=1)
+    for file in input_folder.glob('Image001_*.csv'):
+        os.utime(file, ns=(file.stat().st_atime_ns, file.stat().st_mtime_ns + 10 ** 9))
+    data, _ = write_workbook(input_folder, filename, append=True)
+    assert data == {}
+    assert {file.split('_')[0] for file in read_files} == {'Image001'}
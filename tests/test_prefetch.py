@@ -0,0 +1,30 @@
+import threading
+
+import pytest
+
+import src.aura as aura
+import src.core as core
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'backend': 'xlsxwriter'}, {'append': True}],
+                         ids=['openpyxl', 'xlsxwriter', 'append'])
+def test_sheets_are_read_ahead_in_threads(tmp_path, monkeypatch, aura_files, kwargs):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_experiment(input_folder, samples=4, cells=7)
+
+    threads = []
+    read_aura_csv = core.read_aura_csv
+
+    def record_thread(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return read_aura_csv(*args, **kwargs)
+
+    monkeypatch.setattr(core, 'read_aura_csv', record_thread)
+
+    experiment = aura.load_experiment(input_folder, jobs=2)
+    data, _ = aura.write_workbook(experiment, str(tmp_path / 'experiment.xlsx'), 'Count', **kwargs)
+
+    assert len(data) == 4
+    assert len(threads) == 4 * len(aura_files.channels)
+    assert threading.main_thread() not in threads
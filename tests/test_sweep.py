@@ -0,0 +1,69 @@
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.sweep as sweep
+from src.options import DEFAULT_BIN_EDGES
+
+
+def get_random_data(analysis_type, seed=0) -> dict[str, pd.DataFrame]:
+    """ Samples of 1 to 3 channels with empty cells, values falling on the thresholds of the tests """
+
+    rng = np.random.default_rng(seed)
+    data = {}
+    for sample, (n_channels, n_cells) in enumerate([(3, 40), (1, 15), (2, 25), (3, 1)]):
+        if analysis_type == 'Count':
+            values = rng.integers(0, 20, size=(n_cells, n_channels)).astype(np.float64)
+        else:
+            values = rng.choice([0, 0.5, 1.5, 2.5, 3, 7.25], size=(n_cells, n_channels))
+        values[rng.random(values.shape) < 0.1] = np.nan
+        data[f'Image{sample:03d}'] = pd.DataFrame(values, columns=[f'Opal{520 + 50 * i}' for i in range(n_channels)])
+    return data
+
+
+def divide(numerator, denominator):
+    return numerator / denominator * 100 if denominator else np.nan
+
+
+def get_reference_sweep(data, analysis_type, thresholds, bin_edges) -> pd.DataFrame:
+    """ Every threshold one after the other, counting the cells >= threshold """
+
+    rows = []
+    for sample, df in data.items():
+        for channel, column in df.items():
+            cells = column.dropna()
+            for threshold in thresholds:
+                row = [sample, channel, threshold, divide((cells >= threshold).sum(), len(cells))]
+                if analysis_type == 'Count':
+                    # H-score: each bin edge the cell reaches adds 1 to its weight
+                    weights = sum((cells >= edge).sum() for edge in [threshold, *bin_edges])
+                    row.append(divide(weights, len(cells)) if threshold <= bin_edges[0] else np.nan)
+                rows.append(row)
+
+        channels = list(df.columns)
+        channels_combinations = [combination for n in range(2, len(channels) + 1)
+                                 for combination in combinations(channels, n)]
+        for combination in channels_combinations:
+            average_cells = np.mean([df[channel].notna().sum() for channel in combination])
+            for threshold in thresholds:
+                copositive = (df[list(combination)] >= threshold).all(axis=1).sum()
+                row = [sample, '+'.join(combination), threshold, divide(copositive, average_cells)]
+                rows.append(row + [np.nan] * (analysis_type == 'Count'))
+
+    columns = ['Sample', 'Channel', 'Threshold', '% Positive Cells'] + ['H-Score'] * (analysis_type == 'Count')
+    return pd.DataFrame(rows, columns=columns)
+
+
+@pytest.mark.parametrize('analysis_type, thresholds, bin_edges', [
+    ('Count', [1, 2, 3, 4, 5, 12], None), ('Count', [2, 6, 1], (7, 10, 15)),
+    ('Area', [0.5, 1.5, 2.5, 3, 10], None), ('Area', [0.1, 3, 1], None)])
+def test_sweep_matches_threshold_by_threshold_reference(analysis_type, thresholds, bin_edges):
+    data = get_random_data(analysis_type)
+
+    results = sweep.compute_threshold_sweep(data, analysis_type, thresholds, bin_edges=bin_edges)
+
+    # thresholds equal to data values: cells >= threshold are positive
+    expected = get_reference_sweep(data, analysis_type, sorted(thresholds), bin_edges or DEFAULT_BIN_EDGES)
+    pd.testing.assert_frame_equal(results, expected, check_dtype=False)
@@ -0,0 +1,87 @@
+import pytest
+
+import src.watch as watch
+
+
+class FakeClock:
+    """ Replaces the time module of src.watch: sleeping advances the clock and runs the actions due """
+
+    def __init__(self):
+        self.now = 0
+        self.actions = {}   # {time : action}
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        action = self.actions.pop(self.now, None)
+        if action:
+            action()
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(watch, 'time', clock)
+    return clock
+
+
+def write_sample(folder, aura_files, sample, channels=None):
+    for channel in channels or aura_files.channels:
+        (folder / f'{sample}_{channel}.csv').write_text(aura_files.get_table(channel))
+
+
+def get_ready_samples(ready_files) -> list[str]:
+    return sorted({filename.rsplit('_', 1)[0] for filename in ready_files})
+
+
+def test_samples_are_ready_once_unchanged_for_the_debounce(tmp_path, aura_files, clock):
+    aura_files.write_settings(tmp_path)
+    write_sample(tmp_path, aura_files, 'Image000')
+    # written 3 seconds later: ready 5 seconds after that
+    clock.actions[3] = lambda: write_sample(tmp_path, aura_files, 'Image001')
+
+    ready = watch.iter_ready_files(tmp_path, interval=1, debounce=5)
+
+    ready_files, _ = next(ready)
+    assert (clock.now, get_ready_samples(ready_files)) == (5, ['Image000'])
+    ready_files, _ = next(ready)
+    assert (clock.now, get_ready_samples(ready_files)) == (8, ['Image001'])
+    assert set(ready_files.values()) == {str(tmp_path / f'Image001_{channel}.csv') for channel in aura_files.channels}
+
+
+def test_files_being_written_are_not_read(tmp_path, aura_files, clock):
+    aura_files.write_settings(tmp_path)
+    write_sample(tmp_path, aura_files, 'Image000', channels=aura_files.channels[:-1])
+    # the last file is created empty, then written a few rows at a time until t=6
+    path = tmp_path / f'Image000_{aura_files.channels[-1]}.csv'
+    path.write_text('')
+    rows = aura_files.get_table(aura_files.channels[-1]).splitlines(keepends=True)
+    for second, end in zip(range(2, 7, 2), (5, 15, len(rows))):
+        clock.actions[second] = lambda end=end: path.write_text(''.join(rows[:end]))
+
+    ready = watch.iter_ready_files(tmp_path, interval=1, debounce=5)
+
+    ready_files, _ = next(ready)
+    assert clock.now == 6 + 5
+    assert get_ready_samples(ready_files) == ['Image000']
+
+
+def test_idle_timeout_yields_samples_missing_channels(tmp_path, aura_files, clock):
+    aura_files.write_settings(tmp_path)
+    write_sample(tmp_path, aura_files, 'Image000')
+    write_sample(tmp_path, aura_files, 'Image001', channels=aura_files.channels[:-1])
+
+    ready = watch.iter_ready_files(tmp_path, interval=1, debounce=5, idle_timeout=20)
+
+    ready_files, _ = next(ready)
+    assert (clock.now, get_ready_samples(ready_files)) == (5, ['Image000'])
+
+    # no file changed since t=0: the incomplete sample is processed as it is, then watching stops
+    ready_files, _ = next(ready)
+    assert (clock.now, get_ready_samples(ready_files)) == (20, ['Image001'])
+    assert len(ready_files) == len(aura_files.channels) - 1
+    with pytest.raises(StopIteration):
+        next(ready)
+    assert clock.now == 20
@@ -0,0 +1,116 @@
+from copy import copy
+
+import openpyxl
+from openpyxl.utils import column_index_from_string
+
+import src.aura as aura
+import src.parsing as parsing
+
+
+STYLE_ATTRIBUTES = ('font', 'fill', 'border', 'alignment', 'protection', 'number_format')
+
+
+def test_small_sample_columns_end_with_the_data(tmp_path, aura_files):
+    aura_files.write_experiment(tmp_path, cells=5)
+    filename = tmp_path / 'experiment.xlsx'
+    aura.write_workbook(aura.load_experiment(tmp_path), str(filename), 'Count')
+
+    # data (G-J) then co-positivity (K-O) columns: header on row 3, one row per cell
+    ws = openpyxl.load_workbook(filename)['Image000']
+    last_rows = {}
+    for row in ws.iter_rows(min_col=column_index_from_string('G')):
+        for cell in row:
+            if cell.has_style or cell.value is not None:
+                last_rows[cell.column_letter] = cell.row
+
+    assert set(last_rows) == set('GHIJKLMNO')
+    assert set(last_rows.values()) == {3 + 5}
+
+
+def get_closed_columns(ws, row) -> set[str]:
+    return {cell.column_letter for cell in ws[row] if cell.border.bottom.style}
+
+
+def test_long_sample_is_closed_on_its_last_row(tmp_path, aura_files):
+    aura_files.write_experiment(tmp_path, cells=3000)
+    filename = tmp_path / 'experiment.xlsx'
+    aura.write_workbook(aura.load_experiment(tmp_path), str(filename), 'Count')
+
+    # the last template row (2443) closes the co-positivity columns: only stamped on the last data row
+    ws = openpyxl.load_workbook(filename)['Image000']
+    assert get_closed_columns(ws, 3 + 3000) == set('LMNO')
+    assert not get_closed_columns(ws, 2443)
+    assert not get_closed_columns(ws, 3 + 3000 - 1)
+
+
+def get_cell_styles(ws) -> dict:
+    # cells created by the copy only, compared with their style objects (proxies are never equal)
+    return {cell.coordinate: tuple(copy(getattr(cell, name)) for name in STYLE_ATTRIBUTES)
+            for cell in ws._cells.values()}
+
+
+def test_template_styles_are_stamped_per_run_of_rows():
+    template_ws = parsing.load_template('templates/count/template_sheet_count_3channels.xlsx')
+    template_max_row = template_ws.max_row
+    last_row = template_max_row + 500
+
+    stamped, reference = openpyxl.Workbook().active, openpyxl.Workbook().active
+    parsing.copy_from_template(template_ws, stamped, start_row=3, end_row=last_row, template_start_col=7,
+                               template_end_col=15, destination_start_col=7, destination_end_col=15,
+                               copy_value=False, last_row=last_row)
+    styles = {}
+    for row in range(3, last_row + 1):
+        template_row = parsing.get_template_row(template_max_row, row, last_row)
+        for col in range(7, 16):
+            parsing.copy_cells(template_ws, reference, template_col=col, destination_col=col, row=row,
+                               copy_value=False, copy_style=True, template_row=template_row, styles=styles)
+    assert get_cell_styles(stamped) == get_cell_styles(reference)
+
+    # the rows past the template body are a single run, whatever the data size
+    runs = list(parsing.iter_style_runs(template_ws, 12, 3, last_row, template_max_row, last_row))
+    longer_runs = list(parsing.iter_style_runs(template_ws, 12, 3, 10 * last_row, template_max_row, 10 * last_row))
+    assert len(longer_runs) == len(runs)
+    first, last, template_cell = runs[-1]
+    assert (first, last) == (last_row, last_row)
+    assert parsing.get_style_key(template_cell) == parsing.get_style_key(template_ws.cell(template_max_row, 12))
+
+
+def read_values(filename, sheet) -> list[tuple]:
+    return list(openpyxl.load_workbook(filename)[sheet].iter_rows(values_only=True))
+
+
+def test_summary_only_refers_to_the_channels_read(tmp_path, aura_files):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_experiment(input_folder, cells=5)
+    # the Count column of a channel is missing: the file is left out of the sample
+    (input_folder / 'Image000_Opal650.csv').write_text(' ,Slice,Mean\n1,Opal650_1,255\n')
+
+    experiment = aura.load_experiment(input_folder)
+    serial, streamed = tmp_path / 'serial.xlsx', tmp_path / 'streamed.xlsx'
+    aura.write_workbook(experiment, str(serial), 'Count')
+    aura.write_workbook(experiment, str(streamed), 'Count', backend='xlsxwriter')
+
+    assert read_values(streamed, 'summary') == read_values(serial, 'summary')
+
+
+def read_sheets(filename) -> dict:
+    """ Values, styles and conditional formats of every sheet (format indexes may differ between equivalent files) """
+    workbook = openpyxl.load_workbook(filename)
+    return {ws.title: (list(ws.iter_rows(values_only=True)), get_cell_styles(ws),
+                       [(str(cf.sqref), [repr(rule.dxf) for rule in cf.rules]) for cf in ws.conditional_formatting])
+            for ws in workbook.worksheets}
+
+
+def test_sheets_written_by_workers_match_serial_ones(tmp_path, aura_files):
+    input_folder = tmp_path / 'input'
+    input_folder.mkdir()
+    aura_files.write_experiment(input_folder, samples=5, cells=8)
+
+    experiment = aura.load_experiment(input_folder)
+    serial, pool = tmp_path / 'serial.xlsx', tmp_path / 'pool.xlsx'
+    aura.write_workbook(experiment, str(serial), 'Count', backend='xlsxwriter')
+    data, _ = aura.write_workbook(experiment, str(pool), 'Count', processes=2)
+
+    assert list(data) == [f'Image00{i}' for i in range(5)]
+    assert read_sheets(pool) == read_sheets(serial)